@@ -5,164 +5,476 @@
 # creates the data batches.
 # =============================================================================
 
+import multiprocessing
 import numpy as np
 import os
-import scipy.io.wavfile as wavfile
-from scipy import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import keras
+import espectrograma
 import augmentdata
+from almacenespectrogramas import AlmacenEspectrogramas
+from indicedataset import IndiceVentanas, ListarCanciones
 
 class DataGenerator(keras.utils.Sequence):
-    """Generador de lotes, el cual realiza rutinas de lectura de audio en bloques,
-    para manejar bases de datos de tamaño arbitrario, y realiza data augmentation
-    sobre la marcha (en este caso un 50%). A su vez da el formato adecuado a 
-    las entradas de la red neuronal, y calcula la STFT sobre los audios."""
-	
-	
-    def __init__(self,batch_size=32):
-        
+    """Generador de lotes, el cual lee ventanas de audio de todo el dataset
+    (mapeado en memoria, ver indicedataset.py) y realiza data augmentation
+    sobre la marcha (en este caso un 50%). A su vez da el formato adecuado a
+    las entradas de la red neuronal, y calcula la STFT sobre los audios.
+    Cada lote depende solo de (semilla, época, idx), por lo que Keras puede
+    pedirlos en cualquier orden y desde varios workers. Al terminar de usarlo
+    se llama a close() para detener los hilos y procesos de precarga."""
+
+
+    def __init__(self,batch_size=32,almacen=None,lotesprecargados=8,spill=None,aumentadores=None,aumentarporlote=False,
+                 datasetpath="C:\\Datasets\\DSD100\\DSD100",subset="Dev",muestrasaumentadas=None,seed=None,
+                 aumentarespectros=False,trabajador=0,trabajadores=1):
+
         #Parámetros de STFT:
-        self.WinType = 'hanning'
-        self.WinSize = 2048
-        self.HopSize = 512
-        self.Overlap = self.WinSize - self.HopSize
-        
-        #Variables del Dataset:
-        self.N_Songs = 50
-        self.DatasetPath = "C:\\Datasets\\DSD100\\DSD100\\"
-        self.MixturesDevPath = "Mixtures\\Dev\\"
-        self.SourcesDevPath = "Sources\\Dev\\"
-        self.mixturefiles = os.listdir(self.DatasetPath + self.MixturesDevPath)
-        self.songorder = np.random.permutation(self.mixturefiles)
-        self.sourcefilenames = ["\\bass.wav","\\drums.wav","\\other.wav","\\vocals.wav"]
-        self.N_Sources = 4
-        self.datasetlength = 574524609 #Numero total de samples en el dataset
-        
-        #Ventana Contextual:       
+        self.WinType = espectrograma.WinType
+        self.WinSize = espectrograma.WinSize
+        self.HopSize = espectrograma.HopSize
+        self.Overlap = espectrograma.Overlap
+
+        #Ventana Contextual:
         self.N_FramesPast = 10
         self.N_FramesFuture = 10
-        
-        #Manejo de la lectura de archivos:
-        self.ChunkSize = 10 #Número de canciones a cargar en RAM por vez
-        self.NChunks = self.N_Songs//self.ChunkSize #Número de cargadas necesarias para cubrir dataset               
         self.Samplesize = self.HopSize*(self.N_FramesPast + self.N_FramesFuture) #Tamaño en samples de cada bloque que toma de entrada la red
-        self.chunk = -1
-        self.index = 0
-        self.BatchSize = batch_size        
+
+        #Variables del Dataset (se leen los encabezados de todos los .wav y se mapean en memoria):
+        self.DatasetPath = datasetpath
+        self.N_Sources = 4
+        self.indice = IndiceVentanas(ListarCanciones(datasetpath,subset),self.Samplesize)
+        self.N_Songs = self.indice.N_Songs
+        self.datasetlength = self.indice.muestras #Numero total de samples en el dataset
+        self.fs = self.indice.fs
+
+        #Chunks de datos aumentados:
+        self.AugmentedSize = muestrasaumentadas if muestrasaumentadas is not None else 50*100*self.Samplesize #Muestras de cada chunk aumentado
+        self.BloquesPorChunk = max(self.AugmentedSize//(100*self.Samplesize),1) #Bloques de aumentación (de 100 ventanas) por chunk
+        self.ChunksEnMemoria = 3 #Chunks aumentados que se mantienen en memoria, contando el que se precarga
+        self.BatchSize = batch_size
         self.epoch_i = 0
-        self.mixtures = []
-        self.sources = []
-        self.batchsperchunk = 0 #Lleva registro de a cuanto tiene que llegar el indice para tener que leer otro bloque de canciones.
-        self.fs = 44100
-        self.idxaug = 0
+        self.salto = 0 #Lotes de la época actual ya entrenados (al reanudar, ver Posicionar)
+        self.trabajador = trabajador #Partición de los lotes de cada época que entrega este proceso
+        self.trabajadores = trabajadores
+        self.seed = seed if seed is not None else np.random.randint(2**31) #Semilla de la que se derivan todos los lotes
+        self.spill = spill #Carpeta para mapear en disco los datos aumentados (None: en RAM)
+        self.aumentarporlote = aumentarporlote
+        self.aumentarespectros = aumentarespectros
+        self.aumentadores = aumentadores if aumentadores is not None else max((os.cpu_count() or 2)//2,1) #Procesos de aumentación
+
+        #Espectrogramas precalculados (sin FFT durante el entrenamiento):
+        if isinstance(almacen,str):
+            almacen = AlmacenEspectrogramas(almacen,self.N_FramesPast + self.N_FramesFuture + 1)
+        self.almacen = almacen
+        self.lotesprecargados = lotesprecargados
+
+        #Contadores de espera por datos:
+        self.esperalotes = 0.0 #Segundos que el entrenamiento esperó por lotes
+        self.lotesdemorados = 0 #Lotes pedidos que no estaban listos
+        self.lotesentregados = 0
+        self.esperachunks = 0.0 #Segundos esperando un chunk que no terminó de precargarse
+        self.chunksdemorados = 0
+
+        self.iniciar_estado()
+
+    def iniciar_estado(self):
+
+        #Estado propio de cada proceso (hilos, candados y caches). No se copia al
+        #enviar el generador a otro proceso: se vuelve a crear allí.
+        self.pid = os.getpid()
+        self.candado = threading.Lock()
+        self.planes = OrderedDict() #época -> plan
+        self.cargador = ThreadPoolExecutor(max_workers = 1) #Genera los chunks aumentados
+        self.detener = threading.Event() #Cancela el chunk que se está generando (ver close)
+        self.chunks = OrderedDict() #(época, chunk) -> futuro del chunk aumentado
+        self.condicion = threading.Condition()
+        self.listos = {} #(época, idx) -> lote armado por el productor
+        self.tomados = {} #época -> idx de los lotes que arma el hilo que los pide (el productor los saltea)
+        self.proximo = None #Próximo lote que armará el productor
+        self.enproduccion = None
+        self.productor = None
+        self.ultimo = None #Último lote pedido
+        self.pedidos = 0 #Pedidos en curso
+        self.desordenado = False #Hubo pedidos en paralelo o fuera de orden: no se precargan lotes
+        self.buffers = threading.local() #Buffer de ventanas de cada hilo
+        self.pool = None #Procesos de aumentación, se crean con el primer chunk
+
+    def __getstate__(self):
+
+        estado = self.__dict__.copy()
+        for clave in ['candado','planes','cargador','detener','chunks','condicion','listos','tomados','proximo','enproduccion',
+                      'productor','ultimo','pedidos','desordenado','buffers','pool']:
+            del estado[clave]
+
+        return estado
+
+    def __setstate__(self,estado):
+
+        self.__dict__.update(estado)
+        self.iniciar_estado()
 
     def on_epoch_end(self):
-	
-        #Al terminar la época de entrenamiento, Keras llama a este método y se reordenan las canciones y lee el primer chunk.
-		
-        self.songorder = np.random.permutation(self.mixturefiles)
+
+        #Al terminar la época de entrenamiento, Keras llama a este método. El
+        #productor se detiene (los lotes que ya armó se conservan) y vuelve a
+        #crearse con el primer pedido de la época siguiente.
+        self.detener_productor()
+        self.new_epoch()
+
+    def close(self):
+
+        """Detiene el hilo productor, la precarga de chunks y el pool de
+        aumentación. El generador puede seguir usándose: se vuelven a crear al
+        pedir lotes."""
+
+        self.detener_productor()
+        #El chunk en generación deja de esperar al pool; recién entonces se termina el pool:
+        for futuro in self.chunks.values():
+            futuro.cancel()
+        self.detener.set()
+        self.cargador.shutdown(wait = True)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.iniciar_estado()
+
+    def detener_productor(self):
+
+        #Indica al productor que termine y espera a que entregue el lote que está armando.
+        with self.condicion:
+            productor, self.productor = self.productor, None
+            self.condicion.notify_all()
+        if productor is not None:
+            productor.join()
+
+    def new_epoch(self):
+
         self.epoch_i = self.epoch_i + 1
-        self.chunk = 0
-        self.batchsperchunk = 0
-        self.index = 0
-        self.read_chunk()
-              
-    def read_chunk(self):
-	
-        #Carga un bloque de canciones en la RAM.
-		
-        self.mixtures = []
-        self.sources = []
-        self.augmentedsources = []
-        chunklength = 0
-        for songfilename in self.songorder[self.chunk*self.ChunkSize:(self.chunk+1)*self.ChunkSize]:
-            [fs,mixturei] = wavfile.read(self.DatasetPath + self.MixturesDevPath + songfilename + "\\mixture.wav")
-            chunklength = chunklength + np.size(mixturei,0)
-            self.mixtures.append(mixturei)
-            songsources = []
-            for instrument in self.sourcefilenames:
-                [fs,sourcei] = wavfile.read(self.DatasetPath + self.SourcesDevPath + songfilename + instrument)
-                songsources.append(sourcei)
-            sourcesi = np.array(songsources)
-            self.sources.append(sourcesi)
-        
-        self.batchsperchunk = self.batchsperchunk + 2*chunklength//(self.Samplesize*self.BatchSize)  
+        self.salto = 0
+        self.ultimo = None #La época nueva puede empezar aunque no se hayan pedido todos los lotes
+
+    def Posicionar(self,epoca,paso = 0):
+
+        """Ubica el generador en el lote paso de la época epoca, para reanudar
+        un entrenamiento interrumpido. Hasta el final de esa época el generador
+        tiene paso lotes menos, que son los mismos que se hubieran entregado sin
+        la interrupción. paso cuenta los lotes de este trabajador."""
+
+        self.epoch_i = epoca
+        self.salto = paso
+        self.ultimo = None
+
+    def Estado(self):
+
+        """Lo necesario para volver a generar exactamente los mismos lotes (se
+        guarda en los checkpoints, ver MisCallbacks.GuardarModelo)."""
+
+        return {'seed':int(self.seed),'epoca':self.epoch_i,'lotesporepoca':self.LotesPorEpoca(),'trabajadores':self.trabajadores}
+
+    def PlanEpoca(self,epoca):
+
+        """Plan de la época: cantidad de ejemplos sin aumentar de cada lote y
+        número (dentro de la época) de la primera ventana aumentada de cada lote.
+        Depende solo de la semilla y de la época."""
+
+        with self.candado:
+            if epoca not in self.planes:
+                rng = np.random.RandomState([self.seed,0,epoca])
+                nlimpias = np.sum(rng.randint(0,2,size = (self.LotesPorEpoca(),self.BatchSize)) == 0,axis = 1)
+                aumentadas = np.cumsum(self.BatchSize - nlimpias)
+                self.planes[epoca] = (nlimpias,np.concatenate([[0],aumentadas[:-1]]),int(aumentadas[-1]))
+                if len(self.planes) > 2:
+                    self.planes.popitem(last = False)
+
+            return self.planes[epoca]
+
+    def read_chunk(self,epoca,chunk):
+
+        #Devuelve el chunk aumentado número chunk de la época (esperando la
+        #precarga si todavía no terminó) y pide el siguiente en segundo plano.
+
+        clave = (epoca,chunk)
+        ventanasporchunk = 100*self.BloquesPorChunk
+        [nlimpias,primeras,totalaumentadas] = self.PlanEpoca(epoca)
+        siguiente = (epoca,chunk + 1) if (chunk + 1)*ventanasporchunk < totalaumentadas else (epoca + 1,0)
+        with self.candado:
+            for pedido in [clave,siguiente]:
+                if pedido not in self.chunks:
+                    #La semilla de cada chunk depende solo de su número y de la época:
+                    semilla = np.random.RandomState([self.seed,2,pedido[0],pedido[1]]).randint(2**31)
+                    self.chunks[pedido] = self.cargador.submit(self.load_chunk,semilla)
+                self.chunks.move_to_end(pedido)
+            while len(self.chunks) > self.ChunksEnMemoria:
+                self.chunks.popitem(last = False)
+            futuro = self.chunks[clave]
+
+        inicio = time.perf_counter()
+        demorado = not futuro.done()
+        datos = futuro.result()
+        with self.candado:
+            self.esperachunks = self.esperachunks + time.perf_counter() - inicio
+            self.chunksdemorados = self.chunksdemorados + demorado
+
+        return datos
+
+    def load_chunk(self,seed=None):
+
+        #Genera un chunk de datos aumentados con segmentos de todo el dataset.
+        #Corre en el hilo de precarga, por lo que no modifica el estado del generador.
+
         print('Augmenting data')
-        augmentdata.generateaugmentedset(4,self.sources,self.ChunkSize,chunklength,100*self.Samplesize)
-        
-        [fs,augmentedmix] = wavfile.read("augmented.wav")
-        self.augmentedmix = augmentedmix
-        instruments = ['bass.wav','drums.wav','other.wav','vocals.wav']
-        augmentedsources = []
-        for instrument in instruments:
-            [fs,sourcei] = wavfile.read(instrument)
-            augmentedsources.append(sourcei)
-        
-        self.augmentedsources = np.array(augmentedsources)
-        print(self.batchsperchunk)
-        self.fs = fs    
-        
+
+        bloque = 100*self.Samplesize
+        nbloques = self.BloquesPorChunk
+        if self.aumentadores > 1 and multiprocessing.current_process().daemon:
+            #Los workers de Keras con use_multiprocessing son procesos daemon, que no pueden
+            #crear procesos: en ellos la aumentación corre en el propio proceso.
+            print('Generador en un proceso daemon: se aumenta sin pool de procesos (aumentadores = 1)')
+            self.aumentadores = 1
+        if self.aumentadores > 1 and self.pool is None:
+            #Un solo pool para todos los chunks. Solo lo termina close(), después de que el
+            #cargador dejó de esperarlo (un finalizador podría terminarlo con un chunk a medias):
+            self.pool = augmentdata.CrearAumentadores(self.aumentadores)
+        [augmentedmix,augmentedsources] = augmentdata.generateaugmentedset(self.N_Sources,self.indice.Fuentes(),self.N_Songs,(nbloques+1)*bloque,
+                                                                           bloque,spill = self.spill,
+                                                                           workers = self.aumentadores,seed = seed,pool = self.pool,
+                                                                           detener = self.detener)
+        #generateaugmentedset deja sin llenar el último bloque:
+        return augmentedmix[:nbloques*bloque], augmentedsources[:,:nbloques*bloque]
+
     def representaudio(self,audio):
-	
-        #Calcula los espectrogramas
-        laudio = audio[:,0]/(2**15-1)
-        raudio = audio[:,1]/(2**15-1)       
+
+        #Calcula los espectrogramas de todas las pistas y canales de audio (...,muestras,canales) en una sola llamada.
         #boundary permite agregar ceros al principio y final para evitar perder esos datos con el ventaneo.
-        [f,t,stftl] = signal.stft(laudio,self.fs,window = self.WinType,nperseg = self.WinSize, noverlap = self.Overlap,boundary = 'zeros')
-        [f,t,stftr] = signal.stft(raudio,self.fs,window = self.WinType,nperseg = self.WinSize, noverlap = self.Overlap,boundary = 'zeros')       
-        magstft = [np.log2(1+np.abs(stftl)),np.log2(1+np.abs(stftr))]
+        #Los datos aumentados ya vienen normalizados; solo se normaliza el audio de 16 bits.
+        if audio.dtype.kind in 'iu':
+            audio = audio.astype('float32')/np.float32(2**15-1)
+        audio = np.swapaxes(audio,-1,-2).astype('float32',copy = False)
+        magstft = espectrograma.LogMagnitudSTFT(audio)
+
+        return magstft
 
-        return magstft   
-    
     def __getitem__(self,idx):
-	
+
         #Keras llama este método para obtener cada lote.
-        batchx = []
-        batchy = []
-        self.index = self.index + 1
-        if self.index > self.batchsperchunk and self.chunk < self.NChunks-1:
-            self.chunk = self.chunk + 1
-            self.read_chunk()
-            self.idxaug = 0
-        for i in range(self.BatchSize):
-            da = np.random.randint(0,2)
-            if da == 0:
-                songindex = np.random.randint(0,self.ChunkSize)
-                lengthsong = np.size(self.mixtures[songindex],0)
-                sampleindex = np.random.randint(lengthsong-self.Samplesize)
-                audioin = self.mixtures[songindex][sampleindex:sampleindex+self.Samplesize]
-                magstft = self.representaudio(audioin)
-                batchx.append(magstft)
-                y = []
-                for i in range(self.N_Sources):
-                    instrumenti = self.sources[songindex][i,sampleindex:sampleindex+self.Samplesize,:]
-                    magstfti = self.representaudio(instrumenti)
-                    y.append(magstfti)
-                y = np.array(y)
-                batchy.append(y)
-            else:
-                if (self.idxaug+1)*self.Samplesize<np.size(self.augmentedmix,0):
-                    audioin = self.augmentedmix[self.idxaug*self.Samplesize:(self.idxaug+1)*self.Samplesize]
-                    magstft = self.representaudio(audioin)
-                    batchx.append(magstft)
-                    y = []
-                    for i in range(self.N_Sources):
-                        instrumenti = self.augmentedsources[i,self.idxaug*self.Samplesize:(self.idxaug+1)*self.Samplesize,:]
-                        magstfti = self.representaudio(instrumenti)
-                        y.append(magstfti)                    
-                    batchy.append(y)
-                    self.idxaug = self.idxaug + 1
-                else:
-                    self.idxaug = 0
-                       
-        batchx = np.array(batchx)
-        batchy = np.array(batchy)
-        batchx = np.transpose(batchx,(0,2,3,1))
-        batchy = np.transpose(batchy,(0,3,4,2,1))
-        
+        if self.pid != os.getpid():
+            #Copia del generador en un proceso creado con fork:
+            self.iniciar_estado()
+        clave = (self.epoch_i,(idx + self.salto)*self.trabajadores + self.trabajador)
+        inicio = time.perf_counter()
+        [lote,listo] = [None,False]
+        #Los workers de Keras con use_multiprocessing (procesos daemon) reciben lotes salteados:
+        precarga = self.lotesprecargados > 0 and not multiprocessing.current_process().daemon
+        if precarga:
+            [lote,listo] = self.tomar_precargado(clave)
+        if lote is None:
+            lote = self.generate_batch(*clave)
+        if precarga:
+            with self.condicion:
+                self.pedidos = self.pedidos - 1
+        with self.candado:
+            self.esperalotes = self.esperalotes + time.perf_counter() - inicio
+            self.lotesdemorados = self.lotesdemorados + (not listo)
+            self.lotesentregados = self.lotesentregados + 1
+        if isinstance(lote,Exception):
+            raise lote
+
+        return lote
+
+    def tomar_precargado(self,clave):
+
+        #Devuelve (lote, listo): el lote armado por el productor (esperándolo si lo
+        #está armando) o None si lo tiene que armar el hilo que lo pide, y si ya
+        #estaba armado al pedirlo. El productor arma en orden los lotes siguientes
+        #al último pedido, por lo que solo sirve si los pedidos llegan de a uno y en
+        #orden (workers = 1, shuffle = False). Con pedidos en paralelo o fuera de
+        #orden la cola de Keras ya precarga los lotes y el productor solo competiría
+        #con los hilos que los piden: se detiene y cada hilo arma sus lotes. Los
+        #lotes listos solo se descartan al pasar a una época posterior.
+        with self.condicion:
+            self.pedidos = self.pedidos + 1
+            enorden = self.pedidos == 1 and (self.ultimo is None or clave == self._Siguiente(self.ultimo))
+            self.ultimo = clave
+            if not enorden:
+                self.desordenado = True
+                self.productor = None
+            elif self.productor is None and not self.desordenado:
+                self.proximo = clave
+                self.productor = threading.Thread(target = self.produce_batches,daemon = True)
+                self.productor.start()
+            if any(pedido[0] < clave[0] for pedido in self.listos) or any(epoca < clave[0] for epoca in self.tomados):
+                self.listos = {pedido:lote for pedido,lote in self.listos.items() if pedido[0] >= clave[0]}
+                self.tomados = {epoca:idx for epoca,idx in self.tomados.items() if epoca >= clave[0]}
+            listo = clave in self.listos
+            while clave == self.enproduccion:
+                self.condicion.wait()
+            lote = self.listos.pop(clave,None)
+            if lote is None:
+                self.tomados.setdefault(clave[0],set()).add(clave[1])
+            if self.productor is not None and self.proximo <= clave:
+                #El productor sigue desde el lote siguiente al pedido (nunca retrocede):
+                self.proximo = self._Siguiente(clave)
+            self.condicion.notify_all()
+
+        return lote, listo
+
+    def produce_batches(self):
+
+        #Hilo productor: arma en orden los lotes de la partición a partir de
+        #proximo, salteando los que arman los hilos que los piden, y los deja en
+        #listos (espera mientras haya lotesprecargados sin pedir). Termina cuando
+        #deja de ser el productor del generador (ver detener_productor).
+        productor = threading.current_thread()
+        while True:
+            with self.condicion:
+                while len(self.listos) >= self.lotesprecargados and self.productor is productor:
+                    self.condicion.wait()
+                if self.productor is not productor:
+                    return
+                clave = self.proximo
+                self.proximo = self._Siguiente(clave)
+                if clave[1] in self.tomados.get(clave[0],()):
+                    continue
+                self.enproduccion = clave
+            try:
+                lote = self.generate_batch(*clave)
+            except Exception as error:
+                lote = error
+            with self.condicion:
+                self.enproduccion = None
+                self.listos[clave] = lote
+                self.condicion.notify_all()
+
+    def _Siguiente(self,clave):
+
+        #Lote que sigue a clave en el orden de la partición de este trabajador.
+        siguiente = clave[1] + self.trabajadores
+
+        return (clave[0],siguiente) if siguiente in self.Particion() else (clave[0] + 1,self.trabajador)
+
+    def generate_batch(self,epoca,idx):
+
+        #Arma el lote idx de la época de forma vectorizada: se sortean juntas las
+        #posiciones de todas las ventanas, se copian a un buffer reservado una
+        #sola vez (por hilo) y se calculan todas las STFT (lote x 5 pistas x 2
+        #canales) en una sola llamada. Las ventanas sin aumentar van primero en
+        #el lote y las aumentadas en el dominio de la STFT al final.
+        [nlimpias,primeras,totalaumentadas] = self.PlanEpoca(epoca)
+        nlimpias = int(nlimpias[idx])
+        rng = np.random.RandomState([self.seed,1,epoca,idx])
+        ventanas = getattr(self.buffers,'ventanas',None)
+        if ventanas is None:
+            ventanas = np.empty((self.N_Sources + 1,self.BatchSize,self.Samplesize,2),dtype = 'float32')
+            self.buffers.ventanas = ventanas
+        ntiempo = self.BatchSize #Las ventanas [:ntiempo] se transforman en el dominio del tiempo
+        if self.aumentarporlote:
+            ntrans = rng.randint(0,len(augmentdata.Transformaciones),size = self.BatchSize - nlimpias)
+            if self.aumentarespectros:
+                #Al ordenar, las transformaciones lineales quedan al final:
+                ntrans = np.sort(ntrans)
+                ntiempo = nlimpias + int(np.sum(ntrans < augmentdata.PrimeraLineal))
+
+        if self.almacen is None:
+            self.clean_windows(ventanas[:,:nlimpias],rng)
+        if self.aumentarporlote:
+            self.augment_windows(ventanas[:,nlimpias:ntiempo],rng,ntrans[:ntiempo-nlimpias])
+        else:
+            self.augmented_windows(ventanas[:,nlimpias:],epoca,primeras[idx])
+
+        #Las ventanas sin aumentar del almacén ya tienen los espectrogramas precalculados:
+        primera = nlimpias if self.almacen is not None else 0
+        nframes = self.N_FramesPast + self.N_FramesFuture + 1
+        magstft = np.empty((self.N_Sources + 1,self.BatchSize,2,espectrograma.NFreqs,nframes),dtype = 'float32')
+        for i in range(primera):
+            magstft[:,i] = self.almacen.VentanaAleatoria(rng)
+        magstft[:,primera:ntiempo] = self.representaudio(ventanas[:,primera:ntiempo])
+        if ntiempo < self.BatchSize:
+            [mezclas,fuentes] = self.augmented_spectra(ventanas[1:,ntiempo:],rng,ntrans[ntiempo-nlimpias:])
+            magstft[0,ntiempo:] = espectrograma.LogMagnitud(mezclas)
+            magstft[1:,ntiempo:] = espectrograma.LogMagnitud(np.swapaxes(fuentes,0,1))
+
+        batchx = np.transpose(magstft[0],(0,2,3,1))
+        batchy = np.transpose(magstft[1:],(1,3,4,2,0))
+
         return batchx, batchy
-    
+
+    def clean_windows(self,ventanas,rng):
+
+        #Ventanas de audio sin aumentar, uniformes en todo el dataset, escritas
+        #en ventanas (5,n,muestras,2) y normalizadas.
+        if np.size(ventanas,1) > 0:
+            self.indice.VentanasAleatorias(ventanas,rng)
+
+    def augment_windows(self,ventanas,rng,ntrans):
+
+        #Ventanas nuevas (aleatoriamente con fuentes de distintas canciones) aumentadas en el momento.
+        if np.size(ventanas,1) == 0:
+            return
+        self.indice.FuentesAleatorias(ventanas[1:],rng)
+        #Todas las ventanas a aumentar del lote se transforman juntas:
+        [mezclas,fuentes] = augmentdata.augmentbatch(np.swapaxes(ventanas[1:],0,1),rng,ntrans)
+        ventanas[0] = mezclas
+        ventanas[1:] = np.swapaxes(fuentes,0,1)
+
+    def augmented_spectra(self,fuentes,rng,ntrans):
+
+        #Transformaciones lineales sobre las STFT complejas de las fuentes (fuentes es
+        #el buffer (4,n,muestras,2) de las ventanas). Devuelve las STFT (n,2,NFreqs,nframes)
+        #de las mezclas y (n,4,2,NFreqs,nframes) de las fuentes.
+        n = np.size(fuentes,1)
+        if self.almacen is not None and self.almacen.complejo:
+            #Sin FFT: las fuentes salen del almacén y se intercambian entre canciones en augmentspectra.
+            espectros = np.array([self.almacen.VentanaComplejaAleatoria(rng)[1:] for i in range(n)])
+            return augmentdata.augmentspectra(espectros,rng,ntrans)
+        #FuentesAleatorias ya intercambia fuentes entre canciones; la STFT de la mezcla no hace falta:
+        self.indice.FuentesAleatorias(fuentes,rng)
+        espectros = espectrograma.STFT(np.swapaxes(np.swapaxes(fuentes,0,1),-1,-2))
+
+        return augmentdata.augmentspectra(espectros,rng,ntrans,intercambiar = False)
+
+    def augmented_windows(self,ventanas,epoca,primera):
+
+        #Ventanas aumentadas número primera, primera+1, ... de la época (ya
+        #normalizadas). Cada chunk aumentado contiene ventanasporchunk de ellas.
+        n = np.size(ventanas,1)
+        ventanasporchunk = 100*self.BloquesPorChunk
+        numeros = primera + np.arange(n)
+        for chunk in np.unique(numeros//ventanasporchunk):
+            [augmentedmix,augmentedsources] = self.read_chunk(epoca,int(chunk))
+            seleccion = numeros//ventanasporchunk == chunk
+            indices = numeros[seleccion] % ventanasporchunk
+            ventanas[0,seleccion] = augmentedmix.reshape((ventanasporchunk,self.Samplesize,2))[indices]
+            ventanas[1:,seleccion] = augmentedsources.reshape((self.N_Sources,ventanasporchunk,self.Samplesize,2))[:,indices]
+
     def __len__(self):
-		
+
 		#Keras llama a este método para conocer el número de lotes por época.
+        return len(self.Particion()) - self.salto
+
+    def LotesPorEpoca(self):
+
         return int(2*self.datasetlength//(self.Samplesize*self.BatchSize))
+
+    def Particion(self):
+
+        #Lotes de la época (del plan completo) que entrega este trabajador; todos
+        #los trabajadores entregan la misma cantidad, por lo que se descartan los
+        #últimos LotesPorEpoca() % trabajadores lotes.
+        return range(self.trabajador,self.LotesPorEpoca() - self.LotesPorEpoca() % self.trabajadores,self.trabajadores)
+
+    def Estadisticas(self):
+
+        """Devuelve los contadores de espera por datos: segundos que el
+        entrenamiento esperó por lotes y por chunks que no terminaron de
+        precargarse, y cuántos lotes y chunks no estaban listos al pedirlos."""
+
+        return {'lotes':self.lotesentregados,
+                'espera_lotes_s':self.esperalotes,
+                'lotes_demorados':self.lotesdemorados,
+                'espera_chunks_s':self.esperachunks,
+                'chunks_demorados':self.chunksdemorados,
+                'lotes_en_cola':len(self.listos)}
@@ -2,20 +2,38 @@
 # MisCallbacks.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
 #
 # This script defines the custom loss function. Also callbacks for model reading/
-# writing are supplied.
+# writing are supplied. Checkpoints keep the weights and the optimizer state in
+# a single .hdf5 file, written on a background thread with an atomic rename.
 # =============================================================================
 
+import functools
+import json
 import keras
 import keras.backend as k
 import pickle
+import numpy as np
+import os
+import signal
+import tempfile
 import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
 
-def ConfigurarTF():
+def ConfigurarTF(distribuido = False):
 
-    """Configura Tensorflow para un uso eficiente de la memoria de la GPU."""
+    """Configura Tensorflow para un uso eficiente de la memoria de la GPU.
+    distribuido: inicializa Horovod (el proceso debe lanzarse con horovodrun o
+    mpirun) y reparte los núcleos de la máquina entre los procesos que corren
+    en ella."""
 	
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
+    if distribuido:
+        import horovod.keras as hvd
+        hvd.init()
+        hilos = max((os.cpu_count() or 1)//hvd.local_size(),1)
+        config.intra_op_parallelism_threads = hilos
+        config.inter_op_parallelism_threads = 2
+        config.gpu_options.visible_device_list = str(hvd.local_rank())
     k.tensorflow_backend.set_session(tf.Session(config = config))
     
 def LeerModelo(modelo,weightfile,optimizerfile = None):
@@ -24,10 +42,12 @@ def LeerModelo(modelo,weightfile,optimizerfile = None):
     entrenamiento o realizar predicciones.
     Argumentos:
     modelo: es el modelo compilado de Keras al cual se le cargaran los parámetros.
-    weightfile: es el archivo .hdf5 que contiene los pesos sinápticos.
-    optimizerfile: es el archivo .pkl que contiene los momentos del optimizador.
-    Es necesario si se quiere continuar el entrenamiento, pero no lo es para 
-    realizar predicciones.
+    weightfile: es el archivo .hdf5 que contiene los pesos sinápticos. Si es un
+    checkpoint de GuardarModelo también contiene el estado del optimizador, que
+    se carga automáticamente.
+    optimizerfile: es el archivo .pkl que contiene los momentos del optimizador
+    (formato anterior a los checkpoints). Es necesario si se quiere continuar
+    el entrenamiento, pero no lo es para realizar predicciones.
     """
 
     modelo.load_weights(weightfile)
@@ -38,125 +58,548 @@ def LeerModelo(modelo,weightfile,optimizerfile = None):
         with open(optimizerfile,'rb') as f:
             weight_values = pickle.load(f)
         modelo.optimizer.set_weights(weight_values)
+    else:
+        weight_values = LeerOptimizador(weightfile)
+        if weight_values is not None:
+            modelo.optimizer.set_weights(weight_values)
     
     return modelo
 
+VersionCheckpoint = 1
+
+def _Nombres(pesos):
+
+    #Mismos nombres que usa Keras al guardar los pesos en .hdf5:
+    return [str(w.name) if getattr(w,'name',None) else 'param_' + str(i) for i,w in enumerate(pesos)]
+
+def _GuardarGrupo(grupo,nombres,valores):
+
+    grupo.attrs['weight_names'] = [nombre.encode('utf8') for nombre in nombres]
+    for nombre,valor in zip(nombres,valores):
+        grupo.create_dataset(nombre,data = valor)
+
+def GuardarCheckpoint(archivo,capas,optimizador,metadatos):
+
+    """Escribe un checkpoint (pesos de la red y estado del optimizador) en un
+    único .hdf5, primero en un archivo temporal que luego se renombra.
+    Argumentos:
+    capas: lista de (nombre de la capa, nombres de los pesos, valores).
+    optimizador: (nombres, valores) de los pesos del optimizador.
+    metadatos: diccionario que se guarda como atributos del archivo.
+    Los pesos se guardan con el formato de Keras, por lo que el archivo puede
+    leerse con model.load_weights."""
+
+    import h5py
+    directorio = os.path.dirname(os.path.abspath(archivo))
+    descriptor, temporal = tempfile.mkstemp(suffix = '.tmp',dir = directorio)
+    os.close(descriptor)
+    try:
+        with h5py.File(temporal,'w') as f:
+            f.attrs['layer_names'] = [nombre.encode('utf8') for nombre,nombres,valores in capas]
+            f.attrs['backend'] = k.backend().encode('utf8')
+            f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+            f.attrs['checkpoint_version'] = VersionCheckpoint
+            f.attrs['checkpoint'] = json.dumps(metadatos).encode('utf8')
+            for nombre,nombres,valores in capas:
+                _GuardarGrupo(f.create_group(nombre),nombres,valores)
+            _GuardarGrupo(f.create_group('optimizer_weights'),*optimizador)
+        os.replace(temporal,archivo)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+def LeerOptimizador(archivo):
+
+    """Devuelve los pesos del optimizador guardados en un checkpoint de
+    GuardarModelo, o None si el archivo solo tiene los pesos de la red."""
+
+    import h5py
+    with h5py.File(archivo,'r') as f:
+        if 'optimizer_weights' not in f:
+            return None
+        grupo = f['optimizer_weights']
+        return [grupo[nombre][()] for nombre in grupo.attrs['weight_names']]
+
+def LeerMetadatos(archivo):
+
+    """Devuelve el diccionario de metadatos de un checkpoint (época, paso,
+    métricas) o None si el archivo no es un checkpoint de GuardarModelo."""
+
+    import h5py
+    with h5py.File(archivo,'r') as f:
+        if 'checkpoint' not in f.attrs:
+            return None
+        metadatos = f.attrs['checkpoint']
+    
+    return json.loads(metadatos.decode('utf8') if isinstance(metadatos,bytes) else metadatos)
+
+def _EstadoAleatorio(estado):
+
+    #Estado de np.random (get_state) en un formato que puede guardarse como JSON:
+    return [estado[0],estado[1].tolist()] + [float(valor) for valor in estado[2:]]
+
+def RestaurarAleatorio(estado):
+
+    """Restaura el generador aleatorio de NumPy guardado en un checkpoint."""
+
+    np.random.set_state((estado[0],np.array(estado[1],dtype = 'uint32'),int(estado[2]),int(estado[3]),estado[4]))
+
+def UltimoCheckpoint(filepath):
+
+    """Devuelve los metadatos (ver LeerMetadatos) del checkpoint más reciente
+    registrado en checkpoints.json de la carpeta de filepath, o None si no
+    hay ninguno."""
+
+    indice = os.path.join(os.path.dirname(filepath),'checkpoints.json')
+    if not os.path.exists(indice):
+        return None
+    with open(indice,'r') as f:
+        checkpoints = json.load(f)
+    for checkpoint in reversed(checkpoints):
+        if os.path.exists(checkpoint['archivo']):
+            return LeerMetadatos(checkpoint['archivo'])
+
+    return None
 
 class GuardarModelo(keras.callbacks.Callback):
 
-    """Clase que permite guardar al finalizar cada época de entrenamiento los 
-    pesos sinápticos de la red en un archivo .hdf5 y el estado del optimizador 
-    en un .pkl."""
+    """Clase que permite guardar los pesos sinápticos de la red y el estado del
+    optimizador en un mismo checkpoint .hdf5 al finalizar cada época y,
+    opcionalmente, cada cadapasos lotes dentro de la época.
+    En el hilo de entrenamiento solo se copian los valores de los tensores; el
+    archivo se escribe en un hilo aparte (ver GuardarCheckpoint). Los
+    checkpoints guardados se registran en checkpoints.json, en la carpeta de
+    filepath, que se usa para aplicar la política de conservación.
+    Argumentos:
+    filepath: nombre de los checkpoints, por ejemplo 'weights-{epoch:02d}.hdf5'.
+    Los de mitad de época agregan '-paso' y el número de lote.
+    cadapasos: lotes entre checkpoints dentro de la época (None: solo al final).
+    conservar: cantidad de checkpoints más recientes que se conservan (None:
+    todos).
+    monitor, modo, mejores: además se conservan los mejores checkpoints de fin
+    de época según la métrica monitor ('min' o 'max').
+    generador: DataGenerator de entrenamiento. Su estado (semilla) y el del
+    generador aleatorio de NumPy se guardan en cada checkpoint para reanudar
+    exactamente (ver trainmodel). Al recibir SIGTERM (por ejemplo al
+    interrumpirse una instancia preemptible) se guarda un checkpoint del último
+    lote entrenado y se detiene el entrenamiento.
+    distribuido: con Horovod, el callback se usa en todos los procesos. La
+    señal de todos se combina (un allreduce bloqueante) cada cadainterrupcion
+    lotes, en los checkpoints de mitad de época y en el último lote de cada
+    época, por lo que todos se detienen en el mismo lote si cualquiera la
+    recibió; solo el proceso 0 escribe los checkpoints. Entre la señal y la
+    detención pueden pasar hasta cadainterrupcion lotes, que deben entrar en
+    el plazo de gracia de la instancia (ver medirescalado.py)."""
 	
-    def __init__(self,filepath):
+    def __init__(self,filepath,cadapasos = None,conservar = None,monitor = 'val_loss',modo = 'min',mejores = 1,generador = None,
+                 distribuido = False,cadainterrupcion = 20):
         
         self.filepath = filepath
+        self.distribuido = distribuido
+        self.cadainterrupcion = cadainterrupcion
+        self.escribe = True #Solo un proceso escribe los checkpoints
+        if distribuido:
+            import horovod.keras as hvd
+            self.escribe = hvd.rank() == 0
+        self.interrupciones = None
+        self.generador = generador
+        self.cadapasos = cadapasos
+        self.conservar = conservar
+        self.monitor = monitor
+        self.modo = modo
+        self.mejores = mejores
+        self.epoca = 0
+        self.salto = 0 #Lotes ya entrenados de la primera época al reanudar
+        self.detenido = False
+        self.senal = None
+        self.anterior = None
+        self.indice = os.path.join(os.path.dirname(filepath),'checkpoints.json')
+        self.checkpoints = self.LeerIndice()
+        self.escritor = ThreadPoolExecutor(max_workers = 1)
+        self.pendiente = None
+
+    def LeerIndice(self):
+
+        """Lista de checkpoints guardados (del más viejo al más nuevo), cada uno
+        con archivo, epoca, paso y valor de la métrica monitor."""
+
+        if not os.path.exists(self.indice):
+            return []
+        with open(self.indice,'r') as f:
+            return json.load(f)
+
+    def on_train_begin(self, logs = None):
+
+        self.detenido = False
+        self.senal = None
+        try:
+            self.anterior = signal.signal(signal.SIGTERM,self._Interrumpir)
+        except ValueError:
+            #Solo el hilo principal puede atender señales.
+            self.anterior = None
+        if self.distribuido and self.interrupciones is None:
+            #Promedio entre procesos de la señal recibida (se arma una sola vez en el grafo):
+            import horovod.tensorflow as hvdtf
+            self.senales = tf.placeholder(tf.float32,shape = ())
+            self.interrupciones = hvdtf.allreduce(self.senales)
+
+    def Interrumpido(self):
+
+        """True si este proceso (o, en modo distribuido, cualquiera) recibió SIGTERM."""
+
+        interrumpido = float(self.senal is not None)
+        if self.distribuido:
+            interrumpido = k.get_session().run(self.interrupciones,feed_dict = {self.senales:interrumpido})
+
+        return interrumpido > 0
+
+    def _Interrumpir(self,numero,marco):
+
+        #Solo se registra: el checkpoint se guarda al terminar el lote en curso.
+        self.senal = numero
+
+    def on_epoch_begin(self, epoch, logs = None):
+
+        self.epoca = epoch
+
+    def on_batch_end(self, batch, logs = None):
+
+        paso = self.salto + batch + 1
+        ultimo = batch + 1 >= (self.params.get('steps') or np.inf)
+        checkpoint = bool(self.cadapasos) and paso % self.cadapasos == 0 and not ultimo
+        #En modo distribuido la señal se consulta solo en lotes que coinciden en todos los procesos:
+        consultar = not self.distribuido or paso % self.cadainterrupcion == 0 or checkpoint or ultimo
+        if consultar and self.Interrumpido():
+            if self.escribe:
+                [base,extension] = os.path.splitext(self.filepath.format(epoch = self.epoca + 1,**(logs or {})))
+                self.Guardar(base + '-paso' + str(paso).zfill(6) + extension,self.epoca,paso,None)
+                self.Esperar()
+                print('Entrenamiento interrumpido: se guardó el lote ' + str(paso) + ' de la época ' + str(self.epoca + 1))
+            self.detenido = True
+            self.model.stop_training = True
+        elif not self.escribe:
+            return
+        elif checkpoint:
+            [base,extension] = os.path.splitext(self.filepath.format(epoch = self.epoca + 1,**(logs or {})))
+            self.Guardar(base + '-paso' + str(paso).zfill(6) + extension,self.epoca,paso,None)
         
     def on_epoch_end(self, epoch, logs = None):
         
+        self.salto = 0
+        if self.detenido:
+            #La época no terminó: ya se guardó el checkpoint del último lote.
+            return
+        if not self.escribe:
+            return
+        logs = logs or {}
         filepath = self.filepath.format(epoch=epoch + 1, **logs)
-        #Guardo los pesos sinápticos:
-        self.model.save_weights(filepath,overwrite = True)
-        #Guardo parámetros del optimizador (necesarios si quiero reanudar entrenamiento)
-        symbolic_weights = getattr(self.model.optimizer,'weights')
-        weight_values = k.batch_get_value(symbolic_weights)
-        with open('optimizador.pkl','wb') as f:
-            pickle.dump(weight_values,f)
+        valor = logs.get(self.monitor)
+        self.Guardar(filepath,epoch + 1,0,None if valor is None else float(valor))
 
+    def on_train_end(self, logs = None):
 
-def CustomLossFunction(yTrue,yPred):
+        self.Esperar()
+        if self.anterior is not None:
+            signal.signal(signal.SIGTERM,self.anterior)
 
-    """Función de costo propuesta. Toma como argumentos el espectrograma 
-    verdadero y el predicho, y devuelve el error."""  
-	
-    BassTrue = yTrue[:,:,:,:,0]
-    BassPred = yPred[:,:,:,:,0]              
-    DrumsTrue = yTrue[:,:,:,:,1]
-    DrumsPred = yPred[:,:,:,:,1]
-    OthersTrue = yTrue[:,:,:,:,2]
-    OthersPred = yPred[:,:,:,:,2]
-    VocalsTrue = yTrue[:,:,:,:,3]
-    VocalsPred = yPred[:,:,:,:,3]
-   
-    basemse = k.mean(k.square(BassPred-BassTrue))+k.mean(k.square(DrumsPred-DrumsTrue))+k.mean(k.square(VocalsPred-VocalsTrue))+0.5*k.mean(k.square(OthersPred-OthersTrue))
-    diffmse = k.mean(k.square(BassPred-DrumsPred)+k.square(BassPred-OthersPred)+k.square(BassPred-VocalsPred)+
-                     k.square(DrumsPred-VocalsPred)+k.square(DrumsPred-OthersPred)+k.square(VocalsPred-OthersPred),axis=-1)
-    othvocmse = k.mean(k.square(VocalsPred-OthersTrue),axis=-1)
-    othersmse = k.mean(k.square(VocalsPred-OthersTrue) + k.square(DrumsPred-OthersTrue) + k.square(BassPred-OthersTrue) ,axis=-1)
-    recons = k.mean(k.square(BassTrue + DrumsTrue + OthersTrue + VocalsTrue - BassPred - DrumsPred - OthersPred - VocalsPred),axis=-1)
+    def Guardar(self,filepath,epoca,paso,valor):
+
+        """Copia los pesos de la red y del optimizador y encarga su escritura.
+        epoca (épocas completas) y paso (lotes de la época siguiente) indican
+        desde dónde se reanuda."""
+
+        #Una sola lectura de todos los tensores:
+        capas = [(capa.name,capa.weights) for capa in self.model.layers]
+        optimizador = getattr(self.model.optimizer,'weights')
+        valores = k.batch_get_value([w for nombre,pesos in capas for w in pesos] + optimizador)
+        copias = []
+        for nombre,pesos in capas:
+            copias.append((nombre,_Nombres(pesos),valores[:len(pesos)]))
+            valores = valores[len(pesos):]
+        metadatos = {'archivo':filepath,'epoca':epoca,'paso':paso,'valor':valor}
+        estado = dict(metadatos,numpy = _EstadoAleatorio(np.random.get_state()))
+        if self.generador is not None:
+            estado['generador'] = self.generador.Estado()
+        #Como mucho una escritura pendiente; si falló, el error aparece aquí:
+        self.Esperar()
+        self.pendiente = self.escritor.submit(self._Escribir,copias,(_Nombres(optimizador),valores),metadatos,estado)
+
+    def Esperar(self):
+
+        """Espera a que termine la escritura pendiente."""
+
+        if self.pendiente is not None:
+            pendiente, self.pendiente = self.pendiente, None
+            pendiente.result()
+
+    def _Escribir(self,capas,optimizador,metadatos,estado):
+
+        GuardarCheckpoint(metadatos['archivo'],capas,optimizador,estado)
+        self.checkpoints = [c for c in self.checkpoints if c['archivo'] != metadatos['archivo']] + [metadatos]
+        self.Podar()
+
+    def Podar(self):
+
+        """Elimina los checkpoints que no están entre los conservar más recientes
+        ni entre los mejores según monitor, y actualiza el índice."""
+
+        if self.conservar is not None:
+            conservados = set(c['archivo'] for c in self.checkpoints[-max(self.conservar,1):])
+            medidos = [c for c in self.checkpoints if c['valor'] is not None]
+            medidos = sorted(medidos,key = lambda c: c['valor'],reverse = self.modo == 'max')
+            conservados.update(c['archivo'] for c in medidos[:self.mejores])
+            for checkpoint in self.checkpoints:
+                if checkpoint['archivo'] not in conservados and os.path.exists(checkpoint['archivo']):
+                    os.remove(checkpoint['archivo'])
+            self.checkpoints = [c for c in self.checkpoints if c['archivo'] in conservados]
+        descriptor, temporal = tempfile.mkstemp(suffix = '.tmp',dir = os.path.dirname(os.path.abspath(self.indice)))
+        try:
+            with os.fdopen(descriptor,'w') as f:
+                json.dump(self.checkpoints,f,indent = 1)
+            os.replace(temporal,self.indice)
+        finally:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+
+class AdamEscalado(keras.optimizers.Adam):
+
+    """Adam con escalado dinámico del costo, para entrenar en float16 en GPU
+    (ver ModeloDoble.CompileModel). El costo se multiplica por escala antes de
+    derivar, para que los gradientes chicos no se anulen en float16, y los
+    gradientes se dividen por escala antes del recorte (clipnorm, clipvalue) y
+    de actualizar los pesos, que se mantienen en float32.
+    Si algún gradiente no es finito (desborde en float16) el paso se saltea
+    (no cambian los pesos, los momentos ni iterations) y la escala se divide
+    por 2; después de intervalo pasos seguidos sin desbordes se duplica.
+    La escala y los pasos sin desbordes forman parte de weights, por lo que se
+    guardan en los checkpoints junto con los momentos."""
+
+    def __init__(self,escala = 2.0**15,intervalo = 2000,**kwargs):
+
+        super(AdamEscalado,self).__init__(**kwargs)
+        self.escalainicial = escala
+        self.intervalo = intervalo
+        with k.name_scope(self.__class__.__name__):
+            self.escala = k.variable(escala,dtype = 'float32',name = 'escala')
+            self.validos = k.variable(0,dtype = 'int64',name = 'validos') #Pasos seguidos sin desbordes
+
+    def get_gradients(self,loss,params):
+
+        grads = k.gradients(loss*self.escala,params)
+        if None in grads:
+            raise ValueError('Hay pesos sin gradiente respecto del costo.')
+        grads = [k.cast(g,'float32')/self.escala for g in grads]
+        finitos = tf.reduce_all([tf.reduce_all(tf.is_finite(g)) for g in grads])
+        if getattr(self,'clipnorm',0) > 0:
+            norm = k.sqrt(sum([k.sum(k.square(g)) for g in grads]))
+            grads = [keras.optimizers.clip_norm(g,self.clipnorm,norm) for g in grads]
+        if getattr(self,'clipvalue',0) > 0:
+            grads = [k.clip(g,-self.clipvalue,self.clipvalue) for g in grads]
+        #El recorte convertiría un desborde en un gradiente válido: se marca con NaN, que
+        #también llega a todos los procesos al promediar gradientes (horovod).
+        marca = tf.where(finitos,0.0,np.float32(np.nan))
+
+        return [g + marca for g in grads]
+
+    def get_updates(self,loss,params):
+
+        #Las actualizaciones son las de keras.optimizers.Adam; cada asignación se
+        #reemplaza por una que solo cambia la variable si el paso no desbordó. Un
+        #gradiente no finito (marcado con NaN en get_gradients) vuelve no finitos
+        #los valores nuevos de todos los momentos y pesos.
+        asignaciones = [(t.op.type,t.op.inputs[0],t.op.inputs[1]) for t in super(AdamEscalado,self).get_updates(loss,params)]
+        if any(tipo not in ('Assign','AssignAdd') for tipo,variable,valor in asignaciones):
+            raise ValueError('AdamEscalado solo admite actualizaciones k.update y k.update_add de Adam')
+        finitos = tf.reduce_all([tf.reduce_all(tf.is_finite(valor)) for tipo,variable,valor in asignaciones
+                                 if tipo == 'Assign' and valor.dtype.is_floating])
+        self.updates = []
+        for tipo,variable,valor in asignaciones:
+            if tipo == 'Assign':
+                self.updates.append(tf.assign(variable,tf.where(finitos,valor,variable)))
+            else:
+                self.updates.append(tf.assign_add(variable,tf.where(finitos,valor,tf.zeros_like(valor))))
+
+        #Escala dinámica:
+        validos = tf.where(finitos,self.validos + 1,tf.zeros_like(self.validos))
+        crecer = validos >= self.intervalo
+        escala = tf.where(finitos,tf.where(crecer,self.escala*2.,self.escala),self.escala/2.)
+        self.updates.append(k.update(self.escala,escala))
+        self.updates.append(k.update(self.validos,tf.where(crecer,tf.zeros_like(validos),validos)))
+        self.weights = self.weights + [self.escala,self.validos]
+
+        return self.updates
+
+    def set_weights(self,weights):
+
+        #Los checkpoints anteriores no guardan escala ni validos: se mantienen los actuales.
+        if len(weights) == len(self.weights) - 2:
+            weights = list(weights) + k.batch_get_value([self.escala,self.validos])
+        super(AdamEscalado,self).set_weights(weights)
+
+    def get_config(self):
+
+        config = super(AdamEscalado,self).get_config()
+        config['escala'] = self.escalainicial
+        config['intervalo'] = self.intervalo
+
+        return config
+
+class EstadisticasDatos(keras.callbacks.Callback):
+
+    """Agrega a los logs de cada época (y por lo tanto a Tensorboard) los
+    contadores de espera por datos del generador de entrenamiento (ver
+    DataGenerator.Estadisticas). Si el entrenamiento nunca espera, espera_lotes_s
+    se mantiene cerca de cero."""
+
+    def __init__(self,generador):
+
+        self.generador = generador
+        self.anteriores = {}
+
+    def on_epoch_end(self, epoch, logs = None):
+
+        estadisticas = self.generador.Estadisticas()
+        for clave in ['espera_lotes_s','lotes_demorados','espera_chunks_s','chunks_demorados']:
+            #Se informa lo acumulado durante la época:
+            logs[clave] = estadisticas[clave] - self.anteriores.get(clave,0)
+        self.anteriores = estadisticas
+        print('Espera por datos: ' + str(np.round(logs['espera_lotes_s'],2)) + ' s en ' + str(logs['lotes_demorados']) + ' lotes')
+
+
+#Índices de las fuentes en el último eje de la salida de la red:
+_Bass = 0
+_Drums = 1
+_Others = 2
+_Vocals = 3
+
+def TerminosCosto(yTrue,yPred):
+
+    """Calcula una sola vez todos los términos de la función de costo, que son
+    también las métricas de entrenamiento. Las diferencias al cuadrado se
+    calculan una vez para las 4 fuentes juntas. Devuelve un diccionario con el
+    nombre de cada métrica y su tensor."""
+
+    cuadrados = k.square(yPred - yTrue)
+    #Error de cada fuente (promedio sobre lote, frecuencias, frames y canales):
+    errores = k.mean(cuadrados,axis = [0,1,2,3])
+    #Suma de las diferencias al cuadrado entre todos los pares de predicciones:
+    #sum_{i<j}(pi-pj)^2 = 4*sum_i pi^2 - (sum_i pi)^2
+    interferencia = 4*k.sum(k.square(yPred),axis = -1) - k.square(k.sum(yPred,axis = -1))
+    #Diferencias de cada predicción con la fuente others verdadera:
+    respectoothers = k.square(yPred - yTrue[:,:,:,:,_Others:_Others+1])
+    othvoc = respectoothers[:,:,:,:,_Vocals]
+    others = k.sum(respectoothers,axis = -1) - respectoothers[:,:,:,:,_Others]
+    recons = k.square(k.sum(yTrue - yPred,axis = -1))
+
+    return {'BassError':errores[_Bass],
+            'DrumsError':errores[_Drums],
+            'OthersError':errores[_Others],
+            'VocalsError':errores[_Vocals],
+            'MetricInterference':k.mean(interferencia,axis = -1),
+            'MetricOthVoc':k.mean(othvoc,axis = -1),
+            'MetricOthers':k.mean(others,axis = -1),
+            'MetricRecons':k.mean(recons,axis = -1)}
+
+def _CombinarTerminos(terminos):
+
+    basemse = terminos['BassError'] + terminos['DrumsError'] + terminos['VocalsError'] + 0.5*terminos['OthersError']
     
     alpha = 0.001
     beta = 0.01
     betav = 0.03
-    err = basemse - alpha*diffmse - beta*othersmse - betav*othvocmse + 0.01*recons
+    err = basemse - alpha*terminos['MetricInterference'] - beta*terminos['MetricOthers'] - betav*terminos['MetricOthVoc'] + 0.01*terminos['MetricRecons']
     
     return err
 
-#Métricas de performance:
-    
+def CustomLossFunction(yTrue,yPred):
+
+    """Función de costo propuesta. Toma como argumentos el espectrograma 
+    verdadero y el predicho, y devuelve el error."""  
+	
+    return _CombinarTerminos(TerminosCosto(yTrue,yPred))
+
+#Métricas que se muestran durante el entrenamiento (en este orden):
+NombresMetricas = ['VocalsError','DrumsError','BassError','OthersError','MetricInterference','MetricOthVoc','MetricOthers','MetricRecons']
+
+class CostoFusionado():
+
+    """Función de costo y métricas de entrenamiento calculadas en un único
+    grafo: la función de costo calcula los términos (TerminosCosto) y cada
+    métrica (ver Metricas) reutiliza el tensor del término correspondiente en
+    lugar de volver a calcularlo. Como la función de costo necesita todos los
+    términos, las métricas no agregan cálculo al paso de entrenamiento (ver
+    medirlotes.MedirPaso)."""
+
+    __name__ = 'CustomLossFunction'
+
+    def __init__(self):
+
+        self.terminos = {}
+
+    def Terminos(self,yTrue,yPred):
+
+        #Keras llama a la función de costo y a cada métrica con los mismos tensores
+        #(se guardan junto a los términos para que sus id no se reutilicen):
+        clave = (id(yTrue),id(yPred))
+        if clave not in self.terminos:
+            self.terminos[clave] = (yTrue,yPred,TerminosCosto(yTrue,yPred))
+
+        return self.terminos[clave][2]
+
+    def __call__(self,yTrue,yPred):
+
+        return _CombinarTerminos(self.Terminos(yTrue,yPred))
+
+    def Metricas(self):
+
+        """Devuelve las funciones de métrica para model.compile, con los nombres
+        de NombresMetricas."""
+
+        metricas = []
+        for nombre in NombresMetricas:
+            metrica = functools.partial(self._Metrica,nombre)
+            metrica.__name__ = nombre
+            metricas.append(metrica)
+
+        return metricas
+
+    def _Metrica(self,nombre,yTrue,yPred):
+
+        return self.Terminos(yTrue,yPred)[nombre]
+
+#Métricas de performance (cada una por separado, fuera del entrenamiento). Cada una
+#calcula solo su término; para entrenar con todas usar CostoFusionado.Metricas:
+
+def _ErrorFuente(yTrue,yPred,fuente):
+    return k.mean(k.square(yPred[:,:,:,:,fuente] - yTrue[:,:,:,:,fuente]))
+
 def MetricBaseLoss(yTrue,yPred):
-    BassTrue = yTrue[:,:,:,:,0]
-    BassPred = yPred[:,:,:,:,0]              
-    DrumsTrue = yTrue[:,:,:,:,1]
-    DrumsPred = yPred[:,:,:,:,1]
-    VocalsTrue = yTrue[:,:,:,:,3]
-    VocalsPred = yPred[:,:,:,:,3]
-   
-    return k.mean(k.square(BassPred-BassTrue)+k.square(DrumsPred-DrumsTrue)+k.square(VocalsPred-VocalsTrue),axis=-1)
+    return _ErrorFuente(yTrue,yPred,_Bass) + _ErrorFuente(yTrue,yPred,_Drums) + _ErrorFuente(yTrue,yPred,_Vocals)
 
 def MetricInterference(yTrue,yPred):
-    BassPred = yPred[:,:,:,:,0]              
-    DrumsPred = yPred[:,:,:,:,1]
-    VocalsPred = yPred[:,:,:,:,3]
-    OthersPred = yPred[:,:,:,:,2]
-    return k.mean(k.square(BassPred-DrumsPred)+k.square(BassPred-OthersPred)+k.square(BassPred-VocalsPred)+
-                     k.square(DrumsPred-VocalsPred)+k.square(DrumsPred-OthersPred)+k.square(VocalsPred-OthersPred),axis=-1)
+    #sum_{i<j}(pi-pj)^2 = 4*sum_i pi^2 - (sum_i pi)^2, como en TerminosCosto:
+    return k.mean(4*k.sum(k.square(yPred),axis = -1) - k.square(k.sum(yPred,axis = -1)),axis = -1)
     
 def MetricOthVoc(yTrue,yPred):
-    VocalsPred = yPred[:,:,:,:,3]
-    OthersTrue = yTrue[:,:,:,:,2]
-    return k.mean(k.square(VocalsPred-OthersTrue),axis=-1)
+    return k.mean(k.square(yPred[:,:,:,:,_Vocals] - yTrue[:,:,:,:,_Others]),axis = -1)
 
 def MetricOthers(yTrue,yPred):
-    BassPred = yPred[:,:,:,:,0]              
-    DrumsPred = yPred[:,:,:,:,1]
-    VocalsPred = yPred[:,:,:,:,3]
-    OthersTrue = yTrue[:,:,:,:,2]
-    
-    return k.mean(k.square(VocalsPred-OthersTrue) + k.square(DrumsPred-OthersTrue) + k.square(BassPred-OthersTrue) ,axis=-1)
+    OthersTrue = yTrue[:,:,:,:,_Others:_Others+1]
+    otras = k.concatenate([yPred[:,:,:,:,:_Others],yPred[:,:,:,:,_Others+1:]],axis = -1)
+
+    return k.mean(k.sum(k.square(otras - OthersTrue),axis = -1),axis = -1)
     
 def MetricRecons(yTrue,yPred):
-    BassTrue = yTrue[:,:,:,:,0]
-    BassPred = yPred[:,:,:,:,0]              
-    DrumsTrue = yTrue[:,:,:,:,1]
-    DrumsPred = yPred[:,:,:,:,1]
-    OthersTrue = yTrue[:,:,:,:,2]
-    OthersPred = yPred[:,:,:,:,2]
-    VocalsTrue = yTrue[:,:,:,:,3]
-    VocalsPred = yPred[:,:,:,:,3]
-    
-    return k.mean(k.square(BassTrue + DrumsTrue + OthersTrue + VocalsTrue - BassPred - DrumsPred - OthersPred - VocalsPred),axis=-1)
+    return k.mean(k.square(k.sum(yTrue - yPred,axis = -1)),axis = -1)
     
 def BassError(yTrue,yPred):
-    BassTrue = yTrue[:,:,:,:,0]
-    BassPred = yPred[:,:,:,:,0] 
-    
-    return k.mean(k.square(BassTrue-BassPred))
+    return _ErrorFuente(yTrue,yPred,_Bass)
 
 def VocalsError(yTrue,yPred):
-    VocalsTrue = yTrue[:,:,:,:,3]
-    VocalsPred = yPred[:,:,:,:,3] 
-    
-    return k.mean(k.square(VocalsTrue-VocalsPred))
+    return _ErrorFuente(yTrue,yPred,_Vocals)
 
 def OthersError(yTrue,yPred):
-    OthersTrue = yTrue[:,:,:,:,2]
-    OthersPred = yPred[:,:,:,:,2] 
-    
-    return k.mean(k.square(OthersTrue-OthersPred))
+    return _ErrorFuente(yTrue,yPred,_Others)
 
 def DrumsError(yTrue,yPred):
-    DrumsTrue = yTrue[:,:,:,:,1]
-    DrumsPred = yPred[:,:,:,:,1]
-    
-    return k.mean(k.square(DrumsTrue-DrumsPred))
\ No newline at end of file
+    return _ErrorFuente(yTrue,yPred,_Drums)
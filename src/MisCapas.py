@@ -1,12 +1,15 @@
 # =============================================================================
 # MisCapas.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
 #
-# This script defines custom layers such as soft masks.
+# This script defines custom layers such as soft masks, and the mixed precision
+# variants of the convolutional and dense layers (float32 weights, float16 or
+# bfloat16 computation).
 # =============================================================================
 
 from keras import backend as k
 from keras.layers import  Multiply, Add
-from keras.layers.core import Lambda
+from keras.layers.convolutional import Conv2D, Conv2DTranspose
+from keras.layers.core import Lambda, Dense
 import numpy as np
 import tensorflow as tf
 
@@ -67,4 +70,59 @@ def log2emphasis(inputs):
     emphasized = Lambda(lambda x: k.log(x+1)/log2value)(inputs)
     
     return emphasized
-    
\ No newline at end of file
+
+MaxExponente = 64.0
+
+def exp2emphasis(inputs):
+
+    """Capa que deshace el énfasis logarítmico (2**x - 1). El exponente se
+    limita a MaxExponente: las salidas reales son del orden de 1, pero al
+    divergir el entrenamiento 2**x desbordaría float32 (x > 128) y la máscara
+    suave daría inf/inf = NaN."""
+
+    return k.pow(2.0,k.minimum(inputs,MaxExponente)) - 1
+
+def _CapaMixta(clase):
+
+    #Subclase de clase cuyos pesos se crean en float32 (los que actualiza el
+    #optimizador) y se convierten a computo solo para calcular la salida.
+    class CapaMixta(clase):
+
+        def __init__(self,*args,**kwargs):
+
+            self.computo = kwargs.pop('computo','float16')
+            super(CapaMixta,self).__init__(*args,**kwargs)
+
+        def call(self,inputs):
+
+            pesos = {nombre:getattr(self,nombre) for nombre in ['kernel','bias'] if getattr(self,nombre,None) is not None}
+            for nombre,peso in pesos.items():
+                setattr(self,nombre,k.cast(peso,self.computo))
+            try:
+                return super(CapaMixta,self).call(k.cast(inputs,self.computo))
+            finally:
+                for nombre,peso in pesos.items():
+                    setattr(self,nombre,peso)
+
+        def get_config(self):
+
+            config = super(CapaMixta,self).get_config()
+            config['computo'] = self.computo
+
+            return config
+
+    CapaMixta.__name__ = clase.__name__ + 'Mixta'
+
+    return CapaMixta
+
+#Capas con pesos float32 y cómputo en float16/bfloat16 (argumento computo):
+Conv2DMixta = _CapaMixta(Conv2D)
+Conv2DTransposeMixta = _CapaMixta(Conv2DTranspose)
+DenseMixta = _CapaMixta(Dense)
+
+def afloat32(inputs):
+
+    """Capa que convierte la entrada a float32 (para las partes sensibles
+    numéricamente del modelo en precisión mixta)."""
+
+    return k.cast(inputs,'float32')
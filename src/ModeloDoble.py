@@ -2,20 +2,43 @@
 # ModeloDoble.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
 #
 # This script compiles the keras model of the convolutional neural network
-# developed. 
+# developed. An inference-only model, without optimizer, loss and metrics, can
+# be built with InferenceModel. The model can also be trained in mixed
+# precision (float16 or bfloat16 computation with float32 weights) on a GPU.
 # =============================================================================
 
-from MisCallbacks import CustomLossFunction, VocalsError,DrumsError,BassError,OthersError,MetricInterference,MetricOthVoc,MetricOthers,MetricRecons
-from MisCapas import softmask, stacklayers, unstacklayers, log2emphasis
+import functools
+from MisCapas import softmask, stacklayers, unstacklayers, log2emphasis, exp2emphasis, afloat32
+from MisCapas import Conv2DMixta, Conv2DTransposeMixta, DenseMixta
 from keras.layers import Input, Add, BatchNormalization, Concatenate
 from keras.layers.convolutional import Conv2D, Conv2DTranspose
 from keras.layers.core import Reshape, Dense, Flatten, Lambda
 from keras.models import Model
-from keras.optimizers import Adam
 
-def CompileModel():
-    
-    """Función que compila el modelo de red neuronal implementado en Keras."""
+def BuildModel(batchnorm = True,precision = 'float32'):
+    
+    """Función que construye el grafo del modelo de red neuronal implementado
+    en Keras, sin compilarlo. Con batchnorm = False se omiten las capas de
+    BatchNormalization y las capas que las siguen llevan bias, para cargar en
+    ellas los pesos con las normalizaciones plegadas (ver modelocongelado.py).
+    Con precision 'float16' o 'bfloat16' las capas convolucionales y densas
+    calculan en esa precisión con pesos float32 (los mismos nombres y formas,
+    por lo que los pesos son intercambiables con el modelo float32). Las
+    BatchNormalization, las exponenciales de salida, la máscara suave y el
+    logaritmo final se mantienen en float32."""
+    
+    mixta = precision != 'float32'
+    if mixta:
+        Conv2D_, Conv2DTranspose_, Dense_ = [functools.partial(clase,computo = precision) for clase in [Conv2DMixta,Conv2DTransposeMixta,DenseMixta]]
+    else:
+        Conv2D_, Conv2DTranspose_, Dense_ = Conv2D, Conv2DTranspose, Dense
+    
+    def normalizar(x,nombre):
+        if not batchnorm:
+            return x
+        if mixta:
+            x = Lambda(afloat32)(x)
+        return BatchNormalization(name = nombre)(x)
     
     #Hiperparámetros de la subred percusiva:    
     NVFiltPerc = 64
@@ -23,15 +46,15 @@ def CompileModel():
     NReshapePerc = 1024
 
     #Encoder percusivo:
-    stft_input = Input(shape = (1025,21,2,), dtype = 'float32')
-    pvconv = Conv2D(NVFiltPerc,(1025,1),activation = "relu",use_bias = False)
-    phconv = Conv2D(NHFiltPerc,(1,6),activation = "relu",use_bias = False)
+    stft_input = Input(shape = (1025,21,2,), dtype = 'float32', name = 'entrada')
+    pvconv = Conv2D_(NVFiltPerc,(1025,1),activation = "relu",use_bias = not batchnorm,name = 'pvconv')
+    phconv = Conv2D_(NHFiltPerc,(1,6),activation = "relu",use_bias = not batchnorm,name = 'phconv')
     pflatter = Flatten()      
-    pencoder = BatchNormalization()(stft_input)
+    pencoder = normalizar(stft_input,'pbn0')
     pencoder = pvconv(pencoder)
-    pencoder = BatchNormalization()(pencoder)
+    pencoder = normalizar(pencoder,'pbn1')
     pencoder = phconv(pencoder)
-    pencoder = BatchNormalization()(pencoder)
+    pencoder = normalizar(pencoder,'pbn2')
     pencoder = pflatter(pencoder)
     
     #Hiperparámetros de la subred armónica:
@@ -41,41 +64,41 @@ def CompileModel():
     
     #Encoder armónico:
     
-    hhconv = Conv2D(NHFiltHarm,(1,21),activation = "relu",use_bias = False)
-    hvconv = Conv2D(NVFiltHarm,(82,1),activation = "relu",use_bias = False,strides = (41,1))    
+    hhconv = Conv2D_(NHFiltHarm,(1,21),activation = "relu",use_bias = not batchnorm,name = 'hhconv')
+    hvconv = Conv2D_(NVFiltHarm,(82,1),activation = "relu",use_bias = not batchnorm,strides = (41,1),name = 'hvconv')    
     hflatter = Flatten()       
-    hencoder = BatchNormalization()(stft_input)
+    hencoder = normalizar(stft_input,'hbn0')
     hencoder = hhconv(hencoder)
-    hencoder = BatchNormalization()(hencoder)
+    hencoder = normalizar(hencoder,'hbn1')
     hencoder = hvconv(hencoder)
-    hencoder = BatchNormalization()(hencoder)
+    hencoder = normalizar(hencoder,'hbn2')
     hencoder = hflatter(hencoder)
     
     #Espacio Latente:
     latentspace = Concatenate()([hencoder,pencoder])
-    latentspace = Dense(1024,activation = "relu",use_bias = False)(latentspace)
+    latentspace = Dense_(1024,activation = "relu",use_bias = not batchnorm,name = 'latente')(latentspace)
 
     #Capas de convolución transpuesta con pesos atados entre si (decoder percusivo):
-    psharedHDeconv2D = Conv2DTranspose(NVFiltPerc,(1,6),activation = "relu")
-    psharedVDeconv2D = Conv2DTranspose(2,(1025,1),activation = "relu")
+    psharedHDeconv2D = Conv2DTranspose_(NVFiltPerc,(1,6),activation = "relu",name = 'phdeconv')
+    psharedVDeconv2D = Conv2DTranspose_(2,(1025,1),activation = "relu",name = 'pvdeconv')
     
     #Decodificadores paralelos percusivos para cada instrumento:
-    pbassbranch = Dense(NReshapePerc,activation = "relu")(latentspace)
+    pbassbranch = Dense_(NReshapePerc,activation = "relu",name = 'pbassbranch')(latentspace)
     pbassbranch = Reshape((1,16,NHFiltPerc))(pbassbranch)
     pbassbranch = psharedHDeconv2D(pbassbranch)
     pbassbranch = psharedVDeconv2D(pbassbranch)
     
-    pdrumsbranch = Dense(NReshapePerc,activation = "relu")(latentspace)
+    pdrumsbranch = Dense_(NReshapePerc,activation = "relu",name = 'pdrumsbranch')(latentspace)
     pdrumsbranch = Reshape((1,16,NHFiltPerc))(pdrumsbranch)
     pdrumsbranch = psharedHDeconv2D(pdrumsbranch)
     pdrumsbranch = psharedVDeconv2D(pdrumsbranch)
     
-    pothersbranch = Dense(NReshapePerc,activation = "relu")(latentspace)
+    pothersbranch = Dense_(NReshapePerc,activation = "relu",name = 'pothersbranch')(latentspace)
     pothersbranch = Reshape((1,16,NHFiltPerc))(pothersbranch)
     pothersbranch = psharedHDeconv2D(pothersbranch)
     pothersbranch = psharedVDeconv2D(pothersbranch)
     
-    pvocbranch = Dense(NReshapePerc,activation = "relu")(latentspace)    
+    pvocbranch = Dense_(NReshapePerc,activation = "relu",name = 'pvocbranch')(latentspace)    
     pvocbranch = Reshape((1,16,NHFiltPerc))(pvocbranch)
     pvocbranch = psharedHDeconv2D(pvocbranch)
     pvocbranch = psharedVDeconv2D(pvocbranch)
@@ -90,26 +113,26 @@ def CompileModel():
     poutput = Lambda(stacklayers)([pbass,pdrums,pothers,pvocals])
 
     #Capas de convolución transpuesta con pesos atados entre si (decoder armónico):
-    hsharedVDeconv2D = Conv2DTranspose(32,(82,1),activation = "relu",strides = (41,1))
-    hsharedHDeconv2D = Conv2DTranspose(2,(1,21),activation = "relu")
+    hsharedVDeconv2D = Conv2DTranspose_(32,(82,1),activation = "relu",strides = (41,1),name = 'hvdeconv')
+    hsharedHDeconv2D = Conv2DTranspose_(2,(1,21),activation = "relu",name = 'hhdeconv')
     
     #Decodificadores paralelos armónicos para cada instrumento:
-    hbassbranch = Dense(NReshapeHarm,activation = "relu")(latentspace)
+    hbassbranch = Dense_(NReshapeHarm,activation = "relu",name = 'hbassbranch')(latentspace)
     hbassbranch = Reshape((24,1,NVFiltHarm))(hbassbranch)
     hbassbranch = hsharedVDeconv2D(hbassbranch)
     hbassbranch = hsharedHDeconv2D(hbassbranch)
      
-    hdrumsbranch = Dense(NReshapeHarm,activation = "relu")(latentspace)
+    hdrumsbranch = Dense_(NReshapeHarm,activation = "relu",name = 'hdrumsbranch')(latentspace)
     hdrumsbranch = Reshape((24,1,NVFiltHarm))(hdrumsbranch)
     hdrumsbranch = hsharedVDeconv2D(hdrumsbranch)
     hdrumsbranch = hsharedHDeconv2D(hdrumsbranch)
         
-    hothersbranch = Dense(NReshapeHarm,activation = "relu")(latentspace)
+    hothersbranch = Dense_(NReshapeHarm,activation = "relu",name = 'hothersbranch')(latentspace)
     hothersbranch = Reshape((24,1,NVFiltHarm))(hothersbranch)
     hothersbranch = hsharedVDeconv2D(hothersbranch)
     hothersbranch = hsharedHDeconv2D(hothersbranch)
         
-    hvocbranch = Dense(NReshapeHarm,activation = "relu")(latentspace)    
+    hvocbranch = Dense_(NReshapeHarm,activation = "relu",name = 'hvocbranch')(latentspace)    
     hvocbranch = Reshape((24,1,NVFiltHarm))(hvocbranch)
     hvocbranch = hsharedVDeconv2D(hvocbranch)
     hvocbranch = hsharedHDeconv2D(hvocbranch)
@@ -121,9 +144,12 @@ def CompileModel():
     
     houtput = Lambda(stacklayers)([hbass,hdrums,hothers,hvocals])
     
-    #Fusión de las salidas de los decodificadores armónico y percusivo:
-    houtput = Lambda(lambda x: 2**x-1)(houtput)
-    poutput = Lambda(lambda x: 2**x-1)(poutput)
+    #Fusión de las salidas de los decodificadores armónico y percusivo (en float32):
+    if mixta:
+        houtput = Lambda(afloat32)(houtput)
+        poutput = Lambda(afloat32)(poutput)
+    houtput = Lambda(exp2emphasis)(houtput)
+    poutput = Lambda(exp2emphasis)(poutput)
     totaloutput = Add()([houtput,poutput])
     
     sourceoutputs = Lambda(unstacklayers)(totaloutput)
@@ -135,9 +161,57 @@ def CompileModel():
     
     #Definición del modelo de Keras:
     modelodoble = Model(inputs = stft_input,outputs = finaloutput)
+    
+    return modelodoble
+
+def InferenceModel(weightfile = None):
+    
+    """Construye el modelo solo para predicción y carga los pesos de weightfile.
+    No crea el optimizador ni los grafos de la función de costo y las métricas."""
+    
+    modelodoble = BuildModel()
+    if weightfile is not None:
+        modelodoble.load_weights(weightfile)
+    
+    return modelodoble
+
+def CompileModel(precision = 'float32',escalacosto = None,distribuido = False):
+    
+    """Función que compila el modelo de red neuronal implementado en Keras.
+    La función de costo y las métricas se calculan en un único grafo (ver
+    MisCallbacks.CostoFusionado).
+    precision: 'float32', o 'float16'/'bfloat16' para entrenar en precisión
+    mixta (ver BuildModel). La precisión mixta es opcional y solo se admite
+    con una GPU: en la CPU no hay kernels de media precisión y cada paso es
+    decenas de veces más lento (ver medirprecision.py). escalacosto: factor inicial por el que se
+    multiplica el costo antes de derivar, que luego se ajusta cuando hay
+    desbordes (ver MisCallbacks.AdamEscalado). Por defecto 2**15 con float16
+    y sin escalar con bfloat16, que tiene el mismo rango que float32.
+    distribuido: los gradientes se promedian entre todos los procesos de
+    Horovod en cada paso (entrenamiento con paralelismo de datos, ver
+    trainmodel). Requiere haber llamado a MisCallbacks.ConfigurarTF con
+    distribuido = True."""
+    
+    #Los módulos de entrenamiento solo se importan al compilar:
+    from MisCallbacks import CostoFusionado, AdamEscalado
+    from keras.optimizers import Adam
+    import tensorflow as tf
+    
+    if precision != 'float32' and not tf.test.is_gpu_available():
+        raise ValueError('La precisión ' + precision + ' solo se admite para entrenar en GPU')
+    modelodoble = BuildModel(precision = precision)
     #Especificación del optimizador:
-    opt = Adam(lr = 0.01,clipvalue = 0.9)
+    if escalacosto is None:
+        escalacosto = 2.0**15 if precision == 'float16' else 1.0
+    if escalacosto != 1:
+        opt = AdamEscalado(escalacosto,lr = 0.01,clipvalue = 0.9)
+    else:
+        opt = Adam(lr = 0.01,clipvalue = 0.9)
+    if distribuido:
+        import horovod.keras as hvd
+        opt = hvd.DistributedOptimizer(opt)
+    costo = CostoFusionado()
     #Se compila el modelo utilizando como función de pérdida la propuesta. También se especifican errores a mostrar durante el entrenamiento con el fin de monitorear el progreso.
-    modelodoble.compile(loss = CustomLossFunction,optimizer = opt,metrics = [VocalsError,DrumsError,BassError,OthersError,MetricInterference,MetricOthVoc,MetricOthers,MetricRecons])
+    modelodoble.compile(loss = costo,optimizer = opt,metrics = costo.Metricas())
     
     return modelodoble
@@ -1,135 +1,195 @@
-"""
-BatchGenerator.py - Leonardo Pepino - 2018
-"""
-
+# =============================================================================
+# ValidationGenerator.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script defines the Keras generator of the validation batches, which are
+# fixed across epochs and can be cached on disk.
+# =============================================================================
 
+import hashlib
+import json
 import numpy as np
 import os
-import scipy.io.wavfile as wavfile
-from scipy import signal
+import tempfile
+import threading
 import keras
+import espectrograma
+from almacenespectrogramas import AlmacenEspectrogramas
+from indicedataset import IndiceVentanas, ListarCanciones
 
 class ValidationDataGenerator(keras.utils.Sequence):
-    
-    def __init__(self,batch_size=32):
-        
+
+    """Generador de los lotes de validación. Las ventanas se eligen una sola vez
+    a partir de seed y, si se especifica cache (carpeta), sus espectrogramas de
+    entrada y salida se calculan la primera vez y se guardan en disco (.npy en
+    dtype, leídos mapeados en memoria), por lo que en cada época solo se
+    ejecuta la red. Por defecto se guardan en float32, igual que los lotes de
+    entrenamiento; con dtype = 'float16' ocupan la mitad, pero la pérdida de
+    validación se calcula sobre datos cuantizados y no es comparable con la de
+    un conjunto en float32. El nombre de los archivos incluye una huella de la semilla,
+    el tamaño del conjunto, la STFT y las canciones, por lo que un cambio de
+    cualquiera de ellos genera un conjunto nuevo.
+    Con trabajadores > 1 (entrenamiento distribuido) cada proceso evalúa solo
+    los lotes trabajador, trabajador + trabajadores, ... del conjunto."""
+
+    def __init__(self,batch_size=32,almacen=None,seed=0,lotes=400,cache='validacion',dtype='float32',
+                 datasetpath="C:\\Datasets\\DSD100\\DSD100",subset="Test",trabajador=0,trabajadores=1):
+
         #Representation parameters:
-        self.WinType = 'hanning'
-        self.WinSize = 2048
-        self.HopSize = 512
-        self.Overlap = self.WinSize - self.HopSize
-        
-        #Dataset variables:
-        self.N_Songs = 50
-        self.DatasetPath = "C:\\Datasets\\DSD100\\DSD100\\"
-        self.MixturesDevPath = "Mixtures\\Test\\"
-        self.SourcesDevPath = "Sources\\Test\\"
-        self.mixturefiles = os.listdir(self.DatasetPath + self.MixturesDevPath)
-        #self.songorder = np.random.permutation(self.mixturefiles)
-        self.songorder = self.mixturefiles
-        self.sourcefilenames = ["\\bass.wav","\\drums.wav","\\other.wav","\\vocals.wav"]
-        self.N_Sources = 4
-        self.datasetlength = 574524609 #Numero total de samples en el dataset
-        
-        #Temporal context:       
+        self.WinType = espectrograma.WinType
+        self.WinSize = espectrograma.WinSize
+        self.HopSize = espectrograma.HopSize
+        self.Overlap = espectrograma.Overlap
+
+        #Temporal context:
         self.N_FramesPast = 10
         self.N_FramesFuture = 10
-        
-        #File management:
-        self.ChunkSize = 10 #Número de canciones a cargar en RAM por vez
-        self.NChunks = self.N_Songs//self.ChunkSize #Número de cargadas necesarias para cubrir dataset               
         self.Samplesize = self.HopSize*(self.N_FramesPast + self.N_FramesFuture) #Tamaño en samples de cada bloque que toma de entrada la red
-        self.chunk = -1
-        self.index = 0
-        
-        self.BatchSize = batch_size        
+
+        #Dataset variables:
+        self.DatasetPath = datasetpath
+        self.N_Sources = 4
+        #Con un almacén de espectrogramas precalculados no se leen los audios:
+        if isinstance(almacen,str):
+            almacen = AlmacenEspectrogramas(almacen,self.N_FramesPast + self.N_FramesFuture + 1)
+        self.almacen = almacen
+        self.indice = IndiceVentanas(ListarCanciones(datasetpath,subset),self.Samplesize) if almacen is None else None
+        self.N_Songs = self.indice.N_Songs if almacen is None else almacen.N_Songs
+        self.fs = self.indice.fs if almacen is None else almacen.fs
+
+        #Los lotes dependen solo de la semilla y de idx (son los mismos en todas las épocas):
+        self.seed = seed
+        self.lotes = lotes
+        self.BatchSize = batch_size
+        self.trabajador = trabajador
+        self.trabajadores = trabajadores
         self.epoch_i = 0
-        #self.on_epoch_end()
-        
-        self.mixtures = []
-        self.sources = []
-        self.batchsperchunk = 0 #Lleva registro de a cuanto tiene que llegar el indice para tener que leer otro bloque de canciones.
-        self.fs = 44100
-        
-        
+        self.buffers = threading.local() #Buffer de ventanas de cada hilo
+
+        #Conjunto precalculado en disco:
+        self.archivoscache = self.CargarCache(cache,dtype) if cache is not None else None
+        self.abrir_cache()
+
+    def abrir_cache(self):
+
+        self.x = self.y = None
+        if self.archivoscache is not None:
+            self.x = np.load(self.archivoscache[0],mmap_mode = 'r')
+            self.y = np.load(self.archivoscache[1],mmap_mode = 'r')
+
+    def __getstate__(self):
+
+        #Los arreglos mapeados en memoria se vuelven a abrir en lugar de copiarse:
+        estado = self.__dict__.copy()
+        for clave in ['buffers','x','y']:
+            del estado[clave]
+
+        return estado
+
+    def __setstate__(self,estado):
+
+        self.__dict__.update(estado)
+        self.buffers = threading.local()
+        self.abrir_cache()
+
+    def Huella(self):
+
+        """Identifica al conjunto de validación: semilla, cantidad de lotes,
+        parámetros de la STFT y canciones (nombres y largos) de las que se toman
+        las ventanas."""
+
+        descripcion = [self.seed,self.lotes,self.BatchSize,self.WinType,self.WinSize,self.HopSize,self.Samplesize]
+        if self.almacen is not None:
+            descripcion = descripcion + [os.path.abspath(self.almacen.directorio),self.almacen.framescancion.tolist()]
+        else:
+            descripcion = descripcion + [self.indice.nombres,self.indice.largos.tolist()]
+        huella = hashlib.sha256(json.dumps(descripcion).encode())
+
+        return huella.hexdigest()[:16]
+
+    def CargarCache(self,directorio,dtype = 'float32'):
+
+        """Devuelve los archivos (entradas, salidas) del conjunto en directorio,
+        calculándolos si todavía no existen."""
+
+        os.makedirs(directorio,exist_ok = True)
+        base = os.path.join(directorio,'validacion_' + self.Huella() + '_' + np.dtype(dtype).name)
+        archivos = (base + '_x.npy',base + '_y.npy')
+        if not all(os.path.exists(archivo) for archivo in archivos):
+            self._GuardarCache(directorio,archivos,dtype)
+
+        return archivos
+
+    def _GuardarCache(self,directorio,archivos,dtype):
+
+        #Se escribe en archivos temporales que se renombran al terminar (escritura atómica).
+        print('Calculando el conjunto de validación')
+        temporales = []
+        try:
+            for archivo in archivos:
+                descriptor, temporal = tempfile.mkstemp(suffix = '.tmp',dir = directorio)
+                os.close(descriptor)
+                temporales.append(temporal)
+            [batchx,batchy] = self.CalcularLote(0)
+            n = self.lotes*self.BatchSize
+            x = np.lib.format.open_memmap(temporales[0],mode = 'w+',dtype = dtype,shape = (n,) + batchx.shape[1:])
+            y = np.lib.format.open_memmap(temporales[1],mode = 'w+',dtype = dtype,shape = (n,) + batchy.shape[1:])
+            for idx in range(self.lotes):
+                if idx > 0:
+                    [batchx,batchy] = self.CalcularLote(idx)
+                x[idx*self.BatchSize:(idx+1)*self.BatchSize] = batchx
+                y[idx*self.BatchSize:(idx+1)*self.BatchSize] = batchy
+            x.flush()
+            y.flush()
+            del x, y
+            for temporal, archivo in zip(temporales,archivos):
+                os.replace(temporal,archivo)
+        finally:
+            for temporal in temporales:
+                if os.path.exists(temporal):
+                    os.remove(temporal)
 
     def on_epoch_end(self):
-        #Reordena las canciones y lee el primer chunk
-        #self.songorder = np.random.permutation(self.mixturefiles)
+
         self.epoch_i = self.epoch_i + 1
-        self.chunk = 0
-        self.batchsperchunk = 0
-        self.index = 0
-        self.read_chunk()
-              
-    def read_chunk(self):
-        #Carga un bloque de canciones en la RAM.
-        self.mixtures = []
-        self.sources = []
-        chunklength = 0
-        print(self.chunk)
-        for songfilename in self.songorder[self.chunk*self.ChunkSize:(self.chunk+1)*self.ChunkSize]:
-            [fs,mixturei] = wavfile.read(self.DatasetPath + self.MixturesDevPath + songfilename + "\\mixture.wav")
-           # mixturei = mixturei/(2**15-1)
-            chunklength = chunklength + np.size(mixturei,0)
-            self.mixtures.append(mixturei)
-            songsources = []
-            for instrument in self.sourcefilenames:
-                [fs,sourcei] = wavfile.read(self.DatasetPath + self.SourcesDevPath + songfilename + instrument)
-              #  sourcei = sourcei/(2**15-1)
-                songsources.append(sourcei)
-            sourcesi = np.array(songsources)
-            self.sources.append(sourcesi)
-        self.batchsperchunk = self.batchsperchunk + chunklength//(self.Samplesize*self.BatchSize)    
-        print(self.batchsperchunk)
-        self.fs = fs    
-        
+
     def representaudio(self,audio):
-        #Calcula los espectrogramas
-        
-        laudio = audio[:,0]/(2**15-1)
-        raudio = audio[:,1]/(2**15-1)
-        
+        #Calcula los espectrogramas de todas las pistas y canales de audio (...,muestras,canales) en una sola llamada.
         #boundary permite paddear principio y final para evitar perder esa data con el ventaneo.
-        [f,t,stftl] = signal.stft(laudio,self.fs,window = self.WinType,nperseg = self.WinSize, noverlap = self.Overlap,boundary = 'zeros')
-        [f,t,stftr] = signal.stft(raudio,self.fs,window = self.WinType,nperseg = self.WinSize, noverlap = self.Overlap,boundary = 'zeros')
-        
-        magstft = [np.log2(1+np.abs(stftl)),np.log2(1+np.abs(stftr))]
-        #magstft = [(np.abs(stftl)),(np.abs(stftr))]
-        
-        return magstft   
-    
+        #Las ventanas del índice ya vienen normalizadas.
+        audio = np.swapaxes(audio,-1,-2).astype('float32',copy = False)
+        magstft = espectrograma.LogMagnitudSTFT(audio)
+
+        return magstft
+
     def __getitem__(self,idx):
         #Se llama para crear cada batch
-        batchx = []
-        batchy = []
-        self.index = self.index + 1
-        if self.index > self.batchsperchunk and self.chunk < self.NChunks-1:
-            self.chunk = self.chunk + 1
-            self.read_chunk()           
-        for i in range(self.BatchSize):
-            songindex = np.random.randint(0,self.ChunkSize)
-            lengthsong = np.size(self.mixtures[songindex],0)
-            sampleindex = np.random.randint(lengthsong-self.Samplesize)
-            audioin = self.mixtures[songindex][sampleindex:sampleindex+self.Samplesize]
-            magstft = self.representaudio(audioin)
-            batchx.append(magstft)
-            y = []
-            for i in range(self.N_Sources):
-                instrumenti = self.sources[songindex][i,sampleindex:sampleindex+self.Samplesize,:]
-                magstfti = self.representaudio(instrumenti)
-                y.append(magstfti)
-            y = np.array(y)
-            batchy.append(y)
-                       
-        batchx = np.array(batchx)
-        batchy = np.array(batchy)
-        batchx = np.transpose(batchx,(0,2,3,1))
-        batchy = np.transpose(batchy,(0,3,4,2,1))
-        
+        idx = idx*self.trabajadores + self.trabajador
+        if self.x is not None:
+            lote = slice(idx*self.BatchSize,(idx+1)*self.BatchSize)
+            return self.x[lote].astype('float32'), self.y[lote].astype('float32')
+
+        return self.CalcularLote(idx)
+
+    def CalcularLote(self,idx):
+        #Ventanas del lote idx y sus espectrogramas (dependen solo de la semilla y de idx).
+        rng = np.random.RandomState([self.seed,idx])
+        if self.almacen is not None:
+            magstft = np.array([self.almacen.VentanaAleatoria(rng) for i in range(self.BatchSize)])
+            magstft = np.swapaxes(magstft,0,1)
+        else:
+            ventanas = getattr(self.buffers,'ventanas',None)
+            if ventanas is None:
+                ventanas = np.empty((self.N_Sources + 1,self.BatchSize,self.Samplesize,2),dtype = 'float32')
+                self.buffers.ventanas = ventanas
+            #Mezcla y fuentes de todo el lote se transforman juntas:
+            magstft = self.representaudio(self.indice.VentanasAleatorias(ventanas,rng))
+
+        batchx = np.transpose(magstft[0],(0,2,3,1))
+        batchy = np.transpose(magstft[1:],(1,3,4,2,0))
+
         return batchx, batchy
-    
+
     def __len__(self):
         #Número de batches por epoch
         #return int(self.datasetlength//(self.Samplesize*self.BatchSize))
-        return 400
\ No newline at end of file
+        return self.lotes//self.trabajadores
\ No newline at end of file
@@ -0,0 +1,176 @@
+# =============================================================================
+# almacenespectrogramas.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script precomputes the log-magnitude spectrograms of the mixture and
+# sources of every song of a DSD100 (or MUSDB18-HQ) subset and stores them in
+# sharded .npy files, together with an index of song offsets. During training
+# the shards are memory-mapped and the 21 frames windows that the network takes
+# are served as slices, without computing any FFT. With --complejo the complex
+# STFTs are stored instead, so that the linear augmentations can be applied to
+# them.
+#
+# Usage: python almacenespectrogramas.py C:\Datasets\DSD100\DSD100 Dev almacen_dev
+# =============================================================================
+
+import argparse
+import json
+import os
+import numpy as np
+import scipy.io.wavfile as wavfile
+import espectrograma
+from indicedataset import Pistas, ListarCanciones, Subconjuntos
+
+ArchivoIndice = 'indice.json'
+
+def ConstruirAlmacen(datasetpath,subset,outdir,dtype = 'float16',shardbytes = 2**30,complejo = False):
+
+    """Calcula los espectrogramas (log2(1+|STFT|)) de mezcla y fuentes de todas
+    las canciones de un subconjunto de DSD100 (o MUSDB18-HQ) y los guarda en outdir.
+    Argumentos:
+    datasetpath: carpeta de DSD100 (contiene Mixtures y Sources) o de MUSDB18-HQ.
+    subset: 'Dev' o 'Test' ('train' o 'test' en MUSDB18-HQ).
+    dtype: 'float16' o 'float32'.
+    shardbytes: tamaño aproximado de cada archivo .npy.
+    complejo: si es True se guarda la STFT compleja (parte real e imaginaria en
+    dtype, el doble de espacio) en lugar de log2(1+|STFT|), para poder aplicar
+    las transformaciones lineales de augmentdata.augmentspectra.
+    Cada shard tiene forma (frames,5,2,1025): frames de todas sus canciones
+    concatenados, pistas en el orden de Pistas, canales y frecuencias (con un
+    último eje (real,imaginaria) si complejo). Si las pistas de una canción
+    tienen distinto largo se recortan a la más corta, como en
+    indicedataset.IndiceVentanas."""
+
+    os.makedirs(outdir,exist_ok = True)
+    indice = {'dtype':dtype,'pistas':Pistas,'hop':espectrograma.HopSize,'complejo':complejo,'shards':[],'canciones':[]}
+    bytesporframe = len(Pistas)*2*espectrograma.NFreqs*np.dtype(dtype).itemsize*(2 if complejo else 1)
+    pendientes = []
+    framespendientes = 0
+    frecuencias = set()
+    for songfilename,archivos in ListarCanciones(datasetpath,subset):
+        #Se transforman las 5 pistas estéreo en una sola llamada:
+        leidos = [wavfile.read(archivo,mmap = True) for archivo in archivos]
+        frecuencias.update(fs for fs,pista in leidos)
+        largo = min(np.size(pista,0) for fs,pista in leidos)
+        if any(np.size(pista,0) != largo for fs,pista in leidos):
+            print('Aviso: las pistas de ' + songfilename + ' tienen distinto largo, se recortan a ' + str(largo) + ' muestras')
+        audio = np.array([np.transpose(pista[:largo]) for fs,pista in leidos])
+        audio = audio.astype('float32')/np.float32(2**15-1)
+        if complejo:
+            stft = np.transpose(espectrograma.STFT(audio),(3,0,1,2))
+            magnitudes = np.stack([stft.real,stft.imag],axis = -1).astype(dtype)
+        else:
+            magnitudes = espectrograma.LogMagnitudSTFT(audio)
+            magnitudes = np.transpose(magnitudes,(3,0,1,2)).astype(dtype)
+        indice['canciones'].append({'nombre':songfilename,'shard':len(indice['shards']),
+                                    'inicio':framespendientes,'nframes':np.size(magnitudes,0)})
+        pendientes.append(magnitudes)
+        framespendientes = framespendientes + np.size(magnitudes,0)
+        print(songfilename)
+        if framespendientes*bytesporframe >= shardbytes:
+            _GuardarShard(outdir,indice,pendientes)
+            pendientes = []
+            framespendientes = 0
+    if pendientes:
+        _GuardarShard(outdir,indice,pendientes)
+    if len(frecuencias) > 1:
+        raise ValueError('Las canciones tienen distintas frecuencias de muestreo: ' + str(sorted(frecuencias)))
+    indice['fs'] = frecuencias.pop() if frecuencias else 44100
+    with open(os.path.join(outdir,ArchivoIndice),'w') as f:
+        json.dump(indice,f,indent = 1)
+
+    return indice
+
+def _GuardarShard(outdir,indice,pendientes):
+
+    nombre = 'shard_' + str(len(indice['shards'])).zfill(3) + '.npy'
+    np.save(os.path.join(outdir,nombre),np.concatenate(pendientes))
+    indice['shards'].append(nombre)
+
+class AlmacenEspectrogramas():
+
+    """Acceso a un almacén generado con ConstruirAlmacen. Los shards se abren
+    mapeados en memoria, por lo que el uso de RAM lo maneja el page cache."""
+
+    def __init__(self,directorio,nframes = 21):
+
+        self.directorio = directorio
+        with open(os.path.join(directorio,ArchivoIndice)) as f:
+            self.indice = json.load(f)
+        self.shards = [np.load(os.path.join(directorio,nombre),mmap_mode = 'r') for nombre in self.indice['shards']]
+        self.canciones = self.indice['canciones']
+        self.complejo = self.indice.get('complejo',False)
+        #Los almacenes anteriores no guardan la frecuencia de muestreo (DSD100 es de 44100 Hz):
+        self.fs = self.indice.get('fs',44100)
+        self.N_Songs = len(self.canciones)
+        self.nframes = nframes
+        self.framescancion = np.array([cancion['nframes'] for cancion in self.canciones])
+        #Probabilidad de cada canción proporcional a la cantidad de ventanas que contiene:
+        ventanas = np.maximum(self.framescancion - nframes + 1,0)
+        self.probabilidades = ventanas/np.sum(ventanas)
+
+    def __reduce__(self):
+
+        #Al copiarlo a otro proceso se vuelven a mapear los shards en lugar de copiar su contenido.
+        return (AlmacenEspectrogramas,(self.directorio,self.nframes))
+
+    def Ventana(self,cancion,frame):
+
+        """Devuelve la ventana de nframes frames que empieza en frame, de forma
+        (5,2,1025,nframes) (como DataGenerator.representaudio) en float32."""
+
+        if self.complejo:
+            return espectrograma.LogMagnitud(self.VentanaCompleja(cancion,frame))
+        info = self.canciones[cancion]
+        inicio = info['inicio'] + frame
+        ventana = self.shards[info['shard']][inicio:inicio+self.nframes]
+
+        return np.transpose(ventana,(1,2,3,0)).astype('float32')
+
+    def VentanaCompleja(self,cancion,frame):
+
+        """Como Ventana, pero devuelve la STFT compleja (complex64). Solo en
+        almacenes construidos con complejo = True."""
+
+        if not self.complejo:
+            raise ValueError('El almacén ' + self.directorio + ' no guarda la STFT compleja')
+        info = self.canciones[cancion]
+        inicio = info['inicio'] + frame
+        ventana = self.shards[info['shard']][inicio:inicio+self.nframes].astype('float32')
+
+        return np.transpose(ventana.view('complex64')[...,0],(1,2,3,0))
+
+    def VentanaAleatoria(self,rng = np.random):
+
+        """Elige una ventana uniformemente entre todas las del almacén."""
+
+        return self.Ventana(*self._Sortear(rng))
+
+    def VentanaComplejaAleatoria(self,rng = np.random):
+
+        return self.VentanaCompleja(*self._Sortear(rng))
+
+    def _Sortear(self,rng):
+
+        cancion = rng.choice(self.N_Songs,p = self.probabilidades)
+        frame = rng.randint(0,self.framescancion[cancion] - self.nframes + 1)
+
+        return cancion, frame
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Precalcula los espectrogramas de DSD100 (o MUSDB18-HQ) para el entrenamiento.')
+    parser.add_argument('datasetpath',help = 'carpeta de DSD100 (contiene Mixtures y Sources) o de MUSDB18-HQ')
+    parser.add_argument('subset',help = "'Dev' o 'Test' en DSD100, 'train' o 'test' en MUSDB18-HQ")
+    parser.add_argument('outdir')
+    parser.add_argument('--dtype',choices = ['float16','float32'],default = 'float16')
+    parser.add_argument('--shard-gb',type = float,default = 1)
+    parser.add_argument('--complejo',action = 'store_true',help = 'guarda la STFT compleja (para augmentdata.augmentspectra)')
+    args = parser.parse_args(argv)
+    subconjuntos = Subconjuntos(args.datasetpath) if os.path.isdir(args.datasetpath) else []
+    if args.subset not in subconjuntos:
+        parser.error('subset ' + args.subset + ' no encontrado en ' + args.datasetpath + ' (disponibles: ' + ', '.join(subconjuntos) + ')')
+
+    ConstruirAlmacen(args.datasetpath,args.subset,args.outdir,args.dtype,int(args.shard_gb*2**30),args.complejo)
+
+if __name__ == '__main__':
+    main()
@@ -2,12 +2,24 @@
 # augmentdata.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
 #
 # This script defines data augmentation routines to apply during the training
-# phase.
+# phase. All the effects are implemented with NumPy/SciPy in the same process
+# and work on whole batches of blocks at once: the sources of every transform
+# are arrays of shape (..., n_sources, nsamples, 2), for example a single block
+# (4,nsamples,2) or a batch of blocks (nblocks,4,nsamples,2). The linear
+# transforms can also be applied to complex source STFTs (augmentspectra).
 # =============================================================================
 
-from pysndfx import AudioEffectsChain
-import scipy.io.wavfile as wavfile
+import multiprocessing
+import os
+import tempfile
+import time
+import weakref
 import numpy as np
+import scipy.fft
+import scipy.signal as signal
+import espectrograma
+
+Fs = 44100
 
 """Tecnicas de Data Augmentation propuestas en: Improving music source separation
  based on deep neural networks through data augmentation and network blending - 
@@ -15,179 +27,312 @@ import numpy as np
  Naoya Takahashi y Yuki Mitsufuji.
 """
 
-def changeamplitudes(instruments):
+def changeamplitudes(instruments,rng = np.random):
 
     """ Devuelve las pistas remezcladas con nuevas ganancias y la mezcla 
     resultante."""
     
     minimo = 0.25
     maximo = 1.25
-    newsources = []
-    mix = 0
-    for instrument in instruments:
-        amplitude = np.random.uniform(minimo,maximo)
-        instrument = instrument*amplitude
-        mix = mix + instrument
-        newsources.append(instrument)
-    return mix, newsources
-
-def swapchannels(instruments):
+    instruments = np.asarray(instruments)
+    amplitudes = rng.uniform(minimo,maximo,size = instruments.shape[:-2] + (1,1))
+    newsources = instruments*amplitudes
+
+    return np.sum(newsources,axis = -3), newsources
+
+def swapchannels(instruments,rng = np.random):
     
     """ Intercambia los canales del estéreo en las fuentes."""
-    newsources = []
-    mix = 0
-    for instrument in instruments:
-        swapstate = np.random.randint(2)
-        newinstrument = instrument.copy()
-        if swapstate:
-            newinstrument[:,0] = instrument[:,1]
-            newinstrument[:,1] = instrument[:,0]
-        newsources.append(newinstrument)
-        mix = mix + newinstrument
-
-    return mix, newsources
+
+    instruments = np.asarray(instruments)
+    swapstate = rng.randint(2,size = instruments.shape[:-2] + (1,1))
+    newsources = np.where(swapstate == 1,instruments[...,::-1],instruments)
+
+    return np.sum(newsources,axis = -3), newsources
 
 """Técnicas de aumento de datos aplicadas a la separación de fuentes musicales 
 propuestas en la tesis."""
 
-def makemono(instruments):
+def makemono(instruments,rng = np.random):
     
     """Transforma las mezclas y pistas estereofónicas en monofónicas."""
     
-    newsources = []
-    mix = 0
-    for instrument in instruments:
-        monoinstrument = (instrument[:,0] + instrument[:,1])/2
-        newinstrument = instrument.copy()
-        newinstrument[:,0] = monoinstrument
-        newinstrument[:,1] = monoinstrument
-        newsources.append(newinstrument)
-        mix = mix + newinstrument
+    instruments = np.asarray(instruments)
+    monoinstruments = np.mean(instruments,axis = -1,keepdims = True)
+    newsources = np.repeat(monoinstruments,2,axis = -1)
 
-    return mix, newsources
+    return np.sum(newsources,axis = -3), newsources
 
 
-def repan(instruments):
+def repan(instruments,rng = np.random):
     
     """Cambia el panorama de las fuentes en la mezcla."""
     
-    newsources = []
-    mix = 0
-    for instrument in instruments:
-        monoinstrument = (instrument[:,0] + instrument[:,1])
-        newinstrument = instrument.copy()
-        panindex = np.random.uniform(0,1)
-        newinstrument[:,0] = panindex*monoinstrument
-        newinstrument[:,1] = (1-panindex)*monoinstrument
-        newsources.append(newinstrument)
-        mix = mix + newinstrument
-
-    return mix, newsources
-
-def changepitchvocal(instruments):
-    
-    """ Realiza un cambio aleatorio de pitch de la voz entre +/- 2 tonos."""
-    
-    ncents = 100*np.random.randint(-4,4)
-    fx = AudioEffectsChain().pitch(ncents)
-    pitchvocals = fx(np.transpose(instruments[3]),sample_in=44100,
-                                  sample_out = 44100, channels_out = 2)
-    shx = np.shape(instruments[0])
-    shy = np.shape(pitchvocals)
-    pitchvocalscut = np.zeros((shx[0],2))
-    if shy[1]<shx[0]:
-        pitchvocalscut[0:shy[1],:] = np.transpose(pitchvocals[:,:])
-    else:
-        pitchvocalscut[:,:] = np.transpose(pitchvocals[:,0:shx[0]])   
-    newsources = [instruments[0],instruments[1],instruments[2],pitchvocalscut]
-    mix = instruments[0] + instruments[1] + instruments[2] + pitchvocalscut
+    instruments = np.asarray(instruments)
+    monoinstruments = np.sum(instruments,axis = -1,keepdims = True)
+    panindex = rng.uniform(0,1,size = instruments.shape[:-2] + (1,1))
+    newsources = monoinstruments*np.concatenate([panindex,1-panindex],axis = -1)
 
-    return mix,newsources
+    return np.sum(newsources,axis = -3), newsources
 
-def addreverb(instruments):
+def changepitchvocal(instruments,rng = np.random):
     
-    """Añade reverberación a las fuentes aplicando parámetros aleatorios"""
+    """ Realiza un cambio aleatorio de pitch de la voz entre +/- 2 tonos.
+    Se estira la voz en el tiempo sin cambiar su altura (vocoder de fase) y se
+    remuestrea a la duración original."""
     
-    reverberances = np.random.randint(0,100,size = (4,))
-    hfdampings = np.random.randint(0,100,size = (4,))
-    roomscales = np.random.randint(0,100,size = (4,))
-    stereodepth = np.random.randint(0,100,size = (4,))
-    predelays = np.random.randint(0,100,size = (4,))
-
-    newsources = []
-    mix = 0
-
-    for i,instrument in enumerate(instruments):
-        fx = AudioEffectsChain().reverb(reverberances[i],hfdampings[i],roomscales[i],stereodepth[i],predelays[i])
-        newinstrument = fx(np.transpose(instrument),sample_in=44100, sample_out = 44100, channels_out = 2)
-        newinstrument = np.transpose(newinstrument)
-        newsources.append(newinstrument)
-        mix = mix + newinstrument
-
-    return mix,newsources
-
-
-def distortbass(instruments):
+    instruments = np.asarray(instruments)
+    vocals = instruments[...,3,:,:]
+    ncents = 100*rng.randint(-4,4,size = vocals.shape[:-2])
+    relacion = 2.0**(ncents/1200)
+    nsamples = np.size(vocals,-2)
+    estirada, largos = _EstirarTiempo(vocals.reshape((-1,) + vocals.shape[-2:]),1/relacion.ravel())
+    #Remuestreo lineal: la muestra t de la salida es la muestra t*relacion de la voz estirada.
+    posiciones = np.arange(nsamples)[None,:]*relacion.reshape(-1,1)
+    pitchvocals = _Interpolar(estirada,posiciones,largos)
+    newsources = instruments.copy()
+    newsources[...,3,:,:] = pitchvocals.reshape(vocals.shape)
+
+    return np.sum(newsources,axis = -3), newsources
+
+def addreverb(instruments,rng = np.random):
+    
+    """Añade reverberación a las fuentes aplicando parámetros aleatorios.
+    Cada fuente se convoluciona (por FFT) con una respuesta al impulso de ruido
+    con decaimiento exponencial, cuyos parámetros siguen a los de la reverb de
+    sox: reverberancia y tamaño de sala (tiempo de reverberación), amortiguación
+    de agudos, profundidad estéreo (decorrelación entre canales) y predelay en ms."""
+    
+    instruments = np.asarray(instruments)
+    forma = instruments.shape[:-2]
+    reverberances = rng.randint(0,100,size = forma).ravel()/100
+    hfdampings = rng.randint(0,100,size = forma).ravel()/100
+    roomscales = rng.randint(0,100,size = forma).ravel()/100
+    stereodepth = rng.randint(0,100,size = forma).ravel()/100
+    predelays = rng.randint(0,100,size = forma).ravel()
+
+    #Tiempo de reverberación (caída de 60 dB) entre 0.1 y 2 segundos:
+    rt60 = 0.1 + 1.9*reverberances*(0.25 + 0.75*roomscales)
+    largoir = int(np.ceil((np.max(rt60) + np.max(predelays)/1000)*Fs))
+    t = np.arange(largoir)/Fs
+    retardos = (predelays/1000)[:,None]
+    envolvente = np.where(t[None,:] >= retardos,10**(-3*(t[None,:]-retardos)/rt60[:,None]),0)
+    ruido = rng.randn(len(rt60),largoir,2)
+    #Con profundidad estéreo nula ambos canales comparten la respuesta:
+    ruido[:,:,1] = stereodepth[:,None]*ruido[:,:,1] + (1-stereodepth[:,None])*ruido[:,:,0]
+    ir = ruido*envolvente[:,:,None]
+    ir /= np.sqrt(np.sum(ir**2,axis = 1,keepdims = True)) + 1e-12
+    #La salida se recorta a la duración de la entrada, por lo que sobra la cola más larga que ella:
+    nsamples = np.size(instruments,-2)
+    ir = ir[:,:nsamples]
+    largoir = np.size(ir,1)
+    nfft = scipy.fft.next_fast_len(nsamples + largoir - 1,real = True)
+    secos = instruments.reshape((-1,nsamples,2))
+    espectro = np.fft.rfft(secos,n = nfft,axis = 1)*np.fft.rfft(ir,n = nfft,axis = 1)
+    #Amortiguación de agudos: pasabajos de primer orden entre 20 kHz y 2 kHz.
+    fc = 20000*(0.1**hfdampings)
+    frecuencias = np.fft.rfftfreq(nfft,1/Fs)
+    espectro *= (1/np.sqrt(1 + (frecuencias[None,:]/fc[:,None])**2))[:,:,None]
+    humedos = np.fft.irfft(espectro,n = nfft,axis = 1)[:,:nsamples]
+    newsources = (secos + 0.5*np.sqrt(reverberances)[:,None,None]*humedos).reshape(instruments.shape)
+
+    return np.sum(newsources,axis = -3), newsources
+
+
+def distortbass(instruments,rng = np.random):
     
     """ Añade distorsión y contenido de alta frecuencia mediante un filtro 
-    shelving de agudos al bajo.
+    shelving de agudos al bajo (mismas ecuaciones que highshelf y overdrive de sox).
     """
-    gains = np.random.randint(10,20)
-    colours = np.random.randint(0,100)
-    fc = np.random.randint(2000,5000)
-    gainfilter = np.random.randint(0,10)
-
-    newsources = []
-    mix = 0
-
-    newbass = instruments[0]
-
-    fx = AudioEffectsChain().highshelf(gainfilter,fc).overdrive(gains,colours)
-    newbass = fx(np.transpose(newbass),sample_in=44100,sample_out = 44100,
-                 channels_out = 2)
-    newbass = np.transpose(newbass)
-    newsources = [newbass,instruments[1],instruments[2],instruments[3]]
-    mix = newbass + instruments[1] + instruments[2] + instruments[3]
 
-    return mix,newsources
-
-def timestretch(instruments):
+    instruments = np.asarray(instruments)
+    bass = instruments[...,0,:,:].reshape((-1,) + instruments.shape[-2:])
+    nbass = np.size(bass,0)
+    gains = rng.randint(10,20,size = nbass)
+    colours = rng.randint(0,100,size = nbass)
+    fc = rng.randint(2000,5000,size = nbass)
+    gainfilter = rng.randint(0,10,size = nbass)
+
+    newbass = np.empty_like(bass)
+    for i in range(nbass):
+        b, a = _HighShelf(gainfilter[i],fc[i])
+        newbass[i] = signal.lfilter(b,a,bass[i],axis = 0)
+    newbass = _Overdrive(newbass,gains,colours)
+    newsources = instruments.copy()
+    newsources[...,0,:,:] = newbass.reshape(instruments.shape[:-3] + instruments.shape[-2:])
+
+    return np.sum(newsources,axis = -3), newsources
+
+def timestretch(instruments,rng = np.random):
     
-    """ Realiza time stretching con un factor aleatorio entre 0.75 y 1.5 de las
-    fuentes.
+    """ Realiza time stretching (vocoder de fase, sin cambio de altura) con un
+    factor aleatorio entre 0.75 y 1.5 de las fuentes. Si la fuente queda más
+    larga se recorta y si queda más corta se ubica en una posición aleatoria.
     """
 
-    factors = np.random.uniform(0.75,1.5,size = (4,))
-    shx = np.shape(instruments[0])
-    newsources = []
-    mix = np.zeros((shx[0],shx[1]))
-
-    for i,instrument in enumerate(instruments):
-        fx = AudioEffectsChain().tempo(factors[i])
-        newinstrument = np.zeros((shx[0],shx[1]))
-        newinstrumentfx = fx(np.transpose(instrument),sample_in=44100,sample_out = 44100, channels_out = 2)
-        newinstrumentfx = np.transpose(newinstrumentfx)
-        shinst = np.shape(newinstrumentfx)
-        if shinst[0]>shx[0]:
-            newinstrument = newinstrumentfx[0:shx[0],:]
-        else:
-            shift = np.random.randint(0,shx[0]-shinst[0])
-            newinstrument[shift:shift+shinst[0],:] = newinstrumentfx
-        newsources.append(newinstrument)
-        mix = mix + newinstrument
+    instruments = np.asarray(instruments)
+    factors = rng.uniform(0.75,1.5,size = instruments.shape[:-2]).ravel()
+    nsamples = np.size(instruments,-2)
+    estiradas, largos = _EstirarTiempo(instruments.reshape((-1,nsamples,2)),factors)
+    shifts = rng.randint(0,np.maximum(nsamples - largos,0) + 1)
+    #La muestra t de la salida es la muestra t - shift de la fuente estirada:
+    posiciones = np.arange(nsamples)[None,:] - shifts[:,None]
+    newsources = _Interpolar(estiradas,posiciones,largos).reshape(instruments.shape)
 
-    return mix,newsources
+    return np.sum(newsources,axis = -3), newsources
 
-def augmentdata(instruments):
+def augmentdata(instruments,rng = np.random):
     
-    """Aplica de forma aleatoria una de las funciones definidas anteriormente."""
+    """Aplica de forma aleatoria una de las funciones definidas anteriormente.
+    rng: generador de números aleatorios (np.random o un np.random.RandomState)
+    que usan la elección y los parámetros de la transformación."""
 
     transformations = {0:timestretch,1:distortbass,2:addreverb,3:changepitchvocal,4:repan,5:makemono,6:swapchannels,7:changeamplitudes}
-    ntrans = np.random.randint(0,7)
-    x,y = transformations[ntrans](instruments)
+    #Se mantiene el sorteo original, que nunca elige changeamplitudes (augmentbatch sí lo incluye):
+    ntrans = rng.randint(0,7)
+    x,y = transformations[ntrans](instruments,rng)
 
     return x,y
 
+#Transformaciones en el orden que usan augmentbatch y augmentspectra. Desde
+#PrimeraLineal son lineales por fuente, por lo que pueden aplicarse a la STFT:
+Transformaciones = [timestretch,distortbass,addreverb,changepitchvocal,repan,makemono,swapchannels,changeamplitudes]
+PrimeraLineal = 4
+
+def augmentbatch(bloques,rng = np.random,ntrans = None):
+
+    """Versión por lotes de augmentdata: a cada bloque de bloques (forma
+    (nbloques,n_sources,nmuestras,2)) le aplica una transformación elegida al
+    azar, entre todas las de Transformaciones (a diferencia de augmentdata,
+    incluye changeamplitudes). Los bloques que comparten transformación se
+    procesan juntos.
+    rng: generador de números aleatorios, como en augmentdata.
+    ntrans: índice en Transformaciones de la transformación de cada bloque
+    (por defecto se sortea).
+    Devuelve las mezclas (nbloques,nmuestras,2) y las fuentes."""
+
+    bloques = np.asarray(bloques,dtype = 'float32')
+    if ntrans is None:
+        ntrans = rng.randint(0,len(Transformaciones),size = np.size(bloques,0))
+    mezclas = np.empty(bloques.shape[:1] + bloques.shape[2:],dtype = 'float32')
+    fuentes = np.empty_like(bloques)
+    for n in np.unique(ntrans):
+        indices = np.flatnonzero(ntrans == n)
+        mezclas[indices], fuentes[indices] = Transformaciones[n](bloques[indices],rng)
+
+    return mezclas, fuentes
+
+def augmentspectra(espectros,rng = np.random,ntrans = None,intercambiar = True):
+
+    """Aplica las transformaciones lineales (repan, makemono, swapchannels y
+    changeamplitudes) directamente sobre las STFT complejas de las fuentes:
+    como la STFT es lineal, equivale a transformar el audio, sin volver al
+    dominio del tiempo ni recalcular la STFT.
+    Argumentos:
+    espectros: STFT de las fuentes, de forma (nbloques,n_sources,2,NFreqs,nframes).
+    ntrans: índice en Transformaciones (desde PrimeraLineal) de la transformación
+    de cada bloque; por defecto se sortea entre las lineales.
+    intercambiar: si es True, en la mitad de los bloques (al azar) cada fuente se
+    toma de otro bloque, como el intercambio de fuentes entre canciones de
+    generateaugmentedset.
+    Devuelve las STFT de las mezclas (nbloques,2,NFreqs,nframes) y de las fuentes."""
+
+    espectros = np.asarray(espectros)
+    [nbloques,nfuentes] = espectros.shape[:2]
+    if intercambiar:
+        swap = rng.randint(0,2,size = (nbloques,1))
+        origen = np.where(swap == 1,rng.randint(0,nbloques,size = (nbloques,nfuentes)),np.arange(nbloques)[:,None])
+        espectros = espectros[origen,np.arange(nfuentes)]
+    if ntrans is None:
+        ntrans = rng.randint(PrimeraLineal,len(Transformaciones),size = nbloques)
+    #Cada transformación lineal mezcla los canales de cada fuente con una matriz de 2x2, que
+    #se obtiene aplicándola a la base (1,0), (0,1) en lugar de muestras (los sorteos son los
+    #mismos que sobre el audio). Así los espectros se recorren una sola vez.
+    base = np.broadcast_to(np.eye(2,dtype = 'float32'),(nbloques,nfuentes,2,2))
+    matrices = np.empty((nbloques,nfuentes,2,2),dtype = 'float32')
+    for n in np.unique(ntrans):
+        indices = np.flatnonzero(ntrans == n)
+        matrices[indices] = np.swapaxes(Transformaciones[n](base[indices],rng)[1],-1,-2)
+    #Se aplanan frecuencias y frames en el orden en que están en memoria, para no copiar los
+    #espectros (espectrograma.STFT devuelve los frames como eje más lento):
+    transpuestos = espectros.strides[-1] > espectros.strides[-2]
+    ordenados = np.swapaxes(espectros,-1,-2) if transpuestos else espectros
+    nuevas = np.matmul(matrices.astype(espectros.dtype),ordenados.reshape(ordenados.shape[:3] + (-1,))).reshape(ordenados.shape)
+    nuevas = np.swapaxes(nuevas,-1,-2) if transpuestos else nuevas
+
+    return np.sum(nuevas,axis = 1), nuevas
+
+def _EstirarTiempo(audio,factores):
+
+    #Vocoder de fase por lotes: audio (n,nmuestras,2), factores (n,) de velocidad
+    #(mayor a 1 acorta). Devuelve el audio estirado, completado con ceros hasta el
+    #más largo, y el largo de cada uno.
+    factores = np.asarray(factores,dtype = 'float64')
+    nsamples = np.size(audio,1)
+    stft = espectrograma.STFT(np.swapaxes(audio,1,2)) #(n,2,NFreqs,nframes)
+    nframes = np.size(stft,-1)
+    npasos = int(np.ceil((nframes-1)/np.min(factores)))
+    pasos = np.arange(npasos)[None,:]*factores[:,None]
+    validos = pasos < nframes-1
+    pasos = np.minimum(pasos,nframes-1.001)
+    inicio = np.floor(pasos).astype('int64')
+    fraccion = (pasos - inicio).astype('float32')[:,None,None,:]
+    magnitudes = np.abs(stft)
+    fases = np.angle(stft)
+    indices0 = inicio[:,None,None,:]
+    magnitud = (1-fraccion)*np.take_along_axis(magnitudes,indices0,axis = -1) + fraccion*np.take_along_axis(magnitudes,indices0 + 1,axis = -1)
+    #Avance de fase de cada bin entre frames consecutivos, alrededor del esperado:
+    omega = (2*np.pi*espectrograma.HopSize*np.arange(espectrograma.NFreqs)/espectrograma.WinSize).astype('float32')[:,None]
+    avance = np.take_along_axis(fases,indices0 + 1,axis = -1) - np.take_along_axis(fases,indices0,axis = -1) - omega
+    avance = omega + np.mod(avance + np.pi,2*np.pi) - np.pi
+    fase = fases[...,:1] + np.concatenate([np.zeros_like(avance[...,:1]),np.cumsum(avance[...,:-1],axis = -1)],axis = -1)
+    magnitud *= validos[:,None,None,:]
+    estirado = magnitud*np.cos(fase) + 1j*(magnitud*np.sin(fase))
+    largos = np.round(nsamples/factores).astype('int64')
+    salida = espectrograma.ISTFT(estirado.astype('complex64'),length = int(np.max(largos)))
+
+    return np.swapaxes(salida,1,2), largos
+
+def _Interpolar(audio,posiciones,largos):
+
+    #Interpolación lineal de audio (n,nmuestras,2) en posiciones (n,m) fraccionarias.
+    #Fuera de [0,largo) de cada audio la salida es cero.
+    inicio = np.floor(posiciones).astype('int64')
+    fraccion = (posiciones - inicio)[:,:,None]
+    validos = ((posiciones >= 0) & (posiciones <= largos[:,None]-1))[:,:,None]
+    ultimo = np.size(audio,1)-1
+    muestra0 = np.take_along_axis(audio,np.clip(inicio,0,ultimo)[:,:,None],axis = 1)
+    muestra1 = np.take_along_axis(audio,np.clip(inicio+1,0,ultimo)[:,:,None],axis = 1)
+
+    return np.where(validos,(1-fraccion)*muestra0 + fraccion*muestra1,0)
+
+def _HighShelf(gain,fc,slope = 0.5):
+
+    #Coeficientes del filtro shelving de agudos (Audio EQ Cookbook, como sox).
+    A = 10**(gain/40)
+    w0 = 2*np.pi*fc/Fs
+    alpha = np.sin(w0)/2*np.sqrt((A + 1/A)*(1/slope - 1) + 2)
+    coseno = np.cos(w0)
+    b = [A*((A+1) + (A-1)*coseno + 2*np.sqrt(A)*alpha),
+         -2*A*((A-1) + (A+1)*coseno),
+         A*((A+1) + (A-1)*coseno - 2*np.sqrt(A)*alpha)]
+    a = [(A+1) - (A-1)*coseno + 2*np.sqrt(A)*alpha,
+         2*((A-1) - (A+1)*coseno),
+         (A+1) - (A-1)*coseno - 2*np.sqrt(A)*alpha]
+
+    return np.array(b)/a[0], np.array(a)/a[0]
+
+def _Overdrive(audio,gains,colours):
+
+    #Overdrive de sox: saturación cúbica con offset (armónicos pares) y filtro de continua.
+    forma = (-1,) + (1,)*(audio.ndim-1)
+    ganancia = 10**(np.reshape(gains,forma)/20)
+    d = audio*ganancia + np.reshape(colours,forma)/200
+    d = np.where(d < -1,-2/3,np.where(d > 1,2/3,d - d**3/3))
+    d = signal.lfilter([1,-1],[1,-0.995],d,axis = 1)
+
+    return 0.5*audio + 0.75*d
+
 def normalizeaudio(audio):
     
     """Lleva al audio a un rango entre -1 y 1 (se trabaja en 16 bits)."""
@@ -197,43 +342,167 @@ def normalizeaudio(audio):
     return normalizedaudio
 
 def generateaugmentedset(n_sources,sourcesongs,nsongs,nframes,
-                         framesperaugmentation):
+                         framesperaugmentation,out = None,spill = None,
+                         workers = 1,seed = None,pool = None,detener = None):
+
+    """ Genera audios de mezcla nuevos con sus respectivas pistas de nframes
+    muestras. Para generarlos aplica transformaciones a bloques de
+    framesperaugmentation muestras y concatena los resultados. A su vez,
+    aleatoriamente mezcla pistas de distintas fuentes.
+    Devuelve la mezcla (nframes,2) y las fuentes (n_sources,nframes,2) en
+    float32 normalizadas entre -1 y 1, sin pasar por archivos.
+    Argumentos opcionales:
+    out: tupla (mezcla,fuentes) de arreglos ya reservados donde escribir.
+    Con workers > 1 deben ser np.memmap, para que los procesos escriban en ellos.
+    spill: carpeta donde crear los arreglos mapeados en memoria (np.memmap)
+    en lugar de en RAM, para chunks muy grandes. El archivo es temporal y se
+    borra al liberarse el arreglo.
+    workers: cantidad de procesos entre los que se reparten los bloques. Los
+    procesos escriben directamente en arreglos compartidos mapeados en memoria
+    (en spill o en la carpeta temporal del sistema).
+    seed: semilla de la que se derivan las semillas de cada bloque. Cada bloque
+    se genera con su propia semilla, por lo que el resultado no depende de la
+    cantidad de workers ni del orden en que terminan. Con None se toma de
+    np.random.
+    pool: pool de CrearAumentadores para reutilizar entre llamadas (con
+    workers > 1). Si no se pasa, se crea uno solo para esta llamada.
+    detener: threading.Event para cancelar la generación (por ejemplo una
+    precarga). Se revisa entre bloques; si se activa, la función deja de
+    esperar al pool y devuelve el resultado incompleto."""
+
     print("aumentando")
-    """ Genera audios de mezcla nuevos con sus respectivas pistas y las guarda
-    en archivos .wav de nframes muestras. Para generarlos aplica transformaciones
-    a bloques de framesperaugmentation muestras y concatena los resultados. 
-    A su vez, aleatoriamente mezcla pistas de distintas fuentes."""
-    
+    if out is not None:
+        mixture, sources = out
+    elif workers > 1:
+        mixture = _BufferCompartido(spill,(nframes,2))
+        sources = _BufferCompartido(spill,(n_sources,nframes,2))
+    elif spill is not None:
+        mixture = np.memmap(tempfile.TemporaryFile(dir = spill),dtype = 'float32',mode = 'w+',shape = (nframes,2))
+        sources = np.memmap(tempfile.TemporaryFile(dir = spill),dtype = 'float32',mode = 'w+',shape = (n_sources,nframes,2))
+    else:
+        mixture = np.zeros((nframes,2),dtype = 'float32')
+        sources = np.zeros((n_sources,nframes,2),dtype = 'float32')
+
     naugmentations = (nframes//framesperaugmentation)-1
-    mixture = np.zeros((nframes,2))
-    sources = np.zeros((nframes,2,4))
-    for i in range(naugmentations):
-        swap = np.random.randint(0,2)
-        yraws = []
-        if swap:
-            songindexs = np.random.randint(0,nsongs,size=(4,))
-            for k in range(n_sources):
-                lengthsong = np.size(sourcesongs[songindexs[k]],1)
-                sampleindex = np.random.randint(lengthsong-framesperaugmentation)
-                instrumenti = sourcesongs[songindexs[k]][k,sampleindex:sampleindex+framesperaugmentation,:]
-                instrumenti = normalizeaudio(instrumenti)
-                yraws.append(instrumenti)
+    rng = np.random.RandomState(seed if seed is not None else np.random.randint(2**31))
+    semillas = rng.randint(2**31,size = max(naugmentations,0))
+    #Los segmentos de cada bloque se eligen en este proceso; solo viajan a los workers los recortes:
+    tareas = ((i,semilla,_ElegirSegmentos(np.random.RandomState(semilla),n_sources,sourcesongs,nsongs,framesperaugmentation),
+               framesperaugmentation) for i,semilla in enumerate(semillas))
+    inicio = time.perf_counter()
+    if workers > 1:
+        for buffer in (mixture,sources):
+            if not isinstance(buffer,np.memmap) or buffer.filename is None:
+                raise ValueError('Con workers > 1 los buffers de salida deben ser np.memmap respaldados por un archivo')
+        destino = (mixture.filename,sources.filename,mixture.offset,sources.offset,nframes,n_sources)
+        tareas = ((destino,) + tarea for tarea in tareas)
+        if pool is None:
+            with CrearAumentadores(workers) as pool:
+                _Esperar(pool.imap_unordered(_AumentarEnWorker,tareas),detener)
         else:
-            songindex = np.random.randint(0,nsongs)
-            for k in range(n_sources):
-                lengthsong = np.size(sourcesongs[songindex],1)
-                sampleindex = np.random.randint(lengthsong-framesperaugmentation)
-                instrumenti = sourcesongs[songindex][k,sampleindex:sampleindex+framesperaugmentation,:]
-                instrumenti = normalizeaudio(instrumenti)
-                yraws.append(instrumenti)
-
-        mix, newsources = augmentdata(yraws)     
-        mixture[i*framesperaugmentation:(i+1)*framesperaugmentation,:] = mix[:nframes,:]
-        newsources = np.transpose(np.array(newsources),(1,2,0))
-        sources[i*framesperaugmentation:(i+1)*framesperaugmentation,:,:] = newsources[:nframes,:,:]        
-        
-    mixture = mixture.astype('float32')
-    sources = sources.astype('float32')
-    wavfile.write('augmented.wav',44100,mixture)
-    for n, instrument in enumerate(["bass.wav","drums.wav","other.wav","vocals.wav"]):
-        wavfile.write(instrument,44100,sources[:,:,n])
+            _Esperar(pool.imap_unordered(_AumentarEnWorker,tareas),detener)
+        if out is None:
+            _Liberar(mixture)
+            _Liberar(sources)
+    else:
+        for tarea in tareas:
+            if detener is not None and detener.is_set():
+                break
+            _AumentarBloque(mixture,sources,*tarea)
+    #Las muestras finales que no completan un bloque quedan en silencio:
+    mixture[max(naugmentations,0)*framesperaugmentation:] = 0
+    sources[:,max(naugmentations,0)*framesperaugmentation:] = 0
+
+    duracion = time.perf_counter() - inicio
+    segundos = max(naugmentations,0)*framesperaugmentation/Fs
+    print("Aumentación: " + str(np.round(segundos/max(duracion,1e-9),1)) + " s de audio por segundo (" + str(workers) + " workers)")
+
+    return mixture, sources
+
+def _Esperar(resultados,detener):
+
+    #Espera los bloques del pool; con detener activado deja de esperarlos (el
+    #pool puede terminarse sin que este hilo quede bloqueado).
+    for i in resultados:
+        if detener is not None and detener.is_set():
+            break
+
+def _ElegirSegmentos(rng,n_sources,sourcesongs,nsongs,framesperaugmentation):
+
+    #Elige de qué canciones y posiciones se toman las pistas de un bloque.
+    #Aleatoriamente se mezclan pistas de distintas canciones.
+    swap = rng.randint(0,2)
+    if swap:
+        songindexs = rng.randint(0,nsongs,size=(n_sources,))
+    else:
+        songindexs = np.repeat(rng.randint(0,nsongs),n_sources)
+    segmentos = []
+    for k in range(n_sources):
+        #sourcesongs[i] puede ser un arreglo (fuentes,muestras,2) o una lista de fuentes (muestras,2):
+        lengthsong = len(sourcesongs[songindexs[k]][k])
+        sampleindex = rng.randint(lengthsong-framesperaugmentation)
+        segmentos.append(np.asarray(sourcesongs[songindexs[k]][k][sampleindex:sampleindex+framesperaugmentation]))
+
+    return segmentos
+
+def _AumentarBloque(mixture,sources,i,semilla,segmentos,framesperaugmentation):
+
+    #Las transformaciones usan un generador con la semilla del bloque:
+    yraws = [normalizeaudio(segmento) for segmento in segmentos]
+    mix, newsources = augmentdata(yraws,np.random.RandomState(semilla))
+    mixture[i*framesperaugmentation:(i+1)*framesperaugmentation,:] = mix[:framesperaugmentation,:]
+    for k in range(len(newsources)):
+        sources[k,i*framesperaugmentation:(i+1)*framesperaugmentation,:] = newsources[k][:framesperaugmentation,:]
+
+def CrearAumentadores(workers):
+
+    """Pool de workers procesos para generateaugmentedset, que puede usarse en
+    varias llamadas. Los procesos se crean con spawn, que vuelve a importar el
+    script principal: el script que entrena debe estar protegido con
+    if __name__ == '__main__'."""
+
+    return multiprocessing.get_context('spawn').Pool(workers)
+
+#Buffers de salida abiertos en cada proceso del pool (los del último chunk):
+_destino = (None,None)
+
+def _AbrirDestino(destino):
+
+    global _destino
+    if _destino[0] != destino:
+        [mixturefile,sourcesfile,mixtureoffset,sourcesoffset,nframes,n_sources] = destino
+        _destino = (destino,(np.memmap(mixturefile,dtype = 'float32',mode = 'r+',offset = mixtureoffset,shape = (nframes,2)),
+                             np.memmap(sourcesfile,dtype = 'float32',mode = 'r+',offset = sourcesoffset,shape = (n_sources,nframes,2))))
+
+    return _destino[1]
+
+def _AumentarEnWorker(tarea):
+
+    [mixture,sources] = _AbrirDestino(tarea[0])
+    _AumentarBloque(mixture,sources,*tarea[1:])
+
+    return tarea[1]
+
+def _BufferCompartido(directorio,shape):
+
+    #Arreglo mapeado en un archivo con nombre, para que los workers puedan abrirlo:
+    descriptor, archivo = tempfile.mkstemp(suffix = '.aug',dir = directorio)
+    os.close(descriptor)
+
+    return np.memmap(archivo,dtype = 'float32',mode = 'w+',shape = shape)
+
+def _Liberar(buffer):
+
+    #En POSIX el archivo se puede borrar mientras sigue mapeado; en Windows se
+    #borra cuando se libera el arreglo.
+    try:
+        os.remove(buffer.filename)
+    except OSError:
+        weakref.finalize(buffer,_Borrar,buffer.filename)
+
+def _Borrar(archivo):
+
+    try:
+        os.remove(archivo)
+    except OSError:
+        pass
@@ -0,0 +1,124 @@
+# =============================================================================
+# cacheseparacion.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script defines a persistent cache of network predictions. Entries are
+# keyed by a hash of the decoded audio and of the model weights, and store the
+# averaged network outputs in compressed files (float32 by default, so a hit
+# returns exactly what a miss computes). The cache has a size limit and evicts
+# the least recently used entries. On a hit, only mask application, ISTFT and
+# writing the files are needed.
+# =============================================================================
+
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+def HuellaArchivo(filename,blocksize = 2**20):
+
+    """Hash sha256 del contenido de un archivo (por ejemplo los pesos del modelo)."""
+
+    huella = hashlib.sha256()
+    with open(filename,'rb') as f:
+        for bloque in iter(lambda: f.read(blocksize),b''):
+            huella.update(bloque)
+
+    return huella.hexdigest()
+
+class CacheSeparacion():
+
+    """Cache en disco de las salidas de la red.
+    Argumentos:
+    directorio: carpeta donde se guardan las entradas (.npz).
+    huellamodelo: identifica al modelo (ver HuellaArchivo); forma parte de la clave.
+    maxbytes: tamaño máximo de la carpeta. Al superarlo se eliminan las
+    entradas usadas hace más tiempo.
+    dtype: tipo con que se guardan las salidas. Con 'float32' (por defecto) un
+    acierto devuelve lo mismo que calcular la separación; 'float16' ocupa la
+    mitad pero cuantiza las salidas, por lo que la separación leída del cache
+    difiere levemente de la calculada. Forma parte del nombre de las entradas.
+    """
+
+    def __init__(self,directorio,huellamodelo,maxbytes = 10*2**30,dtype = 'float32'):
+
+        self.directorio = directorio
+        self.huellamodelo = huellamodelo
+        self.maxbytes = maxbytes
+        self.dtype = np.dtype(dtype).name
+        self.aciertos = 0
+        self.fallos = 0
+        os.makedirs(directorio,exist_ok = True)
+
+    def Clave(self,audio):
+
+        """Clave de una mezcla: hash del audio decodificado y del modelo."""
+
+        audio = np.ascontiguousarray(audio,dtype = 'float32')
+        huella = hashlib.sha256(self.huellamodelo.encode())
+        huella.update(str(audio.shape).encode())
+        huella.update(memoryview(audio).cast('B'))
+
+        return huella.hexdigest()
+
+    def Leer(self,clave):
+
+        """Devuelve las salidas guardadas para clave (float32) o None."""
+
+        archivo = self._Archivo(clave)
+        try:
+            with np.load(archivo) as datos:
+                stftpredicted = datos['stftpredicted'].astype('float32')
+        except (IOError,OSError,KeyError,ValueError):
+            self.fallos = self.fallos + 1
+            return None
+        #La fecha de modificación registra el último uso (LRU):
+        try:
+            os.utime(archivo,None)
+        except OSError:
+            pass
+        self.aciertos = self.aciertos + 1
+
+        return stftpredicted
+
+    def Guardar(self,clave,stftpredicted):
+
+        """Guarda las salidas en dtype comprimido (escritura atómica) y
+        aplica el límite de tamaño."""
+
+        descriptor, temporal = tempfile.mkstemp(suffix = '.tmp',dir = self.directorio)
+        try:
+            with os.fdopen(descriptor,'wb') as f:
+                np.savez_compressed(f,stftpredicted = np.asarray(stftpredicted,dtype = self.dtype))
+            os.replace(temporal,self._Archivo(clave))
+        except BaseException:
+            if os.path.exists(temporal):
+                os.remove(temporal)
+            raise
+        self.Podar()
+
+    def Podar(self):
+
+        """Elimina las entradas usadas hace más tiempo hasta respetar maxbytes."""
+
+        entradas = []
+        for nombre in os.listdir(self.directorio):
+            if not nombre.endswith('.npz'):
+                continue
+            try:
+                estado = os.stat(os.path.join(self.directorio,nombre))
+            except OSError:
+                continue
+            entradas.append((estado.st_mtime,estado.st_size,nombre))
+        total = sum(entrada[1] for entrada in entradas)
+        for mtime,size,nombre in sorted(entradas):
+            if total <= self.maxbytes:
+                break
+            try:
+                os.remove(os.path.join(self.directorio,nombre))
+                total = total - size
+            except OSError:
+                pass
+
+    def _Archivo(self,clave):
+
+        return os.path.join(self.directorio,clave + '_' + self.dtype + '.npz')
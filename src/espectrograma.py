@@ -0,0 +1,146 @@
+# =============================================================================
+# espectrograma.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script defines the STFT and ISTFT used for training and separation. All
+# the channels and tracks of an array are transformed in a single vectorized
+# call, using float32 and a cached analysis window. Results match
+# scipy.signal.stft/istft with boundary = 'zeros' and padded = True. Many short
+# signals are transformed in cache sized blocks of frames.
+# =============================================================================
+
+import functools
+import numpy as np
+import scipy.signal as signal
+from numpy.lib.stride_tricks import as_strided
+#scipy.fft (scipy >= 1.4) es más rápido que numpy.fft y reparte lotes de frames entre hilos:
+try:
+    import scipy.fft as fft
+    _Hilos = {'workers':-1}
+except ImportError:
+    fft = np.fft
+    _Hilos = {}
+
+#Parámetros de STFT:
+WinType = 'hann'
+WinSize = 2048
+HopSize = 512
+Overlap = WinSize - HopSize
+NFreqs = WinSize//2 + 1
+FramesPorBloque = 256 #Frames por llamada a la FFT dentro de STFT
+
+@functools.lru_cache(maxsize = None)
+def Ventana(wintype = WinType,winsize = WinSize):
+
+    """Devuelve la ventana de análisis (float32, de solo lectura) y su suma,
+    calculadas una única vez."""
+
+    window = signal.get_window(wintype,winsize).astype('float32')
+    window.flags.writeable = False
+
+    return window, np.float32(np.sum(window))
+
+def FFTFrames(frames):
+
+    """Calcula el espectro de frames de WinSize muestras ubicados en el último
+    eje (..., nframes, WinSize), con la escala de scipy.signal.stft.
+    Devuelve un arreglo complex64 de forma (..., nframes, NFreqs)."""
+
+    #La escala 1/suma de la ventana se aplica junto con la ventana (una pasada menos sobre el espectro):
+    espectro = fft.rfft(frames*_VentanaEscalada(),axis = -1,**_Hilos)
+
+    return espectro.astype('complex64',copy = False)
+
+@functools.lru_cache(maxsize = None)
+def _VentanaEscalada():
+
+    window, winsum = Ventana()
+    escalada = window/winsum
+    escalada.flags.writeable = False
+
+    return escalada
+
+def IFFTFrames(espectro):
+
+    """Inversa de FFTFrames: devuelve los frames (..., nframes, WinSize) ya
+    ventaneados, listos para el overlap-add."""
+
+    window, winsum = Ventana()
+    frames = fft.irfft(espectro,n = WinSize,axis = -1,**_Hilos).astype('float32',copy = False)
+    frames *= winsum*window
+
+    return frames
+
+def STFT(audio):
+
+    """STFT de todos los canales y pistas de audio en una sola llamada.
+    Argumentos:
+    audio: arreglo de forma (..., nmuestras), por ejemplo (pistas,canales,nmuestras).
+    Devuelve la STFT complex64 de forma (..., NFreqs, nframes)."""
+
+    return _STFTPorBloques(audio,None,'complex64')
+
+def LogMagnitudSTFT(audio):
+
+    """Equivale a LogMagnitud(STFT(audio)) pero calcula la magnitud de cada
+    bloque apenas sale de la FFT, sin guardar la STFT compleja completa.
+    Devuelve un arreglo float32 de forma (..., NFreqs, nframes)."""
+
+    return _STFTPorBloques(audio,LogMagnitud,'float32')
+
+def _STFTPorBloques(audio,transformacion,dtype):
+
+    audio = np.asarray(audio,dtype = 'float32')
+    nmuestras = np.size(audio,-1)
+    #Ceros al principio y al final (boundary) y para completar el último frame (padded):
+    relleno = [(0,0)]*(audio.ndim-1) + [(WinSize//2,WinSize//2 + (-nmuestras) % HopSize)]
+    audio = np.pad(audio,relleno,mode = 'constant')
+    nframes = (np.size(audio,-1) - WinSize)//HopSize + 1
+    forma = audio.shape[:-1]
+    audio = audio.reshape((-1,np.size(audio,-1)))
+    frames = as_strided(audio,shape = audio.shape[:-1] + (nframes,WinSize),
+                        strides = audio.strides[:-1] + (HopSize*audio.strides[-1],audio.strides[-1]),writeable = False)
+    #Se transforma por bloques de señales para que los temporales entren en la cache
+    #(con muchas señales cortas, como en un lote de entrenamiento, una sola FFT gigante es más lenta):
+    senales = max(FramesPorBloque//nframes,1)
+    salida = np.empty((np.size(audio,0),nframes,NFreqs),dtype = dtype)
+    for inicio in range(0,np.size(audio,0),senales):
+        espectro = FFTFrames(frames[inicio:inicio+senales])
+        salida[inicio:inicio+senales] = espectro if transformacion is None else transformacion(espectro)
+
+    return np.swapaxes(salida.reshape(forma + (nframes,NFreqs)),-1,-2)
+
+def ISTFT(stft,length = None):
+
+    """ISTFT de todos los canales y pistas en una sola llamada.
+    Argumentos:
+    stft: arreglo complejo de forma (..., NFreqs, nframes).
+    length: si se especifica, se recorta la salida a length muestras.
+    Devuelve el audio float32 de forma (..., nmuestras)."""
+
+    frames = IFFTFrames(np.swapaxes(stft,-1,-2))
+    window, winsum = Ventana()
+    nframes = np.size(frames,-2)
+    largo = (nframes-1)*HopSize + WinSize
+    audio = np.zeros(frames.shape[:-2] + (largo,),dtype = 'float32')
+    norma = np.zeros((largo,),dtype = 'float32')
+    #Overlap-add por segmentos de HopSize muestras (WinSize/HopSize sumas vectorizadas):
+    for q in range(WinSize//HopSize):
+        segmento = frames[...,q*HopSize:(q+1)*HopSize]
+        audio[...,q*HopSize:q*HopSize + nframes*HopSize] += segmento.reshape(frames.shape[:-2] + (nframes*HopSize,))
+        norma[q*HopSize:q*HopSize + nframes*HopSize] += np.tile(window[q*HopSize:(q+1)*HopSize]**2,nframes)
+    audio /= np.where(norma > 1e-10,norma,1)
+    audio = audio[...,WinSize//2:largo-WinSize//2]
+    if length is not None:
+        audio = audio[...,:length]
+
+    return audio
+
+def LogMagnitud(stft):
+
+    """Representación de entrada/salida de la red: log2(1+|STFT|) en float32."""
+
+    magnitud = np.abs(stft).astype('float32',copy = False)
+    magnitud += 1
+    np.log2(magnitud,out = magnitud)
+
+    return magnitud
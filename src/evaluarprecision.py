@@ -0,0 +1,94 @@
+# =============================================================================
+# evaluarprecision.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script compares the separation quality of reduced precision models
+# (exported with modelocongelado.py) against the float32 baseline on the songs
+# in the samples folder. For every song and source it reports the SDR against
+# the true stems, the drift with respect to the baseline, and the SDR of each
+# model's estimates against the baseline estimates.
+#
+# Usage: python evaluarprecision.py --baseline modelo.pb modelo_f16.tflite modelo_int8.tflite
+# =============================================================================
+
+import argparse
+import glob
+import os
+import numpy as np
+import leeraudio
+import separate
+
+Fuentes = ['Bass','Drums','Other','Vocals']
+
+def SDR(referencia,estimacion):
+
+    """Relación señal a distorsión (en dB) entre referencia y estimación."""
+
+    error = np.sum((referencia - estimacion)**2)
+
+    return 10*np.log10(np.sum(referencia**2)/(error + 1e-12) + 1e-12)
+
+def ListarCanciones(carpeta):
+
+    """Devuelve un diccionario canción -> (mezcla, [bajo, batería, otros, voz])
+    con los archivos de la carpeta de muestras ('Nombre - Mixture.wav', etc.)."""
+
+    canciones = {}
+    for mezcla in sorted(glob.glob(os.path.join(carpeta,'* - Mixture.wav'))):
+        nombre = os.path.basename(mezcla)[:-len(' - Mixture.wav')]
+        pistas = []
+        for fuente in Fuentes:
+            #En algunas canciones la pista de otros se llama 'Others':
+            candidatos = glob.glob(os.path.join(carpeta,nombre + ' - ' + fuente + '*.wav'))
+            pistas.append(candidatos[0] if candidatos else None)
+        if None not in pistas:
+            canciones[nombre] = (mezcla,pistas)
+
+    return canciones
+
+def EvaluarPrecision(baseline,modelos,carpeta = '../samples',batchsize = 128):
+
+    """Separa las canciones de carpeta con el modelo baseline y con cada uno de
+    modelos, e imprime el SDR por fuente, la deriva respecto del baseline y el
+    SDR respecto de las estimaciones del baseline.
+    Devuelve un diccionario modelo -> arreglo (canciones,fuentes) de derivas en dB."""
+
+    canciones = ListarCanciones(carpeta)
+    modelobase = separate.CargarModelo(baseline)
+    cargados = [(modelfile,separate.CargarModelo(modelfile)) for modelfile in modelos]
+    derivas = {modelfile:[] for modelfile in modelos}
+    for nombre,(mezcla,pistas) in canciones.items():
+        [fs,audiomixture] = leeraudio.ReadAudio(mezcla)
+        verdaderas = np.array([np.transpose(leeraudio.ReadAudio(pista)[1]) for pista in pistas])
+        estimacionbase = np.transpose(separate.SepararAudio(audiomixture,modelobase,batchsize,verbose = False),(1,0,2))
+        sdrbase = np.array([SDR(verdaderas[n],estimacionbase[n]) for n in range(len(Fuentes))])
+        print(nombre)
+        print('  ' + baseline + ': SDR ' + ' '.join(f + ' ' + str(np.round(v,2)) for f,v in zip(Fuentes,sdrbase)))
+        for modelfile,model in cargados:
+            estimacion = np.transpose(separate.SepararAudio(audiomixture,model,batchsize,verbose = False),(1,0,2))
+            sdr = np.array([SDR(verdaderas[n],estimacion[n]) for n in range(len(Fuentes))])
+            fidelidad = np.array([SDR(estimacionbase[n],estimacion[n]) for n in range(len(Fuentes))])
+            derivas[modelfile].append(sdr - sdrbase)
+            print('  ' + modelfile + ': SDR ' + ' '.join(f + ' ' + str(np.round(v,2)) for f,v in zip(Fuentes,sdr)) +
+                  ' | deriva ' + ' '.join(str(np.round(v,3)) for v in sdr - sdrbase) +
+                  ' | SDR vs baseline ' + ' '.join(str(np.round(v,1)) for v in fidelidad))
+    for modelfile in modelos:
+        derivas[modelfile] = np.array(derivas[modelfile])
+        if len(derivas[modelfile]):
+            print(modelfile + ': deriva media ' + str(np.round(np.mean(derivas[modelfile]),3)) +
+                  ' dB, máxima ' + str(np.round(np.max(np.abs(derivas[modelfile])),3)) + ' dB')
+
+    return derivas
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Compara modelos de precisión reducida contra el baseline float32.')
+    parser.add_argument('modelos',nargs = '+',help = 'modelos a comparar (.pb, .tflite o .hdf5)')
+    parser.add_argument('--baseline',default = 'pesos.hdf5',help = 'modelo de referencia en float32')
+    parser.add_argument('--samples',default = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','samples'))
+    parser.add_argument('--batch-size',type = int,default = 128)
+    args = parser.parse_args(argv)
+
+    EvaluarPrecision(args.baseline,args.modelos,args.samples,args.batch_size)
+
+if __name__ == '__main__':
+    main()
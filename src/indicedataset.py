@@ -0,0 +1,159 @@
+# =============================================================================
+# indicedataset.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script defines a global index of the training windows of a multitrack
+# dataset. Every mixture and source WAV file is opened memory-mapped (only the
+# headers are read at startup), and windows are sampled uniformly across the
+# whole corpus. Memory use is bounded by the page cache instead of by how many
+# songs are loaded at once. Both the DSD100 and the MUSDB18-HQ folder layouts
+# are supported.
+# =============================================================================
+
+import os
+import numpy as np
+import scipy.io.wavfile as wavfile
+
+Pistas = ['mixture','bass','drums','other','vocals']
+
+def ListarCanciones(datasetpath,subset):
+
+    """Devuelve una lista de (nombre, [archivos de las 5 pistas]) en el orden
+    de Pistas. Reconoce la estructura de DSD100 (Mixtures/<subset>/<canción>/
+    mixture.wav y Sources/<subset>/<canción>/<fuente>.wav) y la de MUSDB18-HQ
+    (<subset>/<canción>/<pista>.wav)."""
+
+    mixturespath = os.path.join(datasetpath,'Mixtures',subset)
+    if os.path.isdir(mixturespath):
+        sourcespath = os.path.join(datasetpath,'Sources',subset)
+        carpetas = [(mixturespath,sourcespath)]
+    else:
+        carpetas = [(os.path.join(datasetpath,subset),)*2]
+    canciones = []
+    for mixturespath,sourcespath in carpetas:
+        for nombre in sorted(os.listdir(mixturespath)):
+            archivos = [os.path.join(mixturespath,nombre,'mixture.wav')]
+            archivos = archivos + [os.path.join(sourcespath,nombre,pista + '.wav') for pista in Pistas[1:]]
+            canciones.append((nombre,archivos))
+
+    return canciones
+
+def Subconjuntos(datasetpath):
+
+    """Subconjuntos que ListarCanciones reconoce en datasetpath ('Dev' y 'Test'
+    en DSD100, 'train' y 'test' en MUSDB18-HQ)."""
+
+    mixturespath = os.path.join(datasetpath,'Mixtures')
+    base = mixturespath if os.path.isdir(mixturespath) else datasetpath
+
+    return sorted(nombre for nombre in os.listdir(base) if os.path.isdir(os.path.join(base,nombre)))
+
+def _AbrirPista(archivo):
+
+    #Solo se lee el encabezado; el mapeo sigue siendo válido después de cerrar el archivo,
+    #por lo que no queda un descriptor abierto por pista.
+    with open(archivo,'rb') as f:
+        [fs,audio] = wavfile.read(f,mmap = True)
+
+    return fs, audio
+
+def Normalizar(audio,out):
+
+    """Copia audio a out (float32) llevándolo a [-1,1] si es de 16 bits, con la
+    misma escala que usa el entrenamiento."""
+
+    if audio.dtype.kind in 'iu':
+        np.multiply(audio,np.float32(1/(2**15-1)),out = out,casting = 'unsafe')
+    else:
+        out[...] = audio
+
+class IndiceVentanas():
+
+    """Índice de todas las ventanas de samplesize muestras de un conjunto de
+    canciones (ver ListarCanciones). Las ventanas se numeran de forma global,
+    por lo que sortear un número uniforme equivale a sortear una ventana
+    uniforme de todo el corpus."""
+
+    def __init__(self,canciones,samplesize):
+
+        self.canciones = canciones
+        self.samplesize = samplesize
+        self.nombres = [nombre for nombre,archivos in canciones]
+        self.pistas = []
+        frecuencias = set()
+        for nombre,archivos in canciones:
+            abiertas = [_AbrirPista(archivo) for archivo in archivos]
+            frecuencias.update(fs for fs,audio in abiertas)
+            largo = min(np.size(audio,0) for fs,audio in abiertas)
+            self.pistas.append([audio[:largo] for fs,audio in abiertas])
+        if len(frecuencias) > 1:
+            raise ValueError('Las canciones tienen distintas frecuencias de muestreo: ' + str(sorted(frecuencias)))
+        self.fs = frecuencias.pop() if frecuencias else 44100
+        self.N_Songs = len(self.pistas)
+        self.largos = np.array([np.size(pistas[0],0) for pistas in self.pistas],dtype = 'int64')
+        self.muestras = int(np.sum(self.largos))
+        ventanas = np.maximum(self.largos - samplesize + 1,0)
+        self.acumuladas = np.cumsum(ventanas)
+        self.N_Windows = int(self.acumuladas[-1]) if self.N_Songs else 0
+
+    def __reduce__(self):
+
+        #Al copiarlo a otro proceso se vuelven a mapear los archivos en lugar de copiar su contenido.
+        return (IndiceVentanas,(self.canciones,self.samplesize))
+
+    def Ubicar(self,ventanas):
+
+        """Convierte números globales de ventana en (canción, muestra inicial)."""
+
+        ventanas = np.asarray(ventanas)
+        canciones = np.searchsorted(self.acumuladas,ventanas,side = 'right')
+        anteriores = np.concatenate([[0],self.acumuladas])[canciones]
+
+        return canciones, ventanas - anteriores
+
+    def Ventanas(self,canciones,inicios,out,pistas = None):
+
+        """Copia a out (len(pistas),n,samplesize,2) las ventanas normalizadas que
+        empiezan en inicios de cada canción. canciones e inicios son de forma (n,)
+        o (n,len(pistas)) para tomar cada pista de una canción distinta.
+        pistas: índices de las pistas a copiar (por defecto las 5)."""
+
+        pistas = range(len(Pistas)) if pistas is None else pistas
+        canciones = np.broadcast_to(np.reshape(canciones,(len(canciones),-1)),(len(canciones),len(pistas)))
+        inicios = np.broadcast_to(np.reshape(inicios,(len(inicios),-1)),(len(inicios),len(pistas)))
+        for i in range(len(canciones)):
+            for j,pista in enumerate(pistas):
+                inicio = inicios[i,j]
+                Normalizar(self.pistas[canciones[i,j]][pista][inicio:inicio+self.samplesize],out[j,i])
+
+        return out
+
+    def VentanasAleatorias(self,out,rng = np.random):
+
+        """Llena out (5,n,samplesize,2) con n ventanas uniformes de todo el corpus."""
+
+        [canciones,inicios] = self.Ubicar(rng.randint(0,self.N_Windows,size = np.size(out,1)))
+
+        return self.Ventanas(canciones,inicios,out)
+
+    def FuentesAleatorias(self,out,rng = np.random):
+
+        """Llena out (4,n,samplesize,2) con fuentes para remezclar: en la mitad de
+        los casos (al azar) cada fuente viene de una ventana distinta del corpus y
+        en el resto todas de la misma canción, en posiciones independientes."""
+
+        n = np.size(out,1)
+        nfuentes = len(Pistas) - 1
+        swap = rng.randint(0,2,size = (n,1))
+        [canciones,inicios] = self.Ubicar(rng.randint(0,self.N_Windows,size = (n,nfuentes)))
+        propias = np.maximum(self.largos[canciones[:,:1]] - self.samplesize + 1,1)
+        inicios = np.where(swap == 1,inicios,(rng.random_sample((n,nfuentes))*propias).astype('int64'))
+        canciones = np.where(swap == 1,canciones,canciones[:,:1])
+
+        return self.Ventanas(canciones,inicios,out,range(1,len(Pistas)))
+
+    def Fuentes(self):
+
+        """Lista con las 4 fuentes (mapeadas en memoria) de cada canción, con el
+        formato que usa augmentdata.generateaugmentedset."""
+
+        return [pistas[1:] for pistas in self.pistas]
@@ -0,0 +1,99 @@
+# =============================================================================
+# inferencia.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script defines the inference routines used to obtain the source
+# estimates from the mixture spectrogram. Context windows are taken as strided
+# views of the spectrogram and predicted in large batches.
+# =============================================================================
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+#Parámetros de la ventana contextual de la red:
+N_FramesPast = 10
+N_FramesFuture = 10
+N_FramesWindow = N_FramesPast + N_FramesFuture + 1
+HopVentanas = 3
+N_Sources = 4
+
+def VentanasDeslizantes(magnitudestftin,hop = HopVentanas):
+
+    """Devuelve las ventanas contextuales de la red como una vista (sin copia)
+    del espectrograma.
+    Argumentos:
+    magnitudestftin: espectrograma de la mezcla de forma (1,1025,nframes,2).
+    hop: salto en frames entre ventanas consecutivas.
+    Devuelve un arreglo de forma (nventanas,1025,21,2) y el frame inicial de
+    cada ventana."""
+
+    stft = magnitudestftin[0]
+    nframes = np.size(stft,1)
+    #Mismas ventanas que recorria el bucle original: np.arange(10,nframes-11,3)
+    inicios = np.arange(N_FramesPast,nframes-N_FramesFuture-1,hop) - N_FramesPast
+    sf,st,sc = stft.strides
+    ventanas = as_strided(stft,shape = (len(inicios),np.size(stft,0),N_FramesWindow,np.size(stft,2)),
+                          strides = (hop*st,sf,st,sc),writeable = False)
+
+    return ventanas, inicios
+
+def PredecirEspectrograma(model,magnitudestftin,batchsize = 128,hop = HopVentanas,verbose = True):
+
+    """Predice los espectrogramas de las fuentes para toda la mezcla.
+    Las ventanas se procesan en lotes de batchsize y las salidas se promedian
+    mediante overlap-add sobre el buffer de salida.
+    Argumentos:
+    model: modelo de Keras (ModeloDoble) con los pesos cargados.
+    magnitudestftin: espectrograma de la mezcla de forma (1,1025,nframes,2).
+    batchsize: número de ventanas por llamada a model.predict.
+    hop: salto en frames entre ventanas consecutivas.
+    Devuelve un arreglo float32 de forma (1025,nframes,2,4)."""
+
+    ventanas, inicios = VentanasDeslizantes(magnitudestftin,hop)
+    nfreqs = np.size(magnitudestftin,1)
+    nframes = np.size(magnitudestftin,2)
+    nchannels = np.size(magnitudestftin,3)
+    #Cada frame recibe la contribución de N_FramesWindow/hop ventanas:
+    peso = np.float32(hop/N_FramesWindow)
+    #Se acumula con los frames en el primer eje para sumar lotes enteros por indexado:
+    stftpredicted = np.zeros((nframes,nfreqs,nchannels,N_Sources),dtype = 'float32')
+    nventanas = len(inicios)
+    for b in range(0,nventanas,batchsize):
+        if verbose:
+            print("\r" + str(np.round(b/max(nventanas,1)*100,decimals = 1)) + "%",end='')
+        lote = np.ascontiguousarray(ventanas[b:b+batchsize],dtype = 'float32')
+        prediction = model.predict(lote,batch_size = batchsize)
+        prediction = np.transpose(prediction,(0,2,1,3,4))
+        prediction *= peso
+        iniciosb = inicios[b:b+batchsize]
+        #Dentro de un lote los inicios son distintos, por lo que no hay colisiones en el indexado:
+        for k in range(N_FramesWindow):
+            stftpredicted[iniciosb+k] += prediction[:,k]
+    if verbose:
+        print("\r100.0%")
+
+    return np.transpose(stftpredicted,(1,0,2,3))
+
+def AplicarMascaras(stftpredicted,mixturestft):
+
+    """Calcula las máscaras suaves a partir de las salidas de la red y las
+    aplica sobre la STFT de la mezcla (módulo y fase).
+    Argumentos:
+    stftpredicted: salidas promediadas de la red, float32 de forma
+    (1025,nframes,2,4). Se sobreescribe con las máscaras para no duplicar memoria.
+    mixturestft: STFT compleja de la mezcla de forma (1025,nframes,2).
+    Devuelve la STFT compleja (complex64) de cada fuente, de forma (1025,nframes,2,4)."""
+
+    eps = np.float32(np.finfo(float).eps)
+    masks = np.asarray(stftpredicted,dtype = 'float32')
+    #Se deshace el énfasis logarítmico de la red (2**x-1):
+    np.exp2(masks,out = masks)
+    masks -= 1
+    #Normalización de las máscaras por la suma de las fuentes:
+    denmask = np.sum(masks,axis = 3,keepdims = True)
+    denmask += eps
+    masks /= denmask
+    #Máscara*|X|*exp(j*fase(X)) es igual a máscara*X:
+    sources = np.empty(np.shape(masks),dtype = 'complex64')
+    np.multiply(masks,np.asarray(mixturestft,dtype = 'complex64')[:,:,:,None],out = sources)
+
+    return sources
@@ -1,28 +1,144 @@
-import pydub
-import os
+import subprocess
 import scipy.io.wavfile as wavfile
-from shutil import copyfile
 import numpy as np
 
-def ReadAudio(filename):
+def ReadAudio(filename,start = 0,stop = None,normalize = True):
+
+    """Lee un archivo de audio (.wav, .mp3, .ogg o cualquier formato que
+    soporte ffmpeg) directamente a memoria, sin archivos temporales.
+    Argumentos:
+    filename: archivo a leer.
+    start, stop: rango de muestras a leer (por defecto el archivo completo).
+    normalize: si es True devuelve float32 entre -1 y 1. Si es False y el
+    archivo es .wav, devuelve la vista mapeada en memoria sin copiar los datos.
+    Devuelve la frecuencia de muestreo y el audio de forma (nmuestras,2). Los
+    archivos mono se duplican en los dos canales y los de más de 2 canales se
+    rechazan (ValueError)."""
+
     extension = filename.split('.')
     extension = extension[-1]
-    if extension.lower() == 'mp3':
-    
-    #Abrir mp3:
-        mp3 = pydub.AudioSegment.from_mp3(filename)
-        mp3.export("tempaudio.wav",format="wav")
-    
-    elif extension.lower() == 'ogg':
-        mp3 = pydub.AudioSegment.from_ogg(filename)
-        mp3.export("tempaudio.wav",format="wav")
-   
-    elif extension.lower() == 'wav':
-        copyfile(filename,"tempaudio.wav")
-
-    [fs,audiosignal] = wavfile.read("tempaudio.wav")
-    os.remove("tempaudio.wav")
-    if (np.max(np.abs(audiosignal)))>1.0:
-        audiosignal = audiosignal/(2**15-1)
-
-    return fs, audiosignal
\ No newline at end of file
+    if extension.lower() == 'wav':
+        [fs,audiosignal] = _AbrirWav(filename)
+        audiosignal = _Canales(audiosignal,filename)[start:stop]
+        if normalize:
+            audiosignal = NormalizeAudio(audiosignal)
+    else:
+        fs = _Parametros(filename)
+        audiosignal = _DecodificarFFmpeg(filename,start,stop)
+
+    return fs, _Estereo(audiosignal)
+
+def ReadAudioBlocks(filename,blocksize = 44100*10,segundos = None):
+
+    """Lee un archivo de audio por bloques de blocksize muestras, sin cargarlo
+    completo en memoria. Los .wav se abren mapeados en memoria y los .mp3/.ogg
+    se decodifican con ffmpeg a través de un pipe. Si se especifica segundos,
+    el tamaño de los bloques se calcula con la frecuencia de muestreo del archivo.
+    Devuelve la frecuencia de muestreo y un generador de bloques estéreo float32."""
+
+    extension = filename.split('.')
+    extension = extension[-1]
+    if extension.lower() == 'wav':
+        [fs,audiosignal] = _AbrirWav(filename)
+        blocksize = blocksize if segundos is None else max(int(segundos*fs),1)
+        bloques = _BloquesWav(_Canales(audiosignal,filename),blocksize)
+    else:
+        fs = _Parametros(filename)
+        blocksize = blocksize if segundos is None else max(int(segundos*fs),1)
+        bloques = _BloquesFFmpeg(filename,blocksize)
+
+    return fs, bloques
+
+def NormalizeAudio(audiosignal):
+
+    """Convierte el audio a float32 entre -1 y 1 según su formato: enteros con
+    signo de 16/32 bits, 8 bits sin signo o punto flotante (sin cambios). Los
+    enteros se dividen por su máximo (2**15-1 en 16 bits), la misma escala que
+    usan el entrenamiento y el almacén de espectrogramas."""
+
+    audiosignal = np.asarray(audiosignal)
+    if audiosignal.dtype.kind == 'i':
+        escala = np.float32(2**(8*audiosignal.dtype.itemsize-1)-1)
+        return audiosignal.astype('float32')/escala
+    elif audiosignal.dtype.kind == 'u':
+        cero = np.float32(2**(8*audiosignal.dtype.itemsize-1))
+        return (audiosignal.astype('float32') - cero)/(cero - 1)
+    else:
+        return audiosignal.astype('float32',copy = False)
+
+def _AbrirWav(filename):
+
+    #Los .wav de 24 bits no se pueden mapear en memoria; en ese caso se leen completos.
+    try:
+        return wavfile.read(filename,mmap = True)
+    except ValueError:
+        return wavfile.read(filename)
+
+def _Estereo(audiosignal):
+
+    if audiosignal.ndim == 1:
+        audiosignal = np.stack([audiosignal,audiosignal],axis = 1)
+
+    return audiosignal
+
+def _Canales(audiosignal,filename):
+
+    if audiosignal.ndim > 1:
+        _VerificarCanales(np.size(audiosignal,1),filename)
+
+    return audiosignal
+
+def _VerificarCanales(canales,filename):
+
+    #ffmpeg mezclaría los canales de más a estéreo con sus propios coeficientes; se
+    #rechazan para que todos los formatos se traten igual.
+    if canales > 2:
+        raise ValueError(filename + ' tiene ' + str(canales) + ' canales; solo se admiten archivos mono o estéreo')
+
+def _Parametros(filename):
+
+    #Frecuencia de muestreo de la primera pista de audio, leída con ffprobe (sin
+    #decodificar). También verifica la cantidad de canales.
+    comando = ['ffprobe','-v','error','-select_streams','a:0','-show_entries','stream=sample_rate,channels',
+               '-of','default=noprint_wrappers=1',filename]
+    salida = subprocess.run(comando,stdout = subprocess.PIPE,check = True,universal_newlines = True).stdout
+    parametros = dict(linea.split('=',1) for linea in salida.split())
+    _VerificarCanales(int(parametros['channels']),filename)
+
+    return int(parametros['sample_rate'])
+
+def _ComandoFFmpeg(filename,start = 0,stop = None):
+
+    #Se decodifica a float32 estéreo por stdout; atrim recorta con precisión de muestra.
+    comando = ['ffmpeg','-v','quiet','-i',filename]
+    if start > 0 or stop is not None:
+        recorte = 'atrim=start_sample=' + str(start)
+        if stop is not None:
+            recorte = recorte + ':end_sample=' + str(stop)
+        comando = comando + ['-af',recorte]
+
+    return comando + ['-f','f32le','-acodec','pcm_f32le','-ac','2','-']
+
+def _DecodificarFFmpeg(filename,start = 0,stop = None):
+
+    salida = subprocess.run(_ComandoFFmpeg(filename,start,stop),stdout = subprocess.PIPE,check = True).stdout
+
+    return np.frombuffer(salida,dtype = 'float32').reshape(-1,2)
+
+def _BloquesWav(audiosignal,blocksize):
+
+    for inicio in range(0,np.size(audiosignal,0),blocksize):
+        yield _Estereo(NormalizeAudio(audiosignal[inicio:inicio+blocksize]))
+
+def _BloquesFFmpeg(filename,blocksize):
+
+    proceso = subprocess.Popen(_ComandoFFmpeg(filename),stdout = subprocess.PIPE)
+    try:
+        while True:
+            datos = proceso.stdout.read(blocksize*2*4)
+            if not datos:
+                break
+            yield np.frombuffer(datos,dtype = 'float32').reshape(-1,2)
+    finally:
+        proceso.stdout.close()
+        proceso.wait()
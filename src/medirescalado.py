@@ -0,0 +1,115 @@
+# =============================================================================
+# medirescalado.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script measures the scaling efficiency of data-parallel training
+# (see trainmodel, distribuido = True). For each number of processes, a local
+# Horovod job is launched with horovodrun and every process trains the model
+# on random batches of the same size. The step time, the total throughput and
+# the efficiency relative to a single process are reported.
+#
+# Usage: python medirescalado.py --procesos 1 2 4 --batch-size 32 --pasos 20
+# To measure several machines, pass the horovodrun host list with --hosts.
+#
+# With more than one process, GuardarModelo combines the SIGTERM flag of all
+# processes with a blocking allreduce every cadainterrupcion steps (and at
+# checkpoint and epoch boundaries). The script also measures the latency of
+# that allreduce and the resulting added time per step. A preempted instance
+# stops at most cadainterrupcion steps after the signal.
+# =============================================================================
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+def _Trabajador(batchsize,pasos):
+
+    #Se ejecuta en cada proceso lanzado por horovodrun.
+    import horovod.keras as hvd
+    import ModeloDoble
+    from MisCallbacks import ConfigurarTF, GuardarModelo
+
+    ConfigurarTF(distribuido = True)
+    model = ModeloDoble.CompileModel(distribuido = True)
+    rng = np.random.RandomState(hvd.rank())
+    x = rng.rand(batchsize,1025,21,2).astype('float32')
+    y = rng.rand(batchsize,1025,21,2,4).astype('float32')
+    model._make_train_function()
+    hvd.broadcast_global_variables(0)
+    model.train_on_batch(x,y)
+    inicio = time.perf_counter()
+    for i in range(pasos):
+        model.train_on_batch(x,y)
+    paso = (time.perf_counter() - inicio)/pasos
+    #Latencia de la consulta de SIGTERM entre procesos que hace GuardarModelo:
+    with tempfile.TemporaryDirectory() as carpeta:
+        guardar = GuardarModelo(os.path.join(carpeta,'pesos.hdf5'),distribuido = True)
+        guardar.on_train_begin()
+        guardar.Interrumpido()
+        inicio = time.perf_counter()
+        for i in range(pasos):
+            guardar.Interrumpido()
+        consulta = (time.perf_counter() - inicio)/pasos
+        guardar.on_train_end()
+    if hvd.rank() == 0:
+        print('PASO ' + repr(paso) + ' ' + repr(consulta) + ' ' + repr(guardar.cadainterrupcion))
+
+def MedirEscalado(procesos = [1,2,4],batchsize = 32,pasos = 20,hosts = None):
+
+    """Entrena pasos lotes de batchsize ejemplos por proceso con cada cantidad
+    de procesos y devuelve un diccionario procesos -> (segundos por paso,
+    ejemplos por segundo, eficiencia, segundos de la consulta de SIGTERM). La
+    eficiencia es el tiempo por paso con la menor cantidad de procesos medida
+    (normalmente 1) dividido el tiempo por paso con n procesos (1: escalado
+    ideal, ya que cada proceso entrena un lote del mismo tamaño). La consulta
+    de SIGTERM (ver GuardarModelo) no está incluida en el tiempo por paso; se
+    informa cuánto agrega por paso al hacerla cada cadainterrupcion lotes.
+    hosts: lista de máquinas en el formato de horovodrun (por defecto
+    localhost:n)."""
+
+    resultados = {}
+    for n in procesos:
+        comando = ['horovodrun','-np',str(n),'-H',hosts or 'localhost:' + str(n),
+                   sys.executable,__file__,'--trabajador','--batch-size',str(batchsize),'--pasos',str(pasos)]
+        try:
+            salida = subprocess.run(comando,stdout = subprocess.PIPE,stderr = subprocess.STDOUT,universal_newlines = True)
+        except FileNotFoundError:
+            print('No se encontró horovodrun (pip install horovod).')
+            break
+        medicion = re.search(r'PASO ([0-9.eE+-]+) ([0-9.eE+-]+) ([0-9]+)',salida.stdout)
+        if salida.returncode != 0 or medicion is None:
+            print(str(n) + ' procesos: falló (' + (salida.stdout.strip().splitlines() or ['sin salida'])[-1] + ')')
+            continue
+        paso = float(medicion.group(1))
+        consulta = float(medicion.group(2))
+        cadainterrupcion = int(medicion.group(3))
+        referencia = resultados[min(resultados)][0] if resultados else paso
+        eficiencia = referencia/paso
+        resultados[n] = (paso,n*batchsize/paso,eficiencia,consulta)
+        print(str(n) + ' procesos: ' + str(np.round(paso*1000,1)) + ' ms por paso, ' + str(np.round(n*batchsize/paso,1)) +
+              ' ejemplos/s, eficiencia ' + str(np.round(eficiencia,3)) + ', consulta de SIGTERM ' + str(np.round(consulta*1000,2)) +
+              ' ms (' + str(np.round(consulta*1000/cadainterrupcion,3)) + ' ms por paso cada ' + str(cadainterrupcion) + ' lotes)')
+
+    return resultados
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Mide la eficiencia de escalado del entrenamiento con paralelismo de datos.')
+    parser.add_argument('--procesos',type = int,nargs = '+',default = [1,2,4])
+    parser.add_argument('--batch-size',type = int,default = 32,help = 'ejemplos por proceso en cada paso')
+    parser.add_argument('--pasos',type = int,default = 20)
+    parser.add_argument('--hosts',default = None,help = 'máquinas para horovodrun -H (por defecto localhost)')
+    parser.add_argument('--trabajador',action = 'store_true',help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.trabajador:
+        _Trabajador(args.batch_size,args.pasos)
+    else:
+        MedirEscalado(sorted(args.procesos),args.batch_size,args.pasos,args.hosts)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# =============================================================================
+# medirlotes.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script is a microbenchmark of the batch assembly of DataGenerator. It
+# creates a small synthetic dataset with the DSD100 folder layout, generates one
+# augmented chunk and measures batches per second of the previous assembly (one window
+# and one STFT call per example) and of the vectorized one (all windows of the
+# batch gathered at once and a single STFT call).
+# With --paso it measures instead the training step of ModeloDoble with the
+# standalone metrics (each one computing its own term), with the fused loss and
+# metrics (MisCallbacks.CostoFusionado) and with no metrics at all, which is
+# the most that computing the metrics less often could save.
+#
+# Usage: python medirlotes.py --batch-size 32 --lotes 50
+#        python medirlotes.py --paso --batch-size 8 --lotes 20
+# =============================================================================
+
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import scipy.io.wavfile as wavfile
+from BatchGenerator import DataGenerator
+
+def CrearDatasetSintetico(carpeta,ncanciones = 10,segundos = 30,fs = 44100):
+
+    """Escribe ncanciones canciones de ruido de 16 bits con la estructura de
+    carpetas de DSD100 (Mixtures/Dev y Sources/Dev)."""
+
+    for n in range(ncanciones):
+        nombre = 'cancion ' + str(n).zfill(3)
+        fuentes = (np.random.randn(4,segundos*fs,2)*2000).astype('int16')
+        os.makedirs(os.path.join(carpeta,'Mixtures','Dev',nombre),exist_ok = True)
+        os.makedirs(os.path.join(carpeta,'Sources','Dev',nombre),exist_ok = True)
+        wavfile.write(os.path.join(carpeta,'Mixtures','Dev',nombre,'mixture.wav'),fs,np.sum(fuentes,axis = 0,dtype = 'int16'))
+        for fuente,instrument in zip(fuentes,['bass.wav','drums.wav','other.wav','vocals.wav']):
+            wavfile.write(os.path.join(carpeta,'Sources','Dev',nombre,instrument),fs,fuente)
+
+def _LoteIterativo(generador,augmentedmix,augmentedsources):
+
+    #Armado anterior del lote: un ejemplo por vez, con una llamada a la STFT por ejemplo.
+    batchx = []
+    batchy = []
+    for i in range(generador.BatchSize):
+        da = np.random.randint(0,2)
+        if da == 0:
+            [cancion,inicio] = generador.indice.Ubicar(np.random.randint(0,generador.indice.N_Windows,size = 1))
+            ventana = np.empty((5,1,generador.Samplesize,2),dtype = 'float32')
+            magstft = generador.representaudio(generador.indice.Ventanas(cancion,inicio,ventana)[:,0])
+        else:
+            inicio = np.random.randint(np.size(augmentedmix,0)//generador.Samplesize)*generador.Samplesize
+            audioin = augmentedmix[inicio:inicio+generador.Samplesize]
+            instruments = augmentedsources[:,inicio:inicio+generador.Samplesize,:]
+            magstft = generador.representaudio(np.concatenate([audioin[None],instruments]))
+        batchx.append(magstft[0])
+        batchy.append(magstft[1:])
+    batchx = np.transpose(np.array(batchx),(0,2,3,1))
+    batchy = np.transpose(np.array(batchy),(0,3,4,2,1))
+
+    return batchx, batchy
+
+def MedirLotes(datasetpath = None,batchsize = 32,lotes = 50):
+
+    """Mide lotes por segundo del armado anterior y del vectorizado sobre un
+    chunk aumentado ya generado (sin contar la aumentación del chunk).
+    Si datasetpath es None se crea un dataset sintético temporal.
+    Devuelve un diccionario armado -> lotes por segundo."""
+
+    temporal = None
+    if datasetpath is None:
+        temporal = tempfile.TemporaryDirectory()
+        datasetpath = temporal.name
+        CrearDatasetSintetico(datasetpath)
+    try:
+        generador = DataGenerator(batch_size = batchsize,lotesprecargados = 0,aumentadores = 1,datasetpath = datasetpath,seed = 0)
+        [augmentedmix,augmentedsources] = generador.read_chunk(0,0)
+        #Se espera a que termine la precarga del chunk siguiente para no medirla:
+        for futuro in list(generador.chunks.values()):
+            futuro.result()
+        resultados = {}
+        for nombre,armado in [('iterativo',lambda i: _LoteIterativo(generador,augmentedmix,augmentedsources)),
+                              ('vectorizado',lambda i: generador.generate_batch(0,i % len(generador)))]:
+            armado(0)
+            inicio = time.perf_counter()
+            for i in range(lotes):
+                [batchx,batchy] = armado(i)
+            resultados[nombre] = lotes/(time.perf_counter() - inicio)
+            print(nombre + ": " + str(np.round(resultados[nombre],2)) + " lotes/s " + str(batchx.shape) + " " + str(batchy.shape))
+        print("Aceleración: x" + str(np.round(resultados['vectorizado']/resultados['iterativo'],2)))
+        generador.close()
+    finally:
+        if temporal is not None:
+            temporal.cleanup()
+
+    return resultados
+
+def MedirPaso(batchsize = 8,pasos = 20):
+
+    """Mide los milisegundos por paso de entrenamiento (train_on_batch con
+    lotes aleatorios) con las métricas por separado, con las fusionadas y sin
+    métricas. Devuelve un diccionario configuración -> segundos por paso."""
+
+    import keras.backend as k
+    from keras.optimizers import Adam
+    import ModeloDoble
+    import MisCallbacks
+
+    metricasseparadas = [getattr(MisCallbacks,nombre) for nombre in MisCallbacks.NombresMetricas]
+    x = np.random.rand(batchsize,1025,21,2).astype('float32')
+    y = np.random.rand(batchsize,1025,21,2,4).astype('float32')
+    fusionado = MisCallbacks.CostoFusionado()
+    resultados = {}
+    for nombre,costo,metricas in [('separadas',MisCallbacks.CustomLossFunction,metricasseparadas),
+                                  ('fusionadas',fusionado,fusionado.Metricas()),
+                                  ('sin métricas',MisCallbacks.CostoFusionado(),[])]:
+        k.clear_session()
+        modelo = ModeloDoble.BuildModel()
+        modelo.compile(loss = costo,optimizer = Adam(lr = 0.01,clipvalue = 0.9),metrics = metricas)
+        modelo.train_on_batch(x,y)
+        inicio = time.perf_counter()
+        for i in range(pasos):
+            modelo.train_on_batch(x,y)
+        resultados[nombre] = (time.perf_counter() - inicio)/pasos
+        print(nombre + ": " + str(np.round(resultados[nombre]*1000,1)) + " ms por paso")
+
+    return resultados
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Mide lotes por segundo del armado de lotes de DataGenerator.')
+    parser.add_argument('--dataset',default = None,help = 'carpeta de DSD100 (por defecto un dataset sintético)')
+    parser.add_argument('--batch-size',type = int,default = 32)
+    parser.add_argument('--lotes',type = int,default = 50,help = 'lotes armados (o pasos de entrenamiento con --paso)')
+    parser.add_argument('--paso',action = 'store_true',help = 'mide el paso de entrenamiento con y sin métricas')
+    args = parser.parse_args(argv)
+
+    if args.paso:
+        MedirPaso(args.batch_size,args.lotes)
+    else:
+        MedirLotes(args.dataset,args.batch_size,args.lotes)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# =============================================================================
+# modelocongelado.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script exports the trained network as a frozen Tensorflow graph (graph
+# plus weights in a single .pb file) that can be loaded for predictions without
+# Keras, the optimizer or the training loss and metrics. Before exporting, the
+# inference statistics of the BatchNormalization layers are folded into the
+# weights of the layers that follow them. The network can also be exported to
+# Tensorflow Lite with float16 or int8 weights for cheaper CPU inference. It
+# also measures the cold start time of the different ways of loading the model.
+#
+# Usage: python modelocongelado.py exportar --weights pesos.hdf5 --out modelo.pb
+#        python modelocongelado.py exportar --precision int8 --out modelo.tflite
+#        python modelocongelado.py medir --weights pesos.hdf5 --model modelo.pb
+# =============================================================================
+
+import argparse
+import os
+import subprocess
+import sys
+import numpy as np
+
+NombreEntrada = 'entrada:0'
+NombreSalida = 'salida:0'
+
+Precisiones = ['float32','float16','int8']
+
+#Capas de BatchNormalization que preceden a cada capa lineal del encoder (en el
+#orden en que se concatenan sus salidas):
+_Plegados = {'pvconv':['pbn0'],'phconv':['pbn1'],'hhconv':['hbn0'],'hvconv':['hbn1'],'latente':['hbn2','pbn2']}
+
+def _CoeficientesBN(capa):
+
+    #En inferencia BatchNormalization es la transformación afín escala*x + desplazamiento:
+    gamma, beta, media, varianza = capa.get_weights()
+    escala = gamma/np.sqrt(varianza + capa.epsilon)
+
+    return escala, beta - media*escala
+
+def PlegarBatchNorm(model):
+
+    """Devuelve un modelo equivalente a model sin capas de BatchNormalization.
+    Cada normalización precede a una capa lineal sin activación intermedia
+    (una convolución 'valid' o Flatten seguido de Dense), por lo que su escala
+    se incorpora al kernel de esa capa y su desplazamiento a su bias."""
+
+    import ModeloDoble
+
+    plegado = ModeloDoble.BuildModel(batchnorm = False)
+    for capa in plegado.layers:
+        if not capa.weights:
+            continue
+        kernel = model.get_layer(capa.name).get_weights()
+        if capa.name not in _Plegados:
+            capa.set_weights(kernel)
+            continue
+        kernel = kernel[0]
+        escalas = []
+        desplazamientos = []
+        for nombre in _Plegados[capa.name]:
+            bn = model.get_layer(nombre)
+            escala, desplazamiento = _CoeficientesBN(bn)
+            #Antes de una Dense la normalización se aplica por canal sobre la salida aplanada (canal más rápido):
+            repeticiones = int(np.prod(bn.output_shape[1:-1])) if kernel.ndim == 2 else 1
+            escalas.append(np.tile(escala,repeticiones))
+            desplazamientos.append(np.tile(desplazamiento,repeticiones))
+        escala = np.concatenate(escalas)
+        desplazamiento = np.concatenate(desplazamientos)
+        if kernel.ndim == 2:
+            capa.set_weights([kernel*escala[:,None],np.dot(desplazamiento,kernel)])
+        else:
+            capa.set_weights([kernel*escala[None,None,:,None],np.einsum('hwio,i->o',kernel,desplazamiento)])
+
+    return plegado
+
+def ExportarModelo(weightfile = 'pesos.hdf5',outfile = 'modelo.pb',precision = 'float32'):
+
+    """Construye el modelo de inferencia, carga los pesos, pliega las
+    BatchNormalization y guarda el grafo congelado (variables convertidas en
+    constantes) en outfile. Con precision 'float16' o 'int8' se guarda en
+    cambio un modelo de Tensorflow Lite con los pesos de encoder y decoder
+    cuantizados."""
+
+    import tensorflow as tf
+    from keras import backend as k
+    import ModeloDoble
+
+    #Las BatchNormalization usan las estadísticas de inferencia:
+    k.set_learning_phase(0)
+    model = PlegarBatchNorm(ModeloDoble.InferenceModel(weightfile))
+    tf.identity(model.output,name = NombreSalida.split(':')[0])
+    sess = k.get_session()
+    graphdef = tf.graph_util.convert_variables_to_constants(sess,sess.graph.as_graph_def(),[NombreSalida.split(':')[0]])
+    graphdef = tf.graph_util.remove_training_nodes(graphdef)
+    if precision != 'float32':
+        return _ExportarTFLite(graphdef,outfile,precision)
+    with open(outfile,'wb') as f:
+        f.write(graphdef.SerializeToString())
+
+    return outfile
+
+def _ExportarTFLite(graphdef,outfile,precision):
+
+    import tempfile
+    import tensorflow as tf
+
+    with tempfile.NamedTemporaryFile(suffix = '.pb',delete = False) as f:
+        f.write(graphdef.SerializeToString())
+    try:
+        converter = tf.lite.TFLiteConverter.from_frozen_graph(f.name,[NombreEntrada.split(':')[0]],[NombreSalida.split(':')[0]],
+                                                              input_shapes = {NombreEntrada.split(':')[0]:[1,1025,21,2]})
+    finally:
+        os.remove(f.name)
+    #int8: pesos cuantizados por canal y kernels híbridos; float16: pesos en media precisión.
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    with open(outfile,'wb') as f:
+        f.write(converter.convert())
+
+    return outfile
+
+class ModeloCongelado():
+
+    """Modelo cargado desde un grafo congelado. Expone predict con la misma
+    interfaz que el modelo de Keras, por lo que puede usarse en su lugar en
+    inferencia.PredecirEspectrograma."""
+
+    def __init__(self,modelfile = 'modelo.pb',threads = 0):
+
+        import tensorflow as tf
+
+        graphdef = tf.GraphDef()
+        with open(modelfile,'rb') as f:
+            graphdef.ParseFromString(f.read())
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graphdef,name = '')
+        self.entrada = self.graph.get_tensor_by_name(NombreEntrada)
+        self.salida = self.graph.get_tensor_by_name(NombreSalida)
+        config = tf.ConfigProto(intra_op_parallelism_threads = threads,inter_op_parallelism_threads = threads)
+        self.sess = tf.Session(graph = self.graph,config = config)
+
+    def predict(self,x,batch_size = None):
+
+        return self.sess.run(self.salida,feed_dict = {self.entrada:x})
+
+class ModeloTFLite():
+
+    """Modelo de Tensorflow Lite (pesos float16 o int8) con la misma interfaz
+    predict que el modelo de Keras."""
+
+    def __init__(self,modelfile = 'modelo.tflite',threads = None):
+
+        import tensorflow as tf
+
+        self.interprete = tf.lite.Interpreter(model_path = modelfile)
+        if threads is not None:
+            self.interprete.set_num_threads(threads)
+        self.entrada = self.interprete.get_input_details()[0]['index']
+        self.salida = self.interprete.get_output_details()[0]['index']
+        self.lote = 0
+
+    def predict(self,x,batch_size = None):
+
+        if np.size(x,0) != self.lote:
+            self.interprete.resize_tensor_input(self.entrada,list(np.shape(x)))
+            self.interprete.allocate_tensors()
+            self.lote = np.size(x,0)
+        self.interprete.set_tensor(self.entrada,np.ascontiguousarray(x,dtype = 'float32'))
+        self.interprete.invoke()
+
+        return self.interprete.get_tensor(self.salida)
+
+def CargarModeloCongelado(modelfile = 'modelo.pb'):
+
+    if modelfile.lower().endswith('.tflite'):
+        return ModeloTFLite(modelfile)
+
+    return ModeloCongelado(modelfile)
+
+#Código que corre cada variante de carga en un proceso nuevo, hasta la primera predicción:
+_Variantes = {
+    'compilado':"import ModeloDoble; m = ModeloDoble.CompileModel(); m.load_weights({weights!r})",
+    'inferencia':"import ModeloDoble; m = ModeloDoble.InferenceModel({weights!r})",
+    'congelado':"import modelocongelado; m = modelocongelado.CargarModeloCongelado({model!r})"}
+
+_Medicion = """import time
+inicio = time.perf_counter()
+{carga}
+carga = time.perf_counter() - inicio
+import numpy as np
+m.predict(np.zeros((1,1025,21,2),dtype = 'float32'))
+print(carga, time.perf_counter() - inicio)
+"""
+
+def MedirArranque(weightfile = 'pesos.hdf5',modelfile = 'modelo.pb',repeticiones = 3):
+
+    """Mide, en procesos nuevos, el tiempo de importación y carga del modelo y
+    el tiempo hasta la primera predicción para cada variante de carga.
+    Devuelve un diccionario variante -> (carga, primera predicción) en segundos
+    (mediana de las repeticiones)."""
+
+    entorno = dict(os.environ,PYTHONPATH = os.path.dirname(os.path.abspath(__file__)))
+    resultados = {}
+    for variante, carga in _Variantes.items():
+        codigo = _Medicion.format(carga = carga.format(weights = weightfile,model = modelfile))
+        tiempos = []
+        for _ in range(repeticiones):
+            salida = subprocess.run([sys.executable,'-c',codigo],stdout = subprocess.PIPE,check = True,universal_newlines = True,env = entorno)
+            tiempos.append([float(valor) for valor in salida.stdout.split()[-2:]])
+        resultados[variante] = tuple(np.median(np.array(tiempos),axis = 0))
+        print(variante + ": carga " + str(np.round(resultados[variante][0],2)) + " s, primera predicción " + str(np.round(resultados[variante][1],2)) + " s")
+
+    return resultados
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Exporta el modelo congelado y mide su tiempo de arranque.')
+    parser.add_argument('accion',choices = ['exportar','medir'])
+    parser.add_argument('--weights',default = 'pesos.hdf5',help = 'archivo .hdf5 con los pesos de la red')
+    parser.add_argument('--model',default = 'modelo.pb',help = 'archivo del modelo congelado')
+    parser.add_argument('--out',default = None,help = 'archivo de salida al exportar (por defecto --model)')
+    parser.add_argument('--precision',choices = Precisiones,default = 'float32',help = 'precisión de los pesos exportados')
+    args = parser.parse_args(argv)
+
+    if args.accion == 'exportar':
+        print("Modelo exportado en " + ExportarModelo(args.weights,args.out or args.model,args.precision))
+    else:
+        MedirArranque(args.weights,args.model)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# =============================================================================
+# realtime.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script defines a block based separator for live audio. Fixed size stereo
+# blocks go in and the four source blocks come out with a fixed latency, given
+# by the 10 future frames the network needs plus the STFT window. Processing
+# time of every block is measured to check that it keeps up with real time.
+# =============================================================================
+
+import collections
+import time
+import numpy as np
+import inferencia
+from streaming import SeparadorStreaming, WinSize, HopSize
+
+#Latencia en muestras: una muestra queda completa cuando llega el último frame de
+#la ventana contextual que la cubre (incluyendo el salto de 3 frames entre ventanas).
+LatenciaMuestras = inferencia.N_FramesWindow*HopSize + WinSize - 1
+
+class RealtimeSeparator():
+
+    """Separador de audio en tiempo real por bloques de tamaño fijo.
+    Cada llamada a ProcesarBloque recibe blocksize muestras estéreo y devuelve
+    blocksize muestras de cada fuente (forma (blocksize,2,4), en el orden bajo,
+    batería, otros y voz), retrasadas LatenciaMuestras muestras respecto de la
+    entrada (12799 muestras, unos 290 ms a 44.1 kHz). A eso se suma la duración
+    del bloque, que es inherente a procesar por bloques.
+    Argumentos:
+    model: modelo de Keras (ModeloDoble) con los pesos cargados.
+    blocksize: tamaño de bloque en muestras. Conviene que sea múltiplo de
+    3*512 para que cada bloque dispare la misma cantidad de ventanas.
+    fs: frecuencia de muestreo, usada para reportar el factor de tiempo real.
+    """
+
+    def __init__(self,model,blocksize = 3*HopSize,fs = 44100,historial = 1000):
+
+        self.blocksize = blocksize
+        self.fs = fs
+        self.latencia = LatenciaMuestras
+        self.separador = SeparadorStreaming(model,batchsize = max(blocksize//(3*HopSize),1))
+        #Buffer circular de salida, inicializado con latencia muestras de silencio:
+        self.capacidad = self.latencia + 2*blocksize + WinSize
+        self.ring = np.zeros((self.capacidad,2,inferencia.N_Sources),dtype = 'float32')
+        self.lectura = 0
+        self.disponibles = self.latencia
+        self.tiempos = collections.deque(maxlen = historial)
+
+    def ProcesarBloque(self,bloque):
+
+        """Procesa un bloque (blocksize,2) y devuelve el bloque de salida
+        (blocksize,2,4) correspondiente a la entrada de hace latencia muestras."""
+
+        inicio = time.perf_counter()
+        if np.shape(bloque) != (self.blocksize,2):
+            raise ValueError('Se esperaba un bloque de forma ' + str((self.blocksize,2)))
+        self._Escribir(self.separador.Procesar(bloque))
+        salida = self._Leer(self.blocksize)
+        self.tiempos.append(time.perf_counter() - inicio)
+
+        return salida
+
+    def Finalizar(self):
+
+        """Vacía el separador al terminar la señal y devuelve las muestras
+        pendientes (las últimas latencia muestras de la entrada)."""
+
+        self._Escribir(self.separador.Finalizar())
+
+        return self._Leer(self.disponibles)
+
+    def Estadisticas(self):
+
+        """Devuelve los tiempos de procesamiento por bloque (en segundos) y el
+        factor de tiempo real (tiempo de proceso / duración del bloque)."""
+
+        tiempos = np.array(self.tiempos)
+        duracion = self.blocksize/self.fs
+        if len(tiempos) == 0:
+            return {'bloques':0,'latencia_s':self.latencia/self.fs}
+
+        return {'bloques':len(tiempos),
+                'latencia_s':self.latencia/self.fs,
+                'ultimo_s':tiempos[-1],
+                'medio_s':np.mean(tiempos),
+                'maximo_s':np.max(tiempos),
+                'rtf_medio':np.mean(tiempos)/duracion,
+                'rtf_maximo':np.max(tiempos)/duracion,
+                'bloques_atrasados':int(np.sum(tiempos > duracion))}
+
+    def _Escribir(self,muestras):
+
+        n = np.size(muestras,0)
+        if self.disponibles + n > self.capacidad:
+            raise RuntimeError('Desborde del buffer de salida')
+        posiciones = (self.lectura + self.disponibles + np.arange(n)) % self.capacidad
+        self.ring[posiciones] = muestras
+        self.disponibles = self.disponibles + n
+
+    def _Leer(self,n):
+
+        if n > self.disponibles:
+            raise RuntimeError('El buffer de salida no tiene suficientes muestras')
+        posiciones = (self.lectura + np.arange(n)) % self.capacidad
+        salida = self.ring[posiciones]
+        self.ring[posiciones] = 0
+        self.lectura = (self.lectura + n) % self.capacidad
+        self.disponibles = self.disponibles - n
+
+        return salida
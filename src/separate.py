@@ -4,83 +4,234 @@
 # stereo mixture. Source estimates are predicted using a pretrained convolutional
 # neural network.
 #
-# When running the script, the user will be asked to open an audio file, and
-# within seconds or minutes, depending on the availability of a GPU, estimates
-# will be saved in the folder where this script is contained.
+# The script can be run from the command line with a list of files, folders or
+# glob patterns, which are separated by a pool of worker processes. Each worker
+# loads the network once and keeps it in memory. If no input is given, the user
+# will be asked to open an audio file, and within seconds or minutes, depending
+# on the availability of a GPU, estimates will be saved in the output folder.
+#
+# Usage: python separate.py canciones/*.mp3 otra.wav -o estimaciones -w 4
 # =============================================================================
 
+import argparse
+import glob
+import multiprocessing
+import os
 import leeraudio
-import tkinter as tk
-from tkinter import filedialog
-import ModeloDoble
+import inferencia
+import espectrograma
+import streaming
+import cacheseparacion
 import scipy.io.wavfile as wavfile
-import scipy.signal as signal
 import numpy as np
 
-#Ventana para abrir archivos de audio:
-root = tk.Tk()
-root.withdraw()
-file_path = filedialog.askopenfilename()
-#Se lee el archivo seleccionado:       
-[fs,audiomixture] = leeraudio.ReadAudio(file_path)
-#Se compila el modelo de Keras y se cargan los pesos:
-model = ModeloDoble.CompileModel()
-model.load_weights('pesos.hdf5')
-
-eps = np.finfo(float).eps   
-print("Analizando la señal")
-
-#Se calcula la STFT, aplica el log2 de la magnitud y acondiciona el formato del tensor de entrada a la red:
-[f,t,mixturestftl] = signal.stft(audiomixture[:,0],fs,window = 'hann',nperseg = 2048, noverlap = 2048-512)        
-[f,t,mixturestftr] = signal.stft(audiomixture[:,1],fs,window = 'hann',nperseg = 2048, noverlap = 2048-512)     
-magnitudestftin = np.array([np.log2(1+np.abs(mixturestftl)),np.log2(np.abs(mixturestftr)+1)])
-sizestft = np.shape(magnitudestftin)
-nframes = sizestft[2]               
-magnitudestftin = np.transpose(magnitudestftin,(1,2,0))
-magnitudestftin = np.reshape(magnitudestftin,(1,1025,nframes,2))
-
-#La red neuronal genera las salidas en un bucle:
-print("Realizando la separación")
-stftpredicted = np.empty((1025,nframes,2,4))
-for i in np.arange(10,nframes-11,3):
-    print("\r" + str(np.round(i/(nframes-11)*100,decimals = 1)) + "%",end='')
-    prediction = model.predict(magnitudestftin[:,:,i-10:i+11,:])   
-    #Se promedian las salidas:
-    stftpredicted[:,i-10:i+11,:,:] = stftpredicted[:,i-10:i+11,:,:] + (1/7)*prediction[0,:,:,:,:] 
-
-#Se vuelven a generar máscaras suaves y aplican en la STFT original:    
-stftpredicted = 2**stftpredicted - 1
-denmask = np.sum(stftpredicted,axis = 3)
-softmasks = np.zeros(np.shape(stftpredicted))
-sources = np.zeros(np.shape(stftpredicted))
-for i in range(4):
-    softmasks[:,:,:,i] = np.divide(stftpredicted[:,:,:,i],denmask+eps)    
-    sources[:,:,:,i] = np.multiply(softmasks[:,:,:,i],np.transpose(np.array([np.abs(mixturestftl),np.abs(mixturestftr)]),(1,2,0)))
-        
-magnitudestftoutl = sources[:,:,0,:]
-magnitudestftoutr = sources[:,:,1,:]
-        
-#Fases mezcla
-phasestftl = np.angle(mixturestftl)
-phasestftr = np.angle(mixturestftr)        
-j = np.complex(0,1)
-
-#Se invierte la STFT de cada fuente y se guardan los resultados en archivos .wav
-filename = file_path.split('/')
-filename = filename[-1]
-filename = filename.split('.')
-filename = filename[0]
-print("\nRealizando la inversión de la STFT")        
-for n, instrument in enumerate([filename+"_Bass.wav",filename+"_Drums.wav",filename+"_Other.wav",filename+"_Vocals.wav"]):  
-     
-    [t,xl] = signal.istft((np.multiply(magnitudestftoutl[:,:,n],np.exp(phasestftl*j))), fs = fs, window = 'hann', nperseg = 2048,noverlap = 2048-512,time_axis = 1, freq_axis = 0)
-    [t,xr] = signal.istft((np.multiply(magnitudestftoutr[:,:,n],np.exp(phasestftr*j))), fs = fs, window = 'hann', nperseg = 2048,noverlap = 2048-512,time_axis = 1, freq_axis = 0)       
-    x = np.array([xl,xr])
-    x = x.astype('float32')       
-    shx = np.shape(x)
-    tframes = shx[1]
-    x = np.reshape(x,(2,tframes))
-    x = np.transpose(x)
-    x = x
-    wavfile.write(instrument,fs,x)
-    
\ No newline at end of file
+ExtensionesAudio = ('.wav','.mp3','.ogg')
+InstrumentNames = ['Bass','Drums','Other','Vocals']
+
+#Modelo de cada proceso del pool (se carga una única vez por proceso):
+_modelo = None
+_batchsize = 128
+_blockseconds = None
+_cache = None
+
+def CargarModelo(weightfile = 'pesos.hdf5'):
+
+    """Carga la red entrenada para predicción. Si weightfile es un grafo
+    congelado (.pb o .tflite, ver modelocongelado.py) se carga sin Keras; si es un .hdf5
+    se construye el modelo de inferencia y se cargan los pesos."""
+
+    if weightfile.lower().endswith(('.pb','.tflite')):
+        import modelocongelado
+        return modelocongelado.CargarModeloCongelado(weightfile)
+    import ModeloDoble
+
+    return ModeloDoble.InferenceModel(weightfile)
+
+def SepararAudio(audiomixture,model,batchsize = 128,verbose = True,cache = None):
+
+    """Separa una mezcla estéreo ya leída (nmuestras,2) y devuelve las
+    estimaciones en un arreglo float32 de forma (2,4,nmuestras), con las
+    fuentes en el orden bajo, batería, otros y voz. Si se da un cache
+    (cacheseparacion.CacheSeparacion), las salidas de la red se buscan en él
+    antes de predecirlas y se guardan después."""
+
+    if verbose:
+        print("Analizando la señal")
+
+    #Se calcula la STFT de ambos canales, aplica el log2 de la magnitud y acondiciona el formato del tensor de entrada a la red:
+    mixturestft = espectrograma.STFT(np.transpose(audiomixture))
+    mixturestft = np.transpose(mixturestft,(1,2,0))
+    magnitudestftin = espectrograma.LogMagnitud(mixturestft)[None]
+
+    #La red neuronal genera las salidas por lotes de ventanas:
+    stftpredicted = None
+    if cache is not None:
+        clave = cache.Clave(audiomixture)
+        stftpredicted = cache.Leer(clave)
+    if stftpredicted is None:
+        if verbose:
+            print("Realizando la separación")
+        stftpredicted = inferencia.PredecirEspectrograma(model,magnitudestftin,batchsize = batchsize,verbose = verbose)
+        if cache is not None:
+            cache.Guardar(clave,stftpredicted)
+    elif verbose:
+        print("Salidas de la red leídas del cache")
+
+    #Se vuelven a generar máscaras suaves y aplican en la STFT original:
+    del magnitudestftin
+    sources = inferencia.AplicarMascaras(stftpredicted,mixturestft)
+    del stftpredicted, mixturestft
+
+    #Se invierten las STFT de los 2 canales de las 4 fuentes en una sola llamada:
+    if verbose:
+        print("\nRealizando la inversión de la STFT")
+
+    return espectrograma.ISTFT(np.transpose(sources,(2,3,0,1)),length = np.size(audiomixture,0))
+
+def separate_file(path,out_dir = '.',model = None,weightfile = 'pesos.hdf5',batchsize = 128,blockseconds = None,cache = None):
+
+    """Separa un archivo de audio en bajo, batería, otros y voz, y guarda las
+    estimaciones como archivos .wav en out_dir.
+    Argumentos:
+    path: archivo de audio a separar (.wav, .mp3 u .ogg).
+    out_dir: carpeta donde se guardan las estimaciones.
+    model: modelo ya cargado. Si es None se carga desde weightfile.
+    batchsize: número de ventanas por llamada a model.predict.
+    blockseconds: si se especifica, el archivo se procesa por bloques de
+    blockseconds segundos con memoria acotada (ver streaming.py).
+    cache: cache de las salidas de la red (no se usa en modo streaming).
+    Devuelve la lista de archivos generados."""
+
+    if model is None:
+        model = CargarModelo(weightfile)
+    if blockseconds is not None:
+        return streaming.separate_stream(path,out_dir,model,blockseconds,batchsize)
+    #Se lee el archivo seleccionado:
+    [fs,audiomixture] = leeraudio.ReadAudio(path)
+    x = SepararAudio(audiomixture,model,batchsize,cache = cache)
+
+    #Se guardan los resultados en archivos .wav
+    filename = os.path.splitext(os.path.basename(path))[0]
+    outfiles = []
+    for n, instrument in enumerate(InstrumentNames):
+        outfile = os.path.join(out_dir,filename + "_" + instrument + ".wav")
+        wavfile.write(outfile,fs,np.transpose(x[:,n]))
+        outfiles.append(outfile)
+
+    return outfiles
+
+def ListarArchivos(entradas):
+
+    """Expande una lista de archivos, carpetas y patrones glob en la lista de
+    archivos de audio a separar (sin repetidos y en orden)."""
+
+    archivos = []
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            candidatos = sorted(os.path.join(entrada,nombre) for nombre in os.listdir(entrada))
+        elif os.path.isfile(entrada):
+            candidatos = [entrada]
+        else:
+            candidatos = sorted(glob.glob(entrada,recursive = True))
+        for candidato in candidatos:
+            if os.path.isfile(candidato) and candidato.lower().endswith(ExtensionesAudio) and candidato not in archivos:
+                archivos.append(candidato)
+
+    return archivos
+
+def _IniciarWorker(weightfile,batchsize,blockseconds,cachedir = None,cachebytes = None,cachedtype = 'float32'):
+
+    #Cada proceso del pool carga el modelo una sola vez y lo reutiliza.
+    global _modelo, _batchsize, _blockseconds, _cache
+    _modelo = CargarModelo(weightfile)
+    _batchsize = batchsize
+    _blockseconds = blockseconds
+    _cache = None
+    if cachedir is not None:
+        _cache = cacheseparacion.CacheSeparacion(cachedir,cacheseparacion.HuellaArchivo(weightfile),cachebytes,cachedtype)
+
+def _SepararEnWorker(argumentos):
+
+    path, out_dir = argumentos
+    try:
+        return path, separate_file(path,out_dir,model = _modelo,batchsize = _batchsize,blockseconds = _blockseconds,cache = _cache), None
+    except Exception as error:
+        return path, [], repr(error)
+
+def separate_files(paths,out_dir = '.',workers = 1,weightfile = 'pesos.hdf5',batchsize = 128,blockseconds = None,
+                   cachedir = None,cachebytes = 10*2**30,cachedtype = 'float32'):
+
+    """Separa una lista de archivos repartiéndolos en un pool de workers
+    procesos. Devuelve un diccionario archivo -> lista de estimaciones
+    generadas; los archivos que fallaron se informan por consola."""
+
+    os.makedirs(out_dir,exist_ok = True)
+    tareas = [(path,out_dir) for path in paths]
+    resultados = {}
+    if workers <= 1:
+        _IniciarWorker(weightfile,batchsize,blockseconds,cachedir,cachebytes,cachedtype)
+        salidas = map(_SepararEnWorker,tareas)
+        pool = None
+    else:
+        #Se usa spawn para no heredar la sesión de Tensorflow del proceso principal:
+        pool = multiprocessing.get_context('spawn').Pool(workers,initializer = _IniciarWorker,
+                                                         initargs = (weightfile,batchsize,blockseconds,cachedir,cachebytes,cachedtype))
+        salidas = pool.imap_unordered(_SepararEnWorker,tareas)
+    try:
+        for path, outfiles, error in salidas:
+            if error is not None:
+                print("Error al separar " + path + ": " + error)
+            else:
+                print("Separado " + path)
+            resultados[path] = outfiles
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return resultados
+
+def ElegirArchivo():
+
+    """Ventana para abrir archivos de audio (uso interactivo)."""
+
+    import tkinter as tk
+    from tkinter import filedialog
+    root = tk.Tk()
+    root.withdraw()
+    file_path = filedialog.askopenfilename()
+    root.destroy()
+
+    return [file_path] if file_path else []
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description = 'Separa mezclas estéreo en bajo, batería, otros y voz.')
+    parser.add_argument('entradas',nargs = '*',help = 'archivos, carpetas o patrones glob a separar')
+    parser.add_argument('-o','--out-dir',default = '.',help = 'carpeta de salida de las estimaciones')
+    parser.add_argument('-w','--workers',type = int,default = 1,help = 'número de procesos de separación')
+    parser.add_argument('--weights',default = 'pesos.hdf5',help = 'archivo .hdf5 con los pesos de la red o modelo congelado .pb/.tflite')
+    parser.add_argument('--batch-size',type = int,default = 128,help = 'ventanas por llamada a model.predict')
+    parser.add_argument('--streaming',action = 'store_true',help = 'procesa por bloques con memoria acotada (grabaciones largas)')
+    parser.add_argument('--block-seconds',type = float,default = 10,help = 'duración de los bloques en modo streaming')
+    parser.add_argument('--cache-dir',default = None,help = 'carpeta del cache de salidas de la red')
+    parser.add_argument('--cache-gb',type = float,default = 10,help = 'tamaño máximo del cache en GB')
+    parser.add_argument('--cache-float16',action = 'store_true',help = 'guarda el cache en float16 (la mitad de espacio, salidas cuantizadas)')
+    args = parser.parse_args(argv)
+
+    if args.entradas:
+        paths = ListarArchivos(args.entradas)
+    else:
+        paths = ElegirArchivo()
+    if not paths:
+        parser.error('no se encontraron archivos de audio para separar')
+
+    #El tamaño de los bloques se calcula con la frecuencia de muestreo de cada archivo:
+    blockseconds = args.block_seconds if args.streaming else None
+    resultados = separate_files(paths,args.out_dir,args.workers,args.weights,args.batch_size,blockseconds,
+                                args.cache_dir,int(args.cache_gb*2**30),'float16' if args.cache_float16 else 'float32')
+
+    return 0 if all(resultados.values()) else 1
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,237 @@
+# =============================================================================
+# streaming.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# This script defines a streaming version of the separation. Audio is read in
+# blocks, the STFT is computed incrementally, and only the frames still needed
+# by the 10 past / 10 future frames context window of the network are kept in
+# fixed size buffers. Source estimates are written incrementally using overlap-add, so peak
+# memory does not depend on the length of the recording.
+# =============================================================================
+
+import os
+import struct
+import numpy as np
+import inferencia
+import leeraudio
+import espectrograma
+from espectrograma import WinSize, HopSize, NFreqs
+
+class SeparadorStreaming():
+
+    """Separador incremental. Recibe bloques de audio estéreo de cualquier
+    tamaño con Procesar y devuelve las muestras de las fuentes que ya quedaron
+    completas; Finalizar devuelve el resto al terminar la señal.
+    Las salidas tienen forma (nmuestras,2,4) con las fuentes en el orden bajo,
+    batería, otros y voz. El resultado coincide con la separación del archivo
+    completo (boundary = 'zeros' y padded = True de scipy.signal.stft).
+    Los buffers de entrada, de espectrogramas y de overlap-add tienen tamaño
+    fijo (la ventana contextual más 3*batchsize frames): los bloques grandes se
+    procesan por partes y lo que queda pendiente se corre al principio."""
+
+    def __init__(self,model,batchsize = 128):
+
+        self.model = model
+        self.batchsize = batchsize
+        self.window, _ = espectrograma.Ventana()
+        #Frames nuevos por paso (batchsize ventanas) y capacidad del buffer de frames:
+        self.framesporpaso = inferencia.HopVentanas*batchsize
+        self.capacidad = inferencia.N_FramesWindow + self.framesporpaso
+        #Muestras de entrada que todavía no completan un frame (se agregan WinSize/2 ceros al principio):
+        self.entrada = np.zeros((WinSize + (self.framesporpaso-1)*HopSize,2),dtype = 'float32')
+        self.pendiente = WinSize//2
+        self.nentrada = 0
+        #Frames desde el inicio de la próxima ventana de la red (los anteriores ya se entregaron).
+        #Los frames van en el primer eje para que correr los pendientes sea una sola copia contigua,
+        #salvo en las magnitudes, que se guardan con la forma de las ventanas de la red:
+        self.stftmezcla = np.zeros((self.capacidad,NFreqs,2),dtype = 'complex64')
+        self.magnitudes = np.zeros((NFreqs,self.capacidad,2),dtype = 'float32')
+        self.acumulado = np.zeros((self.capacidad,NFreqs,2,inferencia.N_Sources),dtype = 'float32')
+        self.nframes = 0
+        #Buffers de overlap-add de la ISTFT (las primeras WinSize-HopSize muestras son la cola pendiente):
+        self.ola = np.zeros(((self.capacidad-1)*HopSize + WinSize,2,inferencia.N_Sources),dtype = 'float32')
+        self.norma = np.zeros(((self.capacidad-1)*HopSize + WinSize,),dtype = 'float32')
+        self.salidas = 0
+
+    def Procesar(self,bloque):
+
+        """Agrega un bloque (nmuestras,2) de audio y devuelve las muestras de
+        salida disponibles."""
+
+        bloque = np.asarray(bloque,dtype = 'float32')
+        self.nentrada = self.nentrada + np.size(bloque,0)
+
+        return self._Agregar(bloque)
+
+    def Finalizar(self):
+
+        """Completa la señal con ceros como lo hace scipy.signal.stft y
+        devuelve las últimas muestras de salida."""
+
+        relleno = WinSize//2 + (-self.nentrada) % HopSize
+        salidas = [self._Agregar(np.zeros((relleno,2),dtype = 'float32')),self._Separar(final = True)]
+        #Se vacían los buffers de overlap-add y se recorta al largo de la entrada:
+        cola = self._Normalizar(self.ola[:WinSize-HopSize],self.norma[:WinSize-HopSize])
+        salidas.append(self._Recortar(cola))
+
+        return np.concatenate(salidas)
+
+    def _Agregar(self,bloque):
+
+        #Copia el bloque al buffer de entrada por partes, calculando y separando los frames de cada una:
+        salidas = []
+        inicio = 0
+        while inicio < np.size(bloque,0):
+            n = min(np.size(self.entrada,0) - self.pendiente,np.size(bloque,0) - inicio)
+            self.entrada[self.pendiente:self.pendiente+n] = bloque[inicio:inicio+n]
+            self.pendiente = self.pendiente + n
+            inicio = inicio + n
+            if self._CalcularFrames():
+                salidas.append(self._Separar(final = False))
+
+        if len(salidas) == 1:
+            return salidas[0]
+
+        return np.concatenate(salidas) if salidas else np.zeros((0,2,inferencia.N_Sources),dtype = 'float32')
+
+    def _CalcularFrames(self):
+
+        nnuevos = (self.pendiente - WinSize)//HopSize + 1
+        if nnuevos <= 0:
+            return False
+        sm,sc = self.entrada.strides
+        frames = np.lib.stride_tricks.as_strided(self.entrada,shape = (2,nnuevos,WinSize),strides = (sc,HopSize*sm,sm))
+        stft = np.transpose(espectrograma.FFTFrames(frames),(1,2,0))
+        nuevos = slice(self.nframes,self.nframes + nnuevos)
+        self.stftmezcla[nuevos] = stft
+        self.magnitudes[:,nuevos] = np.swapaxes(espectrograma.LogMagnitud(stft),0,1)
+        self.nframes = self.nframes + nnuevos
+        #Las muestras que no completan un frame pasan al principio del buffer:
+        resto = self.pendiente - nnuevos*HopSize
+        self.entrada[:resto] = self.entrada[nnuevos*HopSize:self.pendiente]
+        self.pendiente = resto
+
+        return True
+
+    def _Separar(self,final):
+
+        #Se predicen todas las ventanas completas que haya en el buffer:
+        magnitudes = self.magnitudes[None,:,:self.nframes]
+        _, inicios = inferencia.VentanasDeslizantes(magnitudes)
+        nlistos = 0
+        if len(inicios) > 0:
+            prediccion = inferencia.PredecirEspectrograma(self.model,magnitudes,self.batchsize,verbose = False)
+            self.acumulado[:self.nframes] += np.swapaxes(prediccion,0,1)
+            #Los frames anteriores a la próxima ventana ya no reciben más contribuciones:
+            nlistos = inicios[-1] + inferencia.HopVentanas
+        if final:
+            nlistos = self.nframes
+        if nlistos == 0:
+            return np.zeros((0,2,inferencia.N_Sources),dtype = 'float32')
+
+        salida = self._Reconstruir(np.swapaxes(self.acumulado[:nlistos],0,1),np.swapaxes(self.stftmezcla[:nlistos],0,1))
+        #Los frames pendientes (menos que una ventana) pasan al principio de los buffers:
+        resto = self.nframes - nlistos
+        self.stftmezcla[:resto] = self.stftmezcla[nlistos:self.nframes]
+        self.magnitudes[:,:resto] = self.magnitudes[:,nlistos:self.nframes]
+        self.acumulado[:resto] = self.acumulado[nlistos:self.nframes]
+        self.acumulado[resto:self.nframes] = 0
+        self.nframes = resto
+
+        return salida
+
+    def _Reconstruir(self,stftpredicted,stftmezcla):
+
+        #Máscaras suaves aplicadas sobre la STFT de la mezcla (módulo y fase):
+        sources = inferencia.AplicarMascaras(stftpredicted,stftmezcla)
+        #ISTFT de todos los frames y overlap-add por segmentos de HopSize muestras:
+        frames = np.transpose(espectrograma.IFFTFrames(np.transpose(sources,(1,2,3,0))),(3,0,1,2))
+        nframes = np.size(frames,1)
+        for q in range(WinSize//HopSize):
+            segmento = frames[q*HopSize:(q+1)*HopSize]
+            segmento = np.transpose(segmento,(1,0,2,3)).reshape(nframes*HopSize,2,inferencia.N_Sources)
+            self.ola[q*HopSize:q*HopSize + nframes*HopSize] += segmento
+            self.norma[q*HopSize:q*HopSize + nframes*HopSize] += np.tile(self.window[q*HopSize:(q+1)*HopSize]**2,nframes)
+        #Las muestras anteriores a nframes*HopSize ya recibieron todos sus frames:
+        completas = nframes*HopSize
+        salida = self._Normalizar(self.ola[:completas],self.norma[:completas])
+        cola = WinSize - HopSize
+        self.ola[:cola] = self.ola[completas:completas + cola]
+        self.norma[:cola] = self.norma[completas:completas + cola]
+        self.ola[cola:completas + cola] = 0
+        self.norma[cola:completas + cola] = 0
+
+        return self._Recortar(salida)
+
+    def _Normalizar(self,ola,norma):
+
+        norma = np.where(norma > 1e-10,norma,1)
+
+        return ola/norma[:,None,None]
+
+    def _Recortar(self,salida):
+
+        #Se descartan las WinSize/2 muestras del relleno inicial y todo lo que exceda el largo de la entrada:
+        inicio = self.salidas
+        self.salidas = self.salidas + np.size(salida,0)
+        desde = max(WinSize//2 - inicio,0)
+        hasta = max(min(WinSize//2 + self.nentrada - inicio,np.size(salida,0)),desde)
+
+        return salida[desde:hasta]
+
+class EscritorWav():
+
+    """Escribe un archivo .wav estéreo en float32 de forma incremental. Los
+    tamaños del encabezado se completan al cerrarlo."""
+
+    def __init__(self,filename,fs,nchannels = 2):
+
+        self.archivo = open(filename,'wb')
+        self.nchannels = nchannels
+        self.nmuestras = 0
+        blockalign = 4*nchannels
+        self.archivo.write(b'RIFF' + struct.pack('<I',0) + b'WAVE')
+        self.archivo.write(b'fmt ' + struct.pack('<IHHIIHHH',18,3,nchannels,fs,fs*blockalign,blockalign,32,0))
+        self.archivo.write(b'fact' + struct.pack('<II',4,0))
+        self.archivo.write(b'data' + struct.pack('<I',0))
+
+    def Escribir(self,x):
+
+        x = np.ascontiguousarray(x,dtype = '<f4')
+        self.archivo.write(x.tobytes())
+        self.nmuestras = self.nmuestras + np.size(x,0)
+
+    def Cerrar(self):
+
+        ndatos = self.nmuestras*4*self.nchannels
+        self.archivo.seek(4)
+        self.archivo.write(struct.pack('<I',4 + 26 + 12 + 8 + ndatos))
+        self.archivo.seek(12 + 26 + 8)
+        self.archivo.write(struct.pack('<I',self.nmuestras))
+        self.archivo.seek(12 + 26 + 12 + 4)
+        self.archivo.write(struct.pack('<I',ndatos))
+        self.archivo.close()
+
+def separate_stream(path,out_dir,model,blockseconds = 10,batchsize = 128):
+
+    """Separa un archivo de audio por bloques de blockseconds segundos con memoria
+    acotada, escribiendo las estimaciones a medida que se generan.
+    Devuelve la lista de archivos generados."""
+
+    [fs,bloques] = leeraudio.ReadAudioBlocks(path,segundos = blockseconds)
+    filename = os.path.splitext(os.path.basename(path))[0]
+    outfiles = [os.path.join(out_dir,filename + "_" + instrument + ".wav") for instrument in ['Bass','Drums','Other','Vocals']]
+    escritores = [EscritorWav(outfile,fs) for outfile in outfiles]
+    separador = SeparadorStreaming(model,batchsize)
+    try:
+        for bloque in bloques:
+            salida = separador.Procesar(bloque)
+            for n,escritor in enumerate(escritores):
+                escritor.Escribir(salida[:,:,n])
+        salida = separador.Finalizar()
+        for n,escritor in enumerate(escritores):
+            escritor.Escribir(salida[:,:,n])
+    finally:
+        for escritor in escritores:
+            escritor.Cerrar()
+
+    return outfiles
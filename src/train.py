@@ -3,17 +3,25 @@
 #
 # This script allows to train the implemented convolutional neural network.
 # It is necessary to specify dataset folder location in BatchGenerator.py and
-# ValidationGenerator.py. It is possible to restart training if files with weights  
-# and optimizer state are available.
+# ValidationGenerator.py. If checkpoints of a previous run are found (see
+# checkpoints.json), training resumes automatically from the last one, even
+# in the middle of an epoch.
+# Data-parallel training across processes or machines (Horovod):
+#   horovodrun -np 4 -H localhost:4 python train.py --distribuido
 # =============================================================================
 
+import sys
 import ModeloDoble
 import trainmodel
-from MisCallbacks import LeerModelo, ConfigurarTF
+from MisCallbacks import ConfigurarTF
 
-ConfigurarTF()
-model = ModeloDoble.CompileModel()
-#Descomentar esta linea si se pausó el entrenamiento previamente:
-#model = LeerModelo(model,'weights-11.hdf5','optimizador.pkl')
-trainmodel.trainmodel(model)
+#Los procesos de aumentación (spawn) vuelven a importar este script, por lo que el
+#entrenamiento solo debe ejecutarse en el proceso principal:
+if __name__ == '__main__':
+    distribuido = '--distribuido' in sys.argv
+    ConfigurarTF(distribuido = distribuido)
+    model = ModeloDoble.CompileModel(distribuido = distribuido)
+    #Para cargar pesos de otro entrenamiento usar MisCallbacks.LeerModelo y reanudar = False.
+    #Con pasoscheckpoint se guarda también cada tantos lotes (se pierde menos al interrumpirse):
+    trainmodel.trainmodel(model,pasoscheckpoint = 500,distribuido = distribuido)
 
@@ -5,27 +5,117 @@
 # can be modified. Also, Tensorboard setting is possible.
 # =============================================================================
 
+import numpy as np
 from BatchGenerator import DataGenerator
 from ValidationGenerator import ValidationDataGenerator
 from keras.callbacks import TensorBoard
-from MisCallbacks import GuardarModelo
+from MisCallbacks import GuardarModelo, EstadisticasDatos, LeerModelo, RestaurarAleatorio, UltimoCheckpoint
 
-def trainmodel(model):
-    """Función que configura el entrenamiento del modelo y lo ejecuta."""
-    #Se usan generadores los cuales levantan los lotes de datos para entrenar la red:
-    training_generator = DataGenerator()
-    validation_generator = ValidationDataGenerator()
+def trainmodel(model,workers = 1,use_multiprocessing = False,seed = None,pasoscheckpoint = None,conservar = 3,
+               reanudar = True,epocas = 20,distribuido = False,aumentarporlote = False):
+    """Función que configura el entrenamiento del modelo y lo ejecuta.
+    Cada lote depende solo de la semilla, la época y su número, por lo que
+    pueden usarse varios workers (hilos o, con use_multiprocessing, procesos).
+    aumentarporlote: los ejemplos aumentados se generan para cada lote en lugar
+    de tomarse de chunks precalculados (ver DataGenerator); es lo recomendado
+    con use_multiprocessing o distribuido, pero no se activa solo.
+    pasoscheckpoint: lotes entre checkpoints dentro de cada época (None: solo al
+    final de la época). Se conservan los conservar checkpoints más recientes y
+    el de menor costo de validación.
+    reanudar: si hay checkpoints de un entrenamiento anterior (por ejemplo
+    interrumpido con SIGTERM), se cargan pesos, optimizador, semilla y
+    generador aleatorio del más reciente y se continúa desde su lote, con los
+    mismos lotes que se hubieran usado sin la interrupción.
+    distribuido: paralelismo de datos sincrónico con Horovod (el modelo debe
+    compilarse con ModeloDoble.CompileModel(distribuido = True)). Cada proceso
+    entrena con una partición disjunta de los lotes de cada época y los
+    gradientes se promedian en cada paso, por lo que el lote efectivo es de
+    batch_size por la cantidad de procesos. El proceso 0 lee y guarda los
+    checkpoints y le envía a los demás los pesos, la semilla y el lote desde
+    el que se continúa."""
+    [trabajador,trabajadores] = [0,1]
+    if distribuido:
+        import horovod.keras as hvd
+        [trabajador,trabajadores] = [hvd.rank(),hvd.size()]
 
     #Guardado de pesos y estado del optimizador en cada época:
     filepath = "weights-{epoch:02d}.hdf5"
-    checkpoint = GuardarModelo(filepath)
+    ultimo = UltimoCheckpoint(filepath) if reanudar and trabajador == 0 else None
+    [epoca,paso] = [0,0]
+    error = None #Motivo por el que no se puede reanudar (en el proceso 0)
+    if ultimo is not None and 'generador' in ultimo:
+        if ultimo['paso'] > 0 and ultimo['generador'].get('trabajadores',1) != trabajadores:
+            error = (ultimo['archivo'] + ' se guardó con ' + str(ultimo['generador'].get('trabajadores',1)) +
+                     ' procesos: solo puede reanudarse con otra cantidad desde el final de una época.')
+        else:
+            model = LeerModelo(model,ultimo['archivo'])
+            RestaurarAleatorio(ultimo['numpy'])
+            seed = ultimo['generador']['seed']
+            [epoca,paso] = [ultimo['epoca'],ultimo['paso']]
+            print('Reanudando desde ' + ultimo['archivo'] + ': época ' + str(epoca + 1) + ', lote ' + str(paso))
+
+    #Se usan generadores los cuales levantan los lotes de datos para entrenar la red:
+    training_generator = DataGenerator(seed = seed,aumentarporlote = aumentarporlote,
+                                       trabajador = trabajador,trabajadores = trabajadores)
+    if distribuido:
+        #El conjunto de validación en disco lo calcula un solo proceso por máquina; el resto
+        #espera (barrera) y abre los mismos archivos:
+        if hvd.local_rank() == 0:
+            validation_generator = ValidationDataGenerator(trabajador = trabajador,trabajadores = trabajadores)
+        hvd.allreduce(np.zeros(1,dtype = 'float32'),name = 'validacion')
+        if hvd.local_rank() != 0:
+            validation_generator = ValidationDataGenerator(trabajador = trabajador,trabajadores = trabajadores)
+    else:
+        validation_generator = ValidationDataGenerator()
+    if error is None and ultimo is not None and 'generador' in ultimo and ultimo['generador']['lotesporepoca'] != training_generator.LotesPorEpoca():
+        error = 'El dataset cambió desde ' + ultimo['archivo'] + ': no se puede reanudar exactamente.'
+
+    if distribuido:
+        #El proceso 0 informa a todos si se puede reanudar y desde dónde, para que ninguno
+        #quede esperando si hay un error; todos usan su plan de épocas, su lote y sus pesos:
+        estado = np.array([error is not None,training_generator.seed,epoca,paso],dtype = 'int64')
+        [fallo,seed,epoca,paso] = [int(valor) for valor in hvd.broadcast(estado,0,name = 'reanudar')]
+        if fallo:
+            raise ValueError(error or 'El proceso 0 no pudo reanudar el entrenamiento (ver su salida).')
+        training_generator.seed = seed #Todavía no se armó ningún lote
+        model._make_train_function()
+        hvd.broadcast_global_variables(0)
+    elif error is not None:
+        raise ValueError(error)
+
+    checkpoint = GuardarModelo(filepath,cadapasos = pasoscheckpoint,conservar = conservar,generador = training_generator,
+                               distribuido = distribuido)
     
     #Despliegue de estadísticas de entrenamiento en Tensorboard
     tbCallBack = TensorBoard(log_dir = './Graph', histogram_freq = 0, write_graph = True,write_images = False)    
-    callbacklist = [checkpoint,tbCallBack]
+    #Tiempo que el entrenamiento esperó por datos (debe ir antes de Tensorboard para que lo registre):
+    esperadatos = EstadisticasDatos(training_generator)
+    callbacklist = [checkpoint,esperadatos,tbCallBack]
+    if distribuido:
+        #Las métricas se promedian entre procesos antes de guardarlas; todos atienden SIGTERM
+        #(GuardarModelo) pero solo el proceso 0 escribe:
+        callbacklist = [hvd.callbacks.MetricAverageCallback(),esperadatos,checkpoint] + ([tbCallBack] if trabajador == 0 else [])
 
-    #Mediante esta función se entrena la red:
-    model.fit_generator(generator=training_generator,validation_data=validation_generator,
-                        epochs = 20, callbacks = callbacklist)
-    
-    
\ No newline at end of file
+    def entrenar(hasta):
+        #Mediante esta función se entrena la red:
+        model.fit_generator(generator=training_generator,validation_data=validation_generator,
+                            epochs = hasta, initial_epoch = epoca, callbacks = callbacklist,
+                            workers = workers, use_multiprocessing = use_multiprocessing,
+                            shuffle = False, #Los lotes ya son aleatorios; en orden se aprovechan los chunks aumentados
+                            verbose = 1 if trabajador == 0 else 0)
+
+    try:
+        if paso > 0:
+            #Resto de la época interrumpida (Keras calcula los lotes por época una sola vez por llamada):
+            training_generator.Posicionar(epoca,paso)
+            checkpoint.salto = paso
+            entrenar(epoca + 1)
+            epoca = epoca + 1
+        if epoca < epocas and not checkpoint.detenido:
+            training_generator.Posicionar(epoca)
+            entrenar(epocas)
+    finally:
+        #Se detienen los hilos y procesos de precarga del generador:
+        training_generator.close()
+
+    return model
@@ -0,0 +1,71 @@
+# =============================================================================
+# conftest.py - Leonardo Pepino (Universidad Nacional de Tres de Febrero)
+#
+# Shared fixtures of the tests. The modules live in src/ and import each other
+# by name, so that folder is added to the path. The dataset fixtures write
+# small synthetic datasets with the DSD100 folder layout, and generadores
+# builds the batch generators of the tests on them.
+# =============================================================================
+
+import os
+import sys
+import numpy as np
+import pytest
+import scipy.io.wavfile as wavfile
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir,'src'))
+
+Fuentes = ['bass','drums','other','vocals']
+
+def EscribirCancion(carpeta,subset,nombre,fuentes,fs = 44100):
+
+    """Escribe las fuentes (4,nmuestras,2) int16 y su mezcla con la estructura
+    de carpetas de DSD100. fuentes también puede ser una lista de pistas de
+    distinto largo."""
+
+    os.makedirs(os.path.join(carpeta,'Mixtures',subset,nombre),exist_ok = True)
+    os.makedirs(os.path.join(carpeta,'Sources',subset,nombre),exist_ok = True)
+    largo = min(np.size(fuente,0) for fuente in fuentes)
+    mezcla = np.sum([fuente[:largo] for fuente in fuentes],axis = 0,dtype = 'int16')
+    wavfile.write(os.path.join(carpeta,'Mixtures',subset,nombre,'mixture.wav'),fs,mezcla)
+    for fuente,instrumento in zip(fuentes,Fuentes):
+        wavfile.write(os.path.join(carpeta,'Sources',subset,nombre,instrumento + '.wav'),fs,fuente)
+
+@pytest.fixture
+def dataset(tmp_path):
+
+    #Dos canciones de ruido de 3 segundos en Dev y una en Test:
+    rng = np.random.RandomState(0)
+    for subset,canciones in [('Dev',2),('Test',1)]:
+        for n in range(canciones):
+            fuentes = (rng.randn(4,3*44100,2)*2000).astype('int16')
+            EscribirCancion(str(tmp_path),subset,'cancion ' + str(n).zfill(3),fuentes)
+
+    return str(tmp_path)
+
+@pytest.fixture
+def datasetlargo(tmp_path):
+
+    #Dos canciones de 24 segundos en Dev: alcanzan para un bloque de aumentación
+    #(100 ventanas), necesario para los chunks aumentados de DataGenerator.
+    rng = np.random.RandomState(1)
+    for n in range(2):
+        fuentes = (rng.randn(4,24*44100,2)*2000).astype('int16')
+        EscribirCancion(str(tmp_path),'Dev','cancion ' + str(n).zfill(3),fuentes)
+
+    return str(tmp_path)
+
+@pytest.fixture
+def generadores():
+
+    #Crea generadores (DataGenerator o ValidationDataGenerator) con lotes de 4
+    #ejemplos y cierra los que tienen close() al terminar el test.
+    creados = []
+    def crear(clase,datasetpath,**kwargs):
+        generador = clase(batch_size = 4,datasetpath = datasetpath,**kwargs)
+        creados.append(generador)
+        return generador
+    yield crear
+    for generador in creados:
+        if hasattr(generador,'close'):
+            generador.close()
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+keras = pytest.importorskip('keras')
+import keras.backend as k
+from keras.layers import Input, Dense
+from keras.models import Model
+from MisCallbacks import AdamEscalado
+
+@pytest.fixture(autouse = True)
+def sesion():
+
+    k.clear_session()
+    yield
+    k.clear_session()
+
+def _Modelo(optimizador):
+
+    entrada = Input((1,))
+    modelo = Model(entrada,Dense(1,use_bias = False,kernel_initializer = 'zeros')(entrada))
+    #Costo lineal: el gradiente del peso es siempre la entrada.
+    modelo.compile(loss = lambda yTrue,yPred: k.mean(yPred),optimizer = optimizador)
+
+    return modelo
+
+def test_pasos_finitos_son_los_de_adam():
+
+    #Con gradiente constante 1, Adam con corrección de sesgo mueve el peso lr en cada paso.
+    modelo = _Modelo(AdamEscalado(2.0**10,intervalo = 2,lr = 0.1))
+    unos = np.ones((1,1),dtype = 'float32')
+    for paso in range(1,4):
+        modelo.train_on_batch(unos,unos)
+        np.testing.assert_allclose(modelo.get_weights()[0],[[-0.1*paso]],rtol = 1e-5)
+    optimizador = modelo.optimizer
+    assert k.get_value(optimizador.iterations) == 3
+    assert k.get_value(optimizador.escala) == 2.0**11 #Se duplica tras intervalo pasos sin desbordes
+
+def test_desborde_saltea_el_paso_y_divide_la_escala():
+
+    modelo = _Modelo(AdamEscalado(2.0**10,lr = 0.1))
+    unos = np.ones((1,1),dtype = 'float32')
+    modelo.train_on_batch(unos,unos)
+    optimizador = modelo.optimizer
+    [pesos,estado] = [modelo.get_weights(),optimizador.get_weights()]
+    modelo.train_on_batch(np.full((1,1),np.inf,dtype = 'float32'),unos)
+    assert all(np.array_equal(a,b) for a,b in zip(modelo.get_weights(),pesos))
+    assert all(np.array_equal(a,b) for a,b in zip(optimizador.get_weights()[:-2],estado[:-2]))
+    assert k.get_value(optimizador.escala) == 2.0**9
+    assert k.get_value(optimizador.validos) == 0
+
+def test_escala_se_guarda_con_los_pesos_del_optimizador():
+
+    modelo = _Modelo(AdamEscalado(2.0**10,lr = 0.1))
+    modelo.train_on_batch(np.ones((1,1),dtype = 'float32'),np.ones((1,1),dtype = 'float32'))
+    optimizador = modelo.optimizer
+    assert optimizador.weights[-2:] == [optimizador.escala,optimizador.validos]
+    pesos = optimizador.get_weights()
+    pesos[-2] = np.float32(64)
+    optimizador.set_weights(pesos)
+    assert k.get_value(optimizador.escala) == 64
+    #Los checkpoints anteriores no tienen escala ni validos: se conservan los actuales.
+    optimizador.set_weights(pesos[:-2])
+    assert k.get_value(optimizador.escala) == 64
+
+def test_exp2emphasis_no_desborda():
+
+    from MisCapas import exp2emphasis
+    x = k.constant([[0.0,1.0,3.0,1000.0]])
+    y = k.get_value(exp2emphasis(x))
+    np.testing.assert_allclose(y[0,:3],[0.0,1.0,7.0])
+    assert np.all(np.isfinite(y))
+
+def test_precision_mixta_solo_en_gpu():
+
+    import tensorflow as tf
+    import ModeloDoble
+    if tf.test.is_gpu_available():
+        pytest.skip('hay una GPU')
+    with pytest.raises(ValueError):
+        ModeloDoble.CompileModel(precision = 'float16')
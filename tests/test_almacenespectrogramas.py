@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import scipy.io.wavfile as wavfile
+import espectrograma
+import almacenespectrogramas
+from almacenespectrogramas import AlmacenEspectrogramas, ConstruirAlmacen
+from indicedataset import ListarCanciones, Subconjuntos
+from conftest import EscribirCancion
+
+def _Espectrogramas(archivos):
+
+    #Espectrogramas de referencia de una canción, con las pistas recortadas a la más corta.
+    pistas = [wavfile.read(archivo)[1] for archivo in archivos]
+    largo = min(np.size(pista,0) for pista in pistas)
+    audio = np.array([np.transpose(pista[:largo]) for pista in pistas]).astype('float32')/np.float32(2**15-1)
+
+    return espectrograma.LogMagnitudSTFT(audio)
+
+def test_ventanas_iguales_a_la_stft(dataset,tmp_path):
+
+    almacen = str(tmp_path/'almacen')
+    ConstruirAlmacen(dataset,'Dev',almacen,dtype = 'float32',shardbytes = 2**20)
+    leido = AlmacenEspectrogramas(almacen)
+    assert leido.N_Songs == 2 and leido.fs == 44100
+    assert len(leido.indice['shards']) == 2
+    for cancion,(nombre,archivos) in enumerate(ListarCanciones(dataset,'Dev')):
+        esperado = _Espectrogramas(archivos)
+        assert leido.framescancion[cancion] == np.size(esperado,-1)
+        for frame in [0,100]:
+            np.testing.assert_array_equal(leido.Ventana(cancion,frame),esperado[...,frame:frame+21])
+
+def test_almacen_complejo_igual_al_de_magnitudes(dataset,tmp_path):
+
+    ConstruirAlmacen(dataset,'Test',str(tmp_path/'magnitudes'),dtype = 'float32')
+    ConstruirAlmacen(dataset,'Test',str(tmp_path/'complejo'),dtype = 'float32',complejo = True)
+    magnitudes = AlmacenEspectrogramas(str(tmp_path/'magnitudes'))
+    complejo = AlmacenEspectrogramas(str(tmp_path/'complejo'))
+    assert complejo.VentanaCompleja(0,10).dtype == np.complex64
+    np.testing.assert_allclose(complejo.Ventana(0,10),magnitudes.Ventana(0,10),atol = 1e-5)
+
+def test_pistas_de_distinto_largo_se_recortan(tmp_path):
+
+    rng = np.random.RandomState(1)
+    fuentes = [(rng.randn(44100 + 700*n,2)*2000).astype('int16') for n in range(4)]
+    EscribirCancion(str(tmp_path),'Dev','despareja',fuentes)
+    ConstruirAlmacen(str(tmp_path),'Dev',str(tmp_path/'almacen'),dtype = 'float32')
+    leido = AlmacenEspectrogramas(str(tmp_path/'almacen'))
+    esperado = _Espectrogramas(ListarCanciones(str(tmp_path),'Dev')[0][1])
+    assert leido.framescancion[0] == np.size(esperado,-1)
+    np.testing.assert_array_equal(leido.Ventana(0,leido.framescancion[0] - 21),esperado[...,-21:])
+
+def test_subconjuntos_de_dsd100_y_musdb(dataset,tmp_path):
+
+    assert Subconjuntos(dataset) == ['Dev','Test']
+    for subset in ['train','test']:
+        (tmp_path/'musdb'/subset/'cancion').mkdir(parents = True)
+    assert Subconjuntos(str(tmp_path/'musdb')) == ['test','train']
+
+def test_main_rechaza_subconjuntos_inexistentes(dataset,tmp_path,capsys):
+
+    with pytest.raises(SystemExit):
+        almacenespectrogramas.main([dataset,'train',str(tmp_path/'almacen')])
+    assert 'Dev, Test' in capsys.readouterr().err
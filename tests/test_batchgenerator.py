@@ -0,0 +1,61 @@
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+from BatchGenerator import DataGenerator
+
+#Con 1 la aumentación corre en el hilo de precarga; con 2, en un pool de procesos (como por defecto).
+Aumentadores = pytest.mark.parametrize('aumentadores',[1,2])
+
+def _Crear(generadores,dataset,lotesprecargados,aumentadores):
+
+    #Un bloque de aumentación por chunk, para que los chunks se generen rápido.
+    return generadores(DataGenerator,dataset,lotesprecargados = lotesprecargados,aumentadores = aumentadores,
+                       muestrasaumentadas = 100*20*512,seed = 3)
+
+def _Iguales(a,b):
+
+    return all(np.array_equal(x,y) for x,y in zip(a,b))
+
+@Aumentadores
+def test_precarga_no_cambia_los_lotes(datasetlargo,generadores,aumentadores):
+
+    sinprecarga = _Crear(generadores,datasetlargo,0,aumentadores)
+    conprecarga = _Crear(generadores,datasetlargo,4,aumentadores)
+    for idx in range(6):
+        assert _Iguales(conprecarga[idx],sinprecarga[idx])
+    #Los lotes que ya armó el productor al cambiar de época se conservan:
+    sinprecarga.on_epoch_end()
+    conprecarga.on_epoch_end()
+    assert _Iguales(conprecarga[0],sinprecarga[0])
+    assert conprecarga.productor is not None and not conprecarga.desordenado
+
+@Aumentadores
+def test_pedidos_en_paralelo_dan_los_mismos_lotes(datasetlargo,generadores,aumentadores):
+
+    sinprecarga = _Crear(generadores,datasetlargo,0,aumentadores)
+    conprecarga = _Crear(generadores,datasetlargo,4,aumentadores)
+    orden = [1,0,3,2,5,4,7,6]
+    with ThreadPoolExecutor(4) as hilos:
+        lotes = list(hilos.map(conprecarga.__getitem__,orden))
+    for idx,lote in zip(orden,lotes):
+        assert _Iguales(lote,sinprecarga[idx])
+    #Con pedidos en paralelo o fuera de orden no se precargan lotes:
+    assert conprecarga.desordenado and conprecarga.productor is None
+
+@Aumentadores
+def test_close_detiene_hilos_y_procesos(datasetlargo,generadores,aumentadores):
+
+    generador = _Crear(generadores,datasetlargo,4,aumentadores)
+    primero = generador[0]
+    #El chunk siguiente queda precargándose mientras se cierra el generador:
+    cargador = generador.cargador
+    generador.close()
+    assert not any(hilo.is_alive() for hilo in cargador._threads)
+    assert [hilo for hilo in threading.enumerate() if not hilo.daemon and hilo is not threading.main_thread()] == []
+    assert multiprocessing.active_children() == []
+    #Después de close el generador sigue entregando los mismos lotes:
+    assert _Iguales(generador[0],primero)
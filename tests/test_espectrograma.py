@@ -0,0 +1,32 @@
+import numpy as np
+import scipy.signal as signal
+import espectrograma
+
+def _Audio(forma,semilla = 0):
+
+    return np.random.RandomState(semilla).uniform(-1,1,size = forma).astype('float32')
+
+def test_stft_igual_a_scipy():
+
+    audio = _Audio((2,3,20000))
+    [f,t,esperado] = signal.stft(audio,window = espectrograma.WinType,nperseg = espectrograma.WinSize,
+                                 noverlap = espectrograma.Overlap,boundary = 'zeros',padded = True)
+    stft = espectrograma.STFT(audio)
+    assert stft.shape == esperado.shape
+    assert stft.dtype == np.complex64
+    np.testing.assert_allclose(stft,esperado,atol = 1e-5)
+
+def test_log_magnitud_stft_igual_a_log_magnitud_de_stft():
+
+    audio = _Audio((5,2,30000),1)
+    np.testing.assert_allclose(espectrograma.LogMagnitudSTFT(audio),espectrograma.LogMagnitud(espectrograma.STFT(audio)),atol = 1e-6)
+
+def test_istft_igual_a_scipy_y_reconstruye():
+
+    audio = _Audio((2,20000),2)
+    stft = espectrograma.STFT(audio)
+    [t,esperado] = signal.istft(stft,window = espectrograma.WinType,nperseg = espectrograma.WinSize,
+                                noverlap = espectrograma.Overlap,boundary = True)
+    reconstruido = espectrograma.ISTFT(stft,length = np.size(audio,-1))
+    np.testing.assert_allclose(reconstruido,esperado[...,:np.size(audio,-1)],atol = 1e-5)
+    np.testing.assert_allclose(reconstruido,audio,atol = 1e-5)
@@ -0,0 +1,46 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+from ValidationGenerator import ValidationDataGenerator
+
+def _Crear(generadores,dataset,cache,**kwargs):
+
+    return generadores(ValidationDataGenerator,dataset,lotes = 3,cache = cache,subset = 'Dev',**kwargs)
+
+def test_cache_en_float32_igual_a_los_lotes_calculados(dataset,generadores,tmp_path):
+
+    cache = str(tmp_path/'validacion')
+    generador = _Crear(generadores,dataset,cache)
+    assert all(archivo.endswith('_float32_x.npy') or archivo.endswith('_float32_y.npy') for archivo in generador.archivoscache)
+    sincache = _Crear(generadores,dataset,None)
+    for idx in range(len(generador)):
+        [x,y] = generador[idx]
+        [xcalculado,ycalculado] = sincache[idx]
+        assert x.dtype == np.float32
+        np.testing.assert_array_equal(x,xcalculado)
+        np.testing.assert_array_equal(y,ycalculado)
+    #Una segunda instancia lee el mismo conjunto sin recalcularlo:
+    fechas = [os.path.getmtime(archivo) for archivo in generador.archivoscache]
+    assert _Crear(generadores,dataset,cache).archivoscache == generador.archivoscache
+    assert [os.path.getmtime(archivo) for archivo in generador.archivoscache] == fechas
+
+def test_cache_float16_es_opcional_y_aparte(dataset,generadores,tmp_path):
+
+    cache = str(tmp_path/'validacion')
+    float32 = _Crear(generadores,dataset,cache)
+    float16 = _Crear(generadores,dataset,cache,dtype = 'float16')
+    assert float16.archivoscache != float32.archivoscache
+    assert np.load(float16.archivoscache[0],mmap_mode = 'r').dtype == np.float16
+    [x,y] = float16[0]
+    assert x.dtype == np.float32
+    np.testing.assert_allclose(x,float32[0][0],rtol = 1e-3,atol = 1e-5)
+    np.testing.assert_allclose(y,float32[0][1],rtol = 1e-3,atol = 1e-5)
+
+def test_trabajadores_reparten_los_lotes(dataset,generadores):
+
+    completo = _Crear(generadores,dataset,None)
+    [primero,segundo] = [_Crear(generadores,dataset,None,trabajador = n,trabajadores = 2) for n in range(2)]
+    assert len(primero) == len(segundo) == 1
+    np.testing.assert_array_equal(segundo[0][0],completo[1][0])